@@ -0,0 +1,116 @@
+"""Benchmark of the initial estimators of sqil_experiments.analysis.estimators.
+
+Compares the sqil_core fits started from their default guesses with the same fits
+seeded by the estimators, on synthetic T1, Rabi and Ramsey traces.
+
+Usage
+-----
+python benchmarks/benchmark_estimators.py [n_traces] [noise]
+"""
+
+import sys
+import time
+
+import numpy as np
+from sqil_core import fit
+
+from sqil_experiments.analysis.estimators import (
+    estimate_decaying_exp,
+    estimate_decaying_oscillations,
+    estimate_many_decaying_oscillations,
+)
+
+
+def benchmark_estimators(n_traces=100, noise=0.05, seed=0) -> dict:
+    """Runs the fits with and without the estimators on n_traces random traces.
+
+    A fit fails if it raises, returns None or misses the decay time by more than 20%.
+    For each case returns the number of failures, the mean number of function
+    evaluations of the returned fit and the total fit time.
+    """
+    rng = np.random.default_rng(seed)
+
+    def nfev(fit_res):
+        output = fit_res.output
+        if isinstance(output, tuple) and len(output) > 2:
+            return output[2].get("nfev", np.nan)
+        return getattr(output, "nfev", np.nan)
+
+    def t1_trace():
+        tau = rng.uniform(5e-6, 100e-6)
+        x = np.hstack([np.linspace(0, tau, 11), np.geomspace(1.1 * tau, 5 * tau, 11)])
+        y = rng.uniform(0.5, 2) * np.exp(-x / tau) + rng.uniform(-1, 1)
+        return x, y, tau, {}
+
+    def rabi_trace():
+        T = rng.uniform(50e-9, 300e-9)
+        tau = rng.uniform(1, 3) * 4 * T
+        x = np.linspace(0, 4 * T, 101)
+        y = rng.uniform(0.5, 2) * np.exp(-x / tau) * np.cos(2 * np.pi * x / T)
+        return x, y + rng.uniform(-1, 1), tau, {}
+
+    def ramsey_trace():
+        tau, f = rng.uniform(2e-6, 20e-6), rng.uniform(0.5e6, 3e6)
+        x = np.linspace(0, 2 * tau, 201)
+        phi = rng.uniform(-np.pi, np.pi)
+        y = rng.uniform(0.5, 2) * np.exp(-x / tau) * np.cos(2 * np.pi * f * x + phi)
+        return x, y + rng.uniform(-1, 1), tau, {"n": 1}
+
+    cases = {
+        "decaying_exp": (
+            t1_trace,
+            fit.fit_decaying_exp,
+            estimate_decaying_exp,
+            "tau",
+        ),
+        "decaying_oscillations": (
+            rabi_trace,
+            fit.fit_decaying_oscillations,
+            lambda x, y: estimate_decaying_oscillations(x, y, num_init=10),
+            "tau",
+        ),
+        "many_decaying_oscillations": (
+            ramsey_trace,
+            fit.fit_many_decaying_oscillations,
+            estimate_many_decaying_oscillations,
+            "tau0",
+        ),
+    }
+
+    results = {}
+    for name, (make_trace, fit_func, estimator, tau_name) in cases.items():
+        traces = []
+        for _ in range(n_traces):
+            x, y, tau, kwargs = make_trace()
+            y = y + noise * rng.normal(size=len(y))
+            traces.append((x, y, tau, kwargs))
+        for seeded in [False, True]:
+            failed, evaluations, start = 0, [], time.perf_counter()
+            for x, y, tau, kwargs in traces:
+                try:
+                    guess = estimator(x, y, **kwargs) if seeded else None
+                    fit_res = fit_func(x, y, guess=guess, **kwargs)
+                    tau_fit = fit_res.params_by_name[tau_name]
+                    evaluations.append(nfev(fit_res))
+                    if abs(tau_fit - tau) > 0.2 * tau:
+                        failed += 1
+                except Exception:
+                    failed += 1
+            results[(name, "seeded" if seeded else "default")] = {
+                "failed": failed,
+                "mean_nfev": float(np.nanmean(evaluations)) if evaluations else np.nan,
+                "time": time.perf_counter() - start,
+            }
+    return results
+
+
+if __name__ == "__main__":
+    n_traces = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    noise = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    results = benchmark_estimators(n_traces, noise)
+    print(f"{'fit':<28}{'guess':<10}{'failed':>8}{'mean nfev':>12}{'time [s]':>10}")
+    for (name, guess), res in results.items():
+        print(
+            f"{name:<28}{guess:<10}{res['failed']:>8}"
+            f"{res['mean_nfev']:>12.1f}{res['time']:>10.2f}"
+        )
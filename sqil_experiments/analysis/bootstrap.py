@@ -0,0 +1,176 @@
+"""Vectorized bootstrap uncertainties.
+
+Standard errors from the fit covariance assume a locally linear model and are
+unreliable on the short, log-spaced delay grids used by the adaptive experiments.
+Here the residuals of the best fit are resampled and all the bootstrap replicas are
+refitted at once.
+
+For a decaying exponential y = A exp(-k x) + y0 the amplitude and offset are linear
+once the rate k is fixed (variable projection). The best k of every replica is the
+one that maximizes the projection of the data onto span{exp(-k x), 1}, which is
+evaluated on a shared grid of k for all the replicas with a single matrix product
+and refined with a parabolic interpolation.
+"""
+
+import numpy as np
+
+DEFAULT_N_BOOT = 1000
+DEFAULT_CONFIDENCE = 0.95
+# Decay rates searched around the initial estimate, as factors of it
+RATE_SPAN = 30
+RATE_POINTS = 400
+
+
+def _rate_grid(k0: float) -> np.ndarray:
+    return k0 * np.geomspace(1 / RATE_SPAN, RATE_SPAN, RATE_POINTS)
+
+
+def fit_decaying_exp_batch(x, y_batch, k0: float):
+    """Fits y = A exp(-x / tau) + y0 to every row of y_batch.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Shared x values, shape (n,).
+    y_batch : np.ndarray
+        Traces to fit, shape (B, n).
+    k0 : float
+        Estimate of the decay rate 1/tau, the search is done within a factor
+        RATE_SPAN of it.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        A, tau and y0, each of shape (B,). Rows whose best rate is at the edge of
+        the search range are NaN.
+    """
+    x = np.asarray(x, dtype=float)
+    y_batch = np.atleast_2d(np.asarray(y_batch, dtype=float))
+    log_k = np.log(_rate_grid(k0))
+
+    # Orthonormal basis of span{exp(-k x), 1} for every k on the grid, (K, n, 2)
+    basis = np.stack(
+        [np.exp(-np.exp(log_k)[:, None] * x[None, :]), np.ones((len(log_k), len(x)))],
+        axis=-1,
+    )
+    q, _ = np.linalg.qr(basis)
+    # Squared norm of the projection of every replica for every k, (K, B)
+    q_flat = q.transpose(1, 0, 2).reshape(len(x), -1)
+    projection = (y_batch @ q_flat).reshape(len(y_batch), len(log_k), 2)
+    score = np.sum(projection**2, axis=-1).T
+
+    best = np.argmax(score, axis=0)
+    valid = (best > 0) & (best < len(log_k) - 1)
+    i = np.clip(best, 1, len(log_k) - 2)
+    cols = np.arange(y_batch.shape[0])
+    s_prev, s_best, s_next = score[i - 1, cols], score[i, cols], score[i + 1, cols]
+    # Vertex of the parabola through the three points around the maximum
+    denominator = s_prev - 2 * s_best + s_next
+    with np.errstate(divide="ignore", invalid="ignore"):
+        offset = np.where(denominator < 0, 0.5 * (s_prev - s_next) / denominator, 0)
+    step = log_k[1] - log_k[0]
+    k = np.exp(log_k[i] + np.clip(offset, -1, 1) * step)
+
+    # Amplitude and offset, solving the 2x2 normal equations of every replica
+    exp_kx = np.exp(-k[:, None] * x[None, :])
+    n = len(x)
+    s_ee, s_e = np.sum(exp_kx**2, axis=1), np.sum(exp_kx, axis=1)
+    s_ey, s_y = np.sum(exp_kx * y_batch, axis=1), np.sum(y_batch, axis=1)
+    det = s_ee * n - s_e**2
+    A = (s_ey * n - s_e * s_y) / det
+    y0 = (s_ee * s_y - s_e * s_ey) / det
+
+    tau = np.where(valid, 1 / k, np.nan)
+    return np.where(valid, A, np.nan), tau, np.where(valid, y0, np.nan)
+
+
+def _interval(samples, confidence):
+    samples = samples[np.isfinite(samples)]
+    if len(samples) == 0:
+        return np.nan, np.nan, np.nan
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(samples, [alpha, 1 - alpha])
+    return float(np.std(samples, ddof=1)) if len(samples) > 1 else np.nan, low, high
+
+
+def bootstrap_decaying_exp(
+    x,
+    y,
+    tau=None,
+    n_boot: int = DEFAULT_N_BOOT,
+    confidence: float = DEFAULT_CONFIDENCE,
+    seed=None,
+) -> dict:
+    """Residual bootstrap of a decaying exponential fit.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Data, e.g. the projected T1 or T2 echo trace.
+    tau : float, optional
+        Fitted decay time, used to center the search. By default it's estimated
+        from the data.
+    n_boot : int, optional
+        Number of bootstrap replicas, by default 1000.
+    confidence : float, optional
+        Confidence level of the percentile intervals, by default 0.95.
+    seed : optional
+        Seed of the resampling.
+
+    Returns
+    -------
+    dict
+        For each parameter (``A``, ``tau``, ``y0``) the best fit value, the
+        bootstrap standard deviation ``<name>_std`` and the interval
+        ``<name>_ci`` = [low, high]. ``n_valid`` is the number of replicas that
+        converged inside the search range.
+    """
+    from sqil_experiments.analysis.estimators import estimate_decaying_exp
+
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if tau is None or not np.isfinite(tau) or tau <= 0:
+        tau = estimate_decaying_exp(x, y)[1] or np.ptp(x) / 3
+    k0 = 1 / tau
+
+    # Best fit on the data, then residuals rescaled for the 3 fitted parameters
+    names = ["A", "tau", "y0"]
+    best = [float(p[0]) for p in fit_decaying_exp_batch(x, y[None, :], k0)]
+    result = dict(zip(names, best))
+    samples = {name: np.array([]) for name in names}
+    if np.isfinite(result["tau"]):
+        A, tau_fit, y0 = best
+        y_fit = A * np.exp(-x / tau_fit) + y0
+        residuals = (y - y_fit) * np.sqrt(len(y) / max(len(y) - 3, 1))
+
+        rng = np.random.default_rng(seed)
+        idx = rng.integers(0, len(y), size=(n_boot, len(y)))
+        y_boot = y_fit[None, :] + residuals[idx]
+        samples = dict(zip(names, fit_decaying_exp_batch(x, y_boot, 1 / tau_fit)))
+
+    for name, values in samples.items():
+        std, low, high = _interval(values, confidence)
+        result[f"{name}_std"] = std
+        result[f"{name}_ci"] = [float(low), float(high)]
+    result["n_valid"] = int(np.count_nonzero(np.isfinite(samples["tau"])))
+    return result
+
+
+def bootstrap_mean(
+    values,
+    n_boot: int = DEFAULT_N_BOOT,
+    confidence: float = DEFAULT_CONFIDENCE,
+    seed=None,
+) -> dict:
+    """Bootstrap of the mean of repeated measurements, ignoring NaNs.
+
+    Returns the ``mean``, its bootstrap standard error ``std`` and the interval
+    ``ci`` = [low, high].
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return {"mean": np.nan, "std": np.nan, "ci": [np.nan, np.nan]}
+    rng = np.random.default_rng(seed)
+    means = values[rng.integers(0, len(values), size=(n_boot, len(values)))].mean(1)
+    std, low, high = _interval(means, confidence)
+    return {"mean": float(np.mean(values)), "std": std, "ci": [float(low), float(high)]}
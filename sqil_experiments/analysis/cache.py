@@ -0,0 +1,233 @@
+"""Persistent cache for the analysis of stored runs.
+
+Entries are keyed by the content of the data folder (``data.ddh5`` and
+``qpu_old.json``), the analysis function and its version, and the arguments used to
+call it. Figures are never cached: a cache hit returns fits, parameters, outputs and
+extra data only.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pickle
+from functools import wraps
+from pathlib import Path
+
+import numpy as np
+from sqil_core.experiment import AnalysisResult
+from sqil_core.fit import FitResult
+
+from sqil_experiments.analysis.fit_table import FitTable
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "sqil_experiments", "analysis"
+)
+DEFAULT_MAX_SIZE = 512 * 1024**2  # bytes
+
+# Files that define the input of an analysis run on a stored folder
+HASHED_FILES = ["data.ddh5", "qpu_old.json"]
+# Keyword arguments that do not change the analysis result
+IGNORED_KWARGS = [
+    "use_cache",
+    "pulse_sheet",
+    "update_params",
+    "headless",
+    "parallel_qubits",
+    "max_workers",
+]
+
+
+def hash_data_folder(path: str, chunk_size: int = 2**20) -> str:
+    """Returns the sha256 of the files an analysis reads from a data folder."""
+    if os.path.isfile(path):
+        path = os.path.dirname(path)
+    sha = hashlib.sha256()
+    for filename in HASHED_FILES:
+        file_path = os.path.join(path, filename)
+        if not os.path.isfile(file_path):
+            continue
+        sha.update(filename.encode())
+        with open(file_path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _canonical(value):
+    """Converts an argument into a deterministic, json serializable object."""
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+        return {"ndarray": digest, "dtype": str(value.dtype), "shape": value.shape}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in sorted(value.items(), key=str)}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(value)
+
+
+def _is_picklable(obj) -> bool:
+    try:
+        pickle.dumps(obj)
+    except Exception:
+        return False
+    return True
+
+
+def portable_fit(fit_res: FitResult) -> FitResult:
+    """Returns a copy of a FitResult without the raw optimizer output and without
+    callables that cannot be pickled (e.g. lambdas used as predict functions).
+    FitTables are already portable and are returned as they are."""
+    if isinstance(fit_res, FitTable):
+        return fit_res
+    predict = fit_res.predict
+    if getattr(predict, "__self__", None) is fit_res or not _is_picklable(predict):
+        predict = None
+    metadata = {k: v for k, v in fit_res.metadata.items() if _is_picklable(v)}
+    return FitResult(
+        fit_res.params,
+        fit_res.std_err,
+        None,
+        metrics=fit_res.metrics,
+        predict=predict,
+        param_names=fit_res.param_names,
+        model_name=fit_res.model_name,
+        metadata=metadata,
+    )
+
+
+class AnalysisCache:
+    """On-disk LRU cache of AnalysisResult objects.
+
+    Each entry is a pickle file in ``cache_dir``. The modification time of the file
+    is refreshed on every hit and the least recently used entries are removed once
+    the total size exceeds ``max_size`` bytes.
+    """
+
+    def __init__(self, cache_dir: str | None = None, max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, path: str, func_name: str, version, kwargs: dict) -> str:
+        kwargs = {k: v for k, v in kwargs.items() if k not in IGNORED_KWARGS}
+        signature = {
+            "data": hash_data_folder(path),
+            "function": func_name,
+            "version": version,
+            "kwargs": _canonical(kwargs),
+        }
+        return hashlib.sha256(json.dumps(signature).encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.pkl"
+
+    def get(self, key: str) -> AnalysisResult | None:
+        entry = self._entry_path(key)
+        try:
+            with open(entry, "rb") as f:
+                content = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(entry)
+        self.hits += 1
+        return AnalysisResult(**content)
+
+    def put(self, key: str, anal_res: AnalysisResult):
+        content = {
+            "data_path": anal_res.data_path,
+            "output": anal_res.output,
+            "updated_params": anal_res.updated_params,
+            "fits": {k: portable_fit(v) for k, v in anal_res.fits.items()},
+            "extra_data": anal_res.extra_data,
+        }
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry = self._entry_path(key)
+        tmp = entry.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(content, f)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits max_size."""
+        if not self.cache_dir.exists():
+            return
+        entries = [(p, p.stat()) for p in self.cache_dir.glob("*.pkl")]
+        total = sum(st.st_size for _, st in entries)
+        for p, st in sorted(entries, key=lambda e: e[1].st_mtime):
+            if total <= self.max_size:
+                break
+            p.unlink(missing_ok=True)
+            total -= st.st_size
+
+    def clear(self):
+        for p in self.cache_dir.glob("*.pkl"):
+            p.unlink(missing_ok=True)
+
+    @property
+    def size(self) -> int:
+        return sum(p.stat().st_size for p in self.cache_dir.glob("*.pkl"))
+
+
+_default_cache: AnalysisCache | None = None
+
+
+def get_analysis_cache() -> AnalysisCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = AnalysisCache(os.environ.get("SQIL_ANALYSIS_CACHE_DIR"))
+    return _default_cache
+
+
+def cached_analysis(version=1, cache: AnalysisCache | None = None):
+    """Caches the result of an analysis function called on a stored run.
+
+    The cache is opt-in: it's used only when the decorated function is called with
+    ``path=...`` and ``use_cache=True``. A cache hit returns an AnalysisResult
+    without figures, call again with ``use_cache=False`` to redraw them.
+    Bump ``version`` whenever the analysis logic changes.
+
+    Example
+    -------
+    >>> @cached_analysis(version=2)
+    ... @multi_qubit_handler
+    ... def analyze_T1(datadict, qpu=None, qu_id="q0", **kwargs): ...
+    >>> anal_res = analyze_T1(path=path, use_cache=True)
+    """
+
+    def decorator(analysis_func):
+        func_name = f"{analysis_func.__module__}.{analysis_func.__qualname__}"
+
+        @wraps(analysis_func)
+        def wrapper(*args, path=None, use_cache=False, **kwargs):
+            can_cache = (
+                use_cache
+                and path is not None
+                and kwargs.get("datadict") is None
+                and kwargs.get("qpu") is None
+            )
+            if not can_cache:
+                return analysis_func(*args, path=path, **kwargs)
+
+            anal_cache = cache or get_analysis_cache()
+            key = anal_cache.make_key(path, func_name, version, kwargs)
+            anal_res = anal_cache.get(key)
+            if anal_res is not None:
+                return anal_res
+
+            anal_res = analysis_func(*args, path=path, **kwargs)
+            if isinstance(anal_res, AnalysisResult):
+                anal_cache.put(key, anal_res)
+            return anal_res
+
+        return wrapper
+
+    return decorator
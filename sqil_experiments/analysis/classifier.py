@@ -0,0 +1,248 @@
+"""Multi-state readout classifier.
+
+The IQ shots of all the prepared states are modelled as a Gaussian mixture with one
+component per state and a covariance matrix shared by all the components. The
+mixture is fitted with expectation-maximization, starting from the mean of each
+prepared state, so that every component keeps the label of the state it was seeded
+from. With a shared covariance the decision boundaries are straight lines.
+
+To handle 10^7 shots the mixture can be fitted on a random subsample, while the
+assignment matrix is always computed on all the shots, in chunks.
+"""
+
+import numpy as np
+from matplotlib.colors import LinearSegmentedColormap, to_rgb
+
+DEFAULT_CHUNK_SIZE = 2**20
+
+
+def _to_points(shots) -> np.ndarray:
+    shots = np.ravel(np.asarray(shots))
+    return np.column_stack([shots.real, shots.imag])
+
+
+def _subsample(points, max_shots, rng):
+    if max_shots is None or len(points) <= max_shots:
+        return points
+    return points[rng.choice(len(points), max_shots, replace=False)]
+
+
+def _log_likelihoods(points, means, cov_inv, log_weights):
+    """Returns log(w_k) + log N(x; mu_k, cov) up to a constant, shape (N, K)."""
+    # Mahalanobis distance expanded as x.S.x - 2 x.S.mu + mu.S.mu, avoids (N, K, 2)
+    x_s = points @ cov_inv
+    x_s_x = np.einsum("ij,ij->i", x_s, points)
+    mu_s_mu = np.einsum("kj,jl,kl->k", means, cov_inv, means)
+    mahalanobis = x_s_x[:, None] - 2 * x_s @ means.T + mu_s_mu[None, :]
+    return log_weights[None, :] - mahalanobis / 2
+
+
+def fit_gmm_shared_cov(points, init_means, max_iter=200, tol=1e-8):
+    """Expectation-maximization for a Gaussian mixture with shared covariance.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        Array of shape (N, 2).
+    init_means : np.ndarray
+        Initial means of the K components, shape (K, 2).
+    max_iter : int, optional
+        Maximum number of EM iterations, by default 200.
+    tol : float, optional
+        Stop when the mean log-likelihood improves less than tol, by default 1e-8.
+
+    Returns
+    -------
+    dict
+        ``means``, ``cov``, ``weights``, ``log_likelihood`` (mean per shot),
+        ``n_iter`` and ``converged``.
+    """
+    n, k = len(points), len(init_means)
+    means = np.array(init_means, dtype=float)
+    weights = np.full(k, 1 / k)
+    # Pooled covariance around the closest seed
+    closest = np.argmax(_log_likelihoods(points, means, np.eye(2), np.zeros(k)), axis=1)
+    diff = points - means[closest]
+    cov = diff.T @ diff / n
+
+    log_likelihood, converged = -np.inf, False
+    for n_iter in range(1, max_iter + 1):
+        # E-step
+        cov_inv = np.linalg.inv(cov)
+        log_p = _log_likelihoods(points, means, cov_inv, np.log(weights))
+        log_norm = np.logaddexp.reduce(log_p, axis=1)
+        resp = np.exp(log_p - log_norm[:, None])
+        new_log_likelihood = np.mean(log_norm) - 0.5 * np.log(np.linalg.det(cov))
+
+        # M-step
+        nk = resp.sum(axis=0) + 1e-12
+        weights = nk / n
+        means = resp.T @ points / nk[:, None]
+        cov = (points.T @ points - (means.T * nk) @ means) / n
+
+        if abs(new_log_likelihood - log_likelihood) < tol:
+            log_likelihood, converged = new_log_likelihood, True
+            break
+        log_likelihood = new_log_likelihood
+
+    return {
+        "means": means,
+        "cov": cov,
+        "weights": weights,
+        "log_likelihood": float(log_likelihood),
+        "n_iter": n_iter,
+        "converged": converged,
+    }
+
+
+def predict_states(points, means, cov, chunk_size=DEFAULT_CHUNK_SIZE) -> np.ndarray:
+    """Index of the most likely component for every point (equal priors)."""
+    cov_inv = np.linalg.inv(cov)
+    log_weights = np.zeros(len(means))
+    labels = np.empty(len(points), dtype=np.intp)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start : start + chunk_size]
+        log_p = _log_likelihoods(chunk, means, cov_inv, log_weights)
+        labels[start : start + chunk_size] = np.argmax(log_p, axis=1)
+    return labels
+
+
+def pairwise_thresholds(states, means, cov) -> dict:
+    """Linear decision boundaries between every pair of states.
+
+    A shot x is closer to state i than to state j when ``normal . x > offset``,
+    with x = [I, Q].
+    """
+    cov_inv = np.linalg.inv(cov)
+    thresholds = {}
+    for i in range(len(states)):
+        for j in range(i + 1, len(states)):
+            normal = cov_inv @ (means[i] - means[j])
+            offset = normal @ (means[i] + means[j]) / 2
+            thresholds[f"{states[i]}{states[j]}"] = {
+                "normal": normal.tolist(),
+                "offset": float(offset),
+            }
+    return thresholds
+
+
+def fit_state_classifier(
+    shots: dict,
+    max_shots: int | None = None,
+    max_iter: int = 200,
+    tol: float = 1e-8,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    seed: int = 0,
+) -> dict:
+    """Fits a shared-covariance Gaussian mixture to the shots of the prepared states.
+
+    Parameters
+    ----------
+    shots : dict
+        Complex single shots for every prepared state, e.g. {"g": ..., "e": ...}.
+    max_shots : int, optional
+        Fit the mixture on at most max_shots random shots per state. The assignment
+        matrix is still computed on all the shots. By default all shots are used.
+    max_iter, tol : optional
+        EM stopping criteria.
+    chunk_size : int, optional
+        Number of shots classified at once when computing the assignment matrix.
+    seed : int, optional
+        Seed of the subsampling.
+
+    Returns
+    -------
+    dict
+        ``states``, the mixture parameters (``means`` as complex numbers, ``cov``,
+        ``weights``), the ``assignment_matrix`` A[i, j] = P(measured j | prepared i),
+        per-state ``fidelities``, the mean assignment ``fidelity``, the pairwise
+        ``thresholds`` and the EM diagnostics.
+    """
+    rng = np.random.default_rng(seed)
+    states = list(shots.keys())
+    points = {s: _to_points(shots[s]) for s in states}
+    init_means = np.array([np.mean(points[s], axis=0) for s in states])
+
+    sample = np.concatenate([_subsample(points[s], max_shots, rng) for s in states])
+    gmm = fit_gmm_shared_cov(sample, init_means, max_iter=max_iter, tol=tol)
+
+    assignment = np.zeros((len(states), len(states)))
+    for i, s in enumerate(states):
+        labels = predict_states(points[s], gmm["means"], gmm["cov"], chunk_size)
+        assignment[i] = np.bincount(labels, minlength=len(states)) / len(labels)
+
+    fidelities = dict(zip(states, np.diag(assignment).tolist()))
+    return {
+        "states": states,
+        "means": (gmm["means"][:, 0] + 1j * gmm["means"][:, 1]),
+        "cov": gmm["cov"],
+        "weights": gmm["weights"],
+        "assignment_matrix": assignment,
+        "fidelities": fidelities,
+        "fidelity": float(np.mean(np.diag(assignment))),
+        "thresholds": pairwise_thresholds(states, gmm["means"], gmm["cov"]),
+        "log_likelihood": gmm["log_likelihood"],
+        "n_iter": gmm["n_iter"],
+        "converged": gmm["converged"],
+    }
+
+
+def plot_iq_density(ax, shots: dict, colors: dict, bins=200, scale=1, clf=None):
+    """Plots every state as a 2D histogram tinted with its color, instead of
+    scattering the single shots. If a classifier is given, its decision boundaries
+    are drawn on top."""
+    all_shots = np.concatenate([np.ravel(v) for v in shots.values()]) * scale
+    i_range = np.percentile(all_shots.real, [0.05, 99.95])
+    q_range = np.percentile(all_shots.imag, [0.05, 99.95])
+    extent = [*i_range, *q_range]
+
+    for s, state in shots.items():
+        state = np.ravel(state) * scale
+        counts, _, _ = np.histogram2d(
+            state.real, state.imag, bins=bins, range=[extent[:2], extent[2:]]
+        )
+        rgb = to_rgb(colors[s])
+        cmap = LinearSegmentedColormap.from_list(s, [(*rgb, 0), (*rgb, 1)])
+        ax.imshow(
+            np.sqrt(counts.T / counts.max()),
+            origin="lower",
+            extent=extent,
+            cmap=cmap,
+            aspect="auto",
+            interpolation="nearest",
+            zorder=-1,
+        )
+
+    if clf is not None:
+        i_grid = np.linspace(extent[0], extent[1], bins)
+        q_grid = np.linspace(extent[2], extent[3], bins)
+        ii, qq = np.meshgrid(i_grid, q_grid)
+        grid = np.column_stack([ii.ravel(), qq.ravel()]) / scale
+        means = np.column_stack([clf["means"].real, clf["means"].imag])
+        labels = predict_states(grid, means, clf["cov"]).reshape(ii.shape)
+        ax.contour(
+            ii,
+            qq,
+            labels,
+            levels=np.arange(len(clf["states"]) - 1) + 0.5,
+            colors="k",
+            linewidths=1,
+            linestyles="--",
+        )
+    ax.set_xlim(extent[:2])
+    ax.set_ylim(extent[2:])
+
+
+def plot_assignment_matrix(ax, clf):
+    states = clf["states"]
+    assignment = clf["assignment_matrix"]
+    ax.imshow(assignment, cmap="Blues", vmin=0, vmax=1)
+    for i in range(len(states)):
+        for j in range(len(states)):
+            color = "white" if assignment[i, j] > 0.5 else "black"
+            ax.text(j, i, f"{assignment[i, j]:.3f}", ha="center", va="center", c=color)
+    ax.set_xticks(range(len(states)), states)
+    ax.set_yticks(range(len(states)), states)
+    ax.set_xlabel("Measured state")
+    ax.set_ylabel("Prepared state")
+    ax.set_title(f"Assignment fidelity {clf['fidelity']:.4f}")
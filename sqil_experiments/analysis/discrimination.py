@@ -0,0 +1,175 @@
+"""Single-shot discrimination of two readout states.
+
+All the quantities are computed with NumPy on the projected shots: the Gaussian
+parameters are the sample mean and std, the threshold is the crossing point of the
+two fitted Gaussians and the assignment fidelity is evaluated analytically from
+their CDFs. Plotting is optional and uses a random subset of the shots.
+"""
+
+import matplotlib.pyplot as plt
+import numpy as np
+from scipy.special import ndtr
+
+DEFAULT_BINS = 100
+DEFAULT_MAX_POINTS = 10_000
+
+
+def project_shots(res0, res1):
+    """Rotates the IQ plane so that the line connecting the two blobs is along the
+    real axis and returns the rotation angle and the projected (real) shots.
+
+    The state 0 blob ends up on the right of the state 1 blob.
+    """
+    res0, res1 = np.asarray(res0), np.asarray(res1)
+    connect_vector = np.mean(res0) - np.mean(res1)
+    rotation_angle = -np.angle(connect_vector)
+    cos, sin = np.cos(rotation_angle), np.sin(rotation_angle)
+    # Real part of res * exp(1j * angle), without allocating the rotated arrays
+    proj0 = res0.real * cos - res0.imag * sin
+    proj1 = res1.real * cos - res1.imag * sin
+    return rotation_angle, proj0, proj1
+
+
+def gaussian_crossing(mu0, sigma0, w0, mu1, sigma1, w1):
+    """Returns the point between mu1 and mu0 where the two weighted Gaussians
+    w * N(x; mu, sigma) intersect."""
+    a = 1 / (2 * sigma1**2) - 1 / (2 * sigma0**2)
+    b = mu0 / sigma0**2 - mu1 / sigma1**2
+    c = (
+        mu1**2 / (2 * sigma1**2)
+        - mu0**2 / (2 * sigma0**2)
+        + np.log(w0 / sigma0)
+        - np.log(w1 / sigma1)
+    )
+    midpoint = (mu0 + mu1) / 2
+    if np.isclose(a, 0, atol=1e-12 * abs(b)):
+        return -c / b if b != 0 else midpoint
+    roots = np.roots([a, b, c])
+    roots = roots[np.isreal(roots)].real
+    if len(roots) == 0:
+        return midpoint
+    lo, hi = min(mu0, mu1), max(mu0, mu1)
+    between = roots[(roots >= lo) & (roots <= hi)]
+    candidates = between if len(between) else roots
+    return candidates[np.argmin(np.abs(candidates - midpoint))]
+
+
+def discriminate(res0, res1, bins=DEFAULT_BINS) -> dict:
+    """Discriminates the single shots of two prepared states.
+
+    Parameters
+    ----------
+    res0, res1 : np.ndarray
+        Complex single shots measured after preparing state 0 and state 1.
+    bins : int, optional
+        Number of bins of the projected histograms, by default 100.
+
+    Returns
+    -------
+    dict
+        ``threshold`` (on the projected axis, crossing of the fitted Gaussians,
+        used for the fidelities and the plots), ``rotation_angle``,
+        ``snr``, ``fidelity`` (analytic), ``fidelity_measured`` (counting the
+        shots on the wrong side of the threshold), ``errors`` (analytic error
+        probability of each state), the Gaussian parameters ``mu`` and ``sigma``,
+        and the ``histograms`` (counts and the shared bin edges).
+    """
+    rotation_angle, proj0, proj1 = project_shots(res0, res1)
+    n0, n1 = len(proj0), len(proj1)
+
+    mu0, sigma0 = np.mean(proj0), np.std(proj0)
+    mu1, sigma1 = np.mean(proj1), np.std(proj1)
+
+    threshold = gaussian_crossing(mu0, sigma0, n0, mu1, sigma1, n1)
+
+    # State 0 is on the right of the threshold, state 1 on the left
+    error0 = ndtr((threshold - mu0) / sigma0)
+    error1 = 1 - ndtr((threshold - mu1) / sigma1)
+    fidelity = 1 - error0 - error1
+    measured0 = np.count_nonzero(proj0 < threshold) / n0
+    measured1 = np.count_nonzero(proj1 >= threshold) / n1
+
+    snr = np.abs(mu0 - mu1) / np.sqrt(sigma0**2 + sigma1**2)
+
+    lo = min(proj0.min(), proj1.min())
+    hi = max(proj0.max(), proj1.max())
+    counts0, edges = np.histogram(proj0, bins=bins, range=(lo, hi))
+    counts1, _ = np.histogram(proj1, bins=bins, range=(lo, hi))
+
+    return {
+        "threshold": float(threshold),
+        "rotation_angle": float(rotation_angle),
+        "snr": float(snr),
+        "fidelity": float(fidelity),
+        "fidelity_measured": float(1 - measured0 - measured1),
+        "errors": [float(error0), float(error1)],
+        "mu": [float(mu0), float(mu1)],
+        "sigma": [float(sigma0), float(sigma1)],
+        "histograms": {"counts": [counts0, counts1], "edges": edges},
+    }
+
+
+def downsample(data, max_points=DEFAULT_MAX_POINTS, seed=0):
+    """Returns a random subset of at most max_points elements."""
+    data = np.asarray(data)
+    if max_points is None or len(data) <= max_points:
+        return data
+    rng = np.random.default_rng(seed)
+    return data[rng.choice(len(data), max_points, replace=False)]
+
+
+def plot_discrimination(res0, res1, disc, max_points=DEFAULT_MAX_POINTS, path=None):
+    """Plots the measured and rotated blobs and the projected histograms.
+
+    Scatter plots use at most ``max_points`` shots per state, the histograms are the
+    ones computed by ``discriminate`` on all the shots.
+    """
+    res0, res1 = downsample(res0, max_points), downsample(res1, max_points)
+    rotation = np.exp(1j * disc["rotation_angle"])
+    res0_rot, res1_rot = res0 * rotation, res1 * rotation
+    figs = {}
+
+    for name, (r0, r1) in {
+        "measured": (res0, res1),
+        "rotated": (res0_rot, res1_rot),
+    }.items():
+        fig, ax = plt.subplots(1, 1)
+        ax.scatter(r0.real, r0.imag, c="b", alpha=0.1, label="ground")
+        ax.scatter(r1.real, r1.imag, c="r", alpha=0.1, label="excited")
+        for r, color in [(r0, "b"), (r1, "r")]:
+            ax.plot(
+                np.real(np.mean(r)),
+                np.imag(np.mean(r)),
+                "X",
+                markerfacecolor=color,
+                markersize=15,
+                markeredgewidth=2,
+                markeredgecolor="gold",
+            )
+        if name == "rotated":
+            ax.axvline(disc["threshold"], color="black")
+        ax.legend()
+        ax.set_title(name)
+        figs[name] = fig
+
+    fig, ax = plt.subplots(1, 1)
+    ax.set_title("projection of rotated I-quadrature")
+    edges = disc["histograms"]["edges"]
+    bin_width = edges[1] - edges[0]
+    x = np.linspace(edges[0], edges[-1], 1000)
+    for counts, mu, sigma, color in zip(
+        disc["histograms"]["counts"], disc["mu"], disc["sigma"], ["b", "r"]
+    ):
+        ax.stairs(counts, edges, fill=True, color=color, alpha=0.5)
+        area = np.sum(counts) * bin_width
+        gauss = np.exp(-((x - mu) ** 2) / (2 * sigma**2)) / (sigma * np.sqrt(2 * np.pi))
+        ax.plot(x, gauss * area, c=color)
+    ax.axvline(disc["threshold"], color="black", linestyle="--")
+    figs["histogram"] = fig
+
+    if path is not None:
+        figs["measured"].savefig(path + "/blob_plot_measured.png")
+        figs["rotated"].savefig(path + "/blob_plot_rotated.png")
+        figs["histogram"].savefig(path + "/blob_plot_histogram.png")
+
+    return figs
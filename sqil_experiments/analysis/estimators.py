@@ -0,0 +1,180 @@
+"""Closed-form initial estimators for decay and oscillation fits.
+
+The nonlinear fits of sqil_core start from heuristic guesses (FFT peaks, Hilbert
+envelope, multiple phase trials). The estimators below recover decay rates,
+frequencies, phases and amplitudes with linear algebra only, and return guesses in
+the parameter order of the corresponding sqil_core fit functions:
+
+- ``estimate_decaying_exp`` -> ``fit_decaying_exp``, uses the integral equation
+  of the exponential, so it works directly on log-spaced or irregular delays.
+- ``estimate_decaying_oscillations`` -> ``fit_decaying_oscillations``
+- ``estimate_many_decaying_oscillations`` -> ``fit_many_decaying_oscillations``
+
+The oscillation estimators use the matrix pencil method (a noise-robust Prony
+method) on a uniform grid; irregular traces are first interpolated on one. Values
+that cannot be estimated are returned as None, so that ``fill_gaps`` in the fit
+functions falls back to the default guess.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+
+# Pencil parameter as a fraction of the number of points, N/3 is close to optimal
+PENCIL_FRACTION = 1 / 3
+
+
+def _is_uniform(x, rtol=1e-3) -> bool:
+    dx = np.diff(x)
+    return len(dx) > 0 and np.all(np.abs(dx - dx[0]) <= rtol * np.abs(dx[0]))
+
+
+def _uniform_trace(x, y):
+    """Returns the trace sorted and, if needed, interpolated on a uniform grid."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    order = np.argsort(x)
+    x, y = x[order], y[order]
+    if _is_uniform(x):
+        return x, y
+    x_uniform = np.linspace(x[0], x[-1], len(x))
+    return x_uniform, np.interp(x_uniform, x, y)
+
+
+def matrix_pencil(x, y, n_modes: int) -> np.ndarray:
+    """Estimates the complex exponents s_k of y(x) = sum_k c_k exp(s_k x).
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Trace to analyze. If x is not uniformly spaced the trace is interpolated on a
+        uniform grid.
+    n_modes : int
+        Number of exponential modes. A constant offset counts as one mode and a
+        real oscillation as two (complex conjugate pair).
+
+    Returns
+    -------
+    np.ndarray
+        The complex exponents s_k, in units of 1/x. The decay rate of each mode is
+        -Re(s_k), its angular frequency Im(s_k).
+    """
+    x, y = _uniform_trace(x, y)
+    n = len(y)
+    dx = x[1] - x[0]
+    pencil = max(n_modes, int(n * PENCIL_FRACTION))
+    if n - pencil < n_modes:
+        raise ValueError(f"At least {2 * n_modes + 1} points are needed.")
+
+    # Hankel matrix of the data, filtered to the n_modes dominant singular vectors
+    idx = np.arange(n - pencil)[:, None] + np.arange(pencil + 1)[None, :]
+    hankel = y[idx]
+    _, _, vh = np.linalg.svd(hankel, full_matrices=False)
+    v = vh[:n_modes].conj().T
+    v1, v2 = v[:-1], v[1:]
+    z = np.linalg.eigvals(np.linalg.pinv(v1) @ v2)
+    return np.log(z.astype(complex)) / dx
+
+
+def _oscillating_modes(s, n):
+    """Selects the n oscillating modes (positive frequency) with the slowest decay
+    among the poles returned by matrix_pencil."""
+    osc = s[s.imag > 0]
+    if len(osc) < n:
+        return None
+    return osc[np.argsort(-osc.real)][:n]
+
+
+def _damped_basis(x, s):
+    """Columns exp(-g x) cos(w x), exp(-g x) sin(w x) for every mode, plus 1."""
+    cols = []
+    for mode in s:
+        envelope = np.exp(mode.real * x)
+        cols += [envelope * np.cos(mode.imag * x), envelope * np.sin(mode.imag * x)]
+    cols.append(np.ones_like(x))
+    return np.column_stack(cols)
+
+
+def estimate_decaying_exp(x, y) -> list:
+    """Guess [A, tau, y0] for ``fit_decaying_exp``.
+
+    Uses the integral form of y = A exp(-x/tau) + y0:
+        y(x) - y(x_0) = -1/tau * int_{x_0}^{x} y dx' + y0/tau * (x - x_0)
+    which is linear in (-1/tau, y0/tau) and needs no uniform grid.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    order = np.argsort(x)
+    x, y = x[order], y[order]
+    try:
+        integral = np.concatenate([[0], np.cumsum(np.diff(x) * (y[1:] + y[:-1]) / 2)])
+        design = np.column_stack([integral, x - x[0]])
+        (c1, _), *_ = np.linalg.lstsq(design, y - y[0], rcond=None)
+        tau = -1 / c1
+        if not np.isfinite(tau) or tau <= 0:
+            return [None, None, None]
+        # Amplitude and offset from a linear fit with the estimated tau
+        design = np.column_stack([np.exp(-x / tau), np.ones_like(x)])
+        (A, y0), *_ = np.linalg.lstsq(design, y, rcond=None)
+    except (np.linalg.LinAlgError, ValueError):
+        return [None, None, None]
+    return [A, tau, y0]
+
+
+def _estimate_oscillation_params(x, y, n):
+    """Returns the modes and the real amplitudes (a, b) of
+    y = sum exp(-g x) (a cos(w x) + b sin(w x)) + y0, or None."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    try:
+        s = _oscillating_modes(matrix_pencil(x, y, 2 * n + 1), n)
+        if s is None:
+            return None
+        coeffs, *_ = np.linalg.lstsq(_damped_basis(x, s), y, rcond=None)
+    except (np.linalg.LinAlgError, ValueError):
+        return None
+    return s, coeffs[:-1].reshape(n, 2), coeffs[-1]
+
+
+def _tau_from_mode(mode, x):
+    # Modes that don't decay (or grow, because of noise) get a long decay time
+    span = np.ptp(x)
+    return -1 / mode.real if mode.real < -1 / (100 * span) else 100 * span
+
+
+def estimate_decaying_oscillations(x, y, num_init: int | None = None) -> list:
+    """Guess [A, tau, y0, phi, T] for ``fit_decaying_oscillations``, whose model is
+    A exp(-x/tau) cos(2 pi (x - phi) / T) + y0.
+
+    With num_init, phi is a list of num_init phases spread over one period, starting
+    from the estimate, so that the fit keeps its multi-start over the phase.
+    """
+    res = _estimate_oscillation_params(x, y, 1)
+    if res is None:
+        return [None] * 5
+    (mode,), ((a, b),), y0 = res
+    omega = mode.imag
+    A = np.hypot(a, b)
+    T = 2 * np.pi / omega
+    # a cos(wx) + b sin(wx) = A cos(w x - theta) = A cos(w (x - phi))
+    phi = np.mod(np.arctan2(b, a) / omega, T)
+    if num_init:
+        phi = list(np.mod(phi + np.arange(num_init) * T / num_init, T))
+    return [A, _tau_from_mode(mode, x), y0, phi, T]
+
+
+def estimate_many_decaying_oscillations(x, y, n: int) -> list:
+    """Guess [A_i, tau_i, phi_i, T_i]*n + [y0] for ``fit_many_decaying_oscillations``,
+    whose components are A_i exp(-x/tau_i) cos(2 pi T_i x + phi_i), T_i being a
+    frequency."""
+    res = _estimate_oscillation_params(x, y, n)
+    if res is None:
+        return [None] * (4 * n + 1)
+    modes, amplitudes, y0 = res
+    guess = []
+    for mode, (a, b) in zip(modes, amplitudes):
+        # a cos(wx) + b sin(wx) = A cos(w x + phi)
+        guess += [
+            np.hypot(a, b),
+            _tau_from_mode(mode, x),
+            -np.arctan2(b, a),
+            mode.imag / (2 * np.pi),
+        ]
+    return guess + [y0]
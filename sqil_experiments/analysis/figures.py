@@ -0,0 +1,78 @@
+"""Lazily rendered figures for headless analysis.
+
+Analysis functions accept ``headless=True`` to replace their matplotlib figures with
+``LazyFigure`` recipes. A recipe keeps the plotting closure (and the data it
+captures) and draws the figure only when it's displayed or accessed.
+
+``AnalysisResult.save_all`` needs matplotlib figures, save results that may hold
+lazy figures with ``save_analysis``, which draws them first. ``ExperimentHandler.run``
+saves the figures of every run, so the analyses it calls are not headless.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
+    from sqil_core.experiment import AnalysisResult
+
+
+class LazyFigure:
+    """Recipe for a matplotlib figure, drawn on first use.
+
+    Any attribute that is not defined here (``savefig``, ``axes``, ``text``, ...)
+    is forwarded to the rendered figure. A LazyFigure is not a matplotlib Figure,
+    use ``render`` or ``render_figures`` where a Figure is required.
+    """
+
+    def __init__(self, render: Callable[[], Figure]):
+        self._render = render
+        self._fig = None
+
+    def render(self) -> Figure:
+        if self._fig is None:
+            self._fig = self._render()
+        return self._fig
+
+    @property
+    def is_rendered(self) -> bool:
+        return self._fig is not None
+
+    def __getattr__(self, name):
+        # Avoid rendering for protocol lookups (copy, pickle, ...)
+        if name.startswith("__") or name in ("_render", "_fig"):
+            raise AttributeError(name)
+        return getattr(self.render(), name)
+
+    def _repr_png_(self):
+        from io import BytesIO
+
+        buffer = BytesIO()
+        self.render().savefig(buffer, format="png", bbox_inches="tight")
+        return buffer.getvalue()
+
+    def __repr__(self):
+        state = "rendered" if self.is_rendered else "not rendered"
+        return f"LazyFigure({state})"
+
+
+def make_figure(render: Callable[[], Figure], headless: bool = False):
+    """Returns the figure drawn by ``render``, or a LazyFigure if headless."""
+    if headless:
+        return LazyFigure(render)
+    return render()
+
+
+def render_figures(anal_res: AnalysisResult) -> AnalysisResult:
+    """Draws all the lazy figures of an analysis result in place."""
+    for key, fig in anal_res.figures.items():
+        if isinstance(fig, LazyFigure):
+            anal_res.figures[key] = fig.render()
+    return anal_res
+
+
+def save_analysis(anal_res: AnalysisResult, path: str):
+    """Draws the lazy figures of an analysis result and saves it in path."""
+    render_figures(anal_res).save_all(path)
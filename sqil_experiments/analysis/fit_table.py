@@ -0,0 +1,165 @@
+"""Columnar storage for the fits of the rows of a 2D sweep.
+
+Keeping a FitResult per row means keeping the raw optimizer output (covariance
+matrices, jacobians, ...) and a closure for every trace. A FitTable keeps only the
+parameters, their standard errors, the fit metrics and the model name of each row,
+in a numpy structured array. The FitResult of a row is rebuilt on request, without
+the raw optimizer output.
+
+A FitTable can be stored in ``AnalysisResult.fits`` like a FitResult: it has a
+``model_name`` and a ``summary`` used by ``save_fits``.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from sqil_core.fit import FitResult
+
+
+def _model_function(model_name):
+    """Returns the sqil_core model with the given name, if any."""
+    try:
+        from sqil_core.fit import _models
+    except ImportError:
+        return None
+    return getattr(_models, model_name or "", None)
+
+
+class FitTable:
+    """Fit results of the rows of a sweep, one record per row.
+
+    The table is allocated by the first call to ``set_row``, which defines the
+    parameter names and metrics. Rows that are never set (e.g. failed fits) are
+    NaN and have ``success`` False. The model of each row is stored as an index in
+    ``model_names``.
+
+    Example
+    -------
+    >>> table = FitTable(len(y_data))
+    >>> for i in range(len(y_data)):
+    ...     table.set_row(i, fit.fit_decaying_exp(x_data[i], y_data[i]))
+    >>> taus = table.param("tau")
+    >>> fit_res = table[3]
+    """
+
+    def __init__(self, n_rows: int):
+        self.n_rows = n_rows
+        self.param_names: list = []
+        self.metric_names: list = []
+        self.model_names: list = []
+        self.data: np.ndarray | None = None
+
+    def _allocate(self, fit_res: FitResult):
+        self.param_names = list(fit_res.param_names)
+        self.metric_names = list(fit_res.metrics.keys())
+        n_params = len(self.param_names)
+        dtype = [
+            ("success", bool),
+            ("model", np.int16),
+            ("params", float, (n_params,)),
+            ("std_err", float, (n_params,)),
+        ] + [(name, float) for name in self.metric_names]
+        self.data = np.zeros(self.n_rows, dtype=dtype)
+        self.data["params"] = np.nan
+        self.data["std_err"] = np.nan
+        for name in self.metric_names:
+            self.data[name] = np.nan
+
+    def set_row(self, i: int, fit_res: FitResult | None):
+        """Stores the fit of row i. None marks the row as failed."""
+        if fit_res is None:
+            if self.data is not None:
+                self.data["success"][i] = False
+            return
+        if self.data is None:
+            self._allocate(fit_res)
+        row = self.data[i]
+        row["success"] = True
+        model_name = fit_res.model_name or ""
+        if model_name not in self.model_names:
+            self.model_names.append(model_name)
+        row["model"] = self.model_names.index(model_name)
+        row["params"] = fit_res.params
+        if fit_res.std_err is not None:
+            row["std_err"] = fit_res.std_err
+        for name in self.metric_names:
+            row[name] = fit_res.metrics.get(name, np.nan)
+
+    def param(self, name: str) -> np.ndarray:
+        """Fitted values of a parameter for all the rows, NaN for failed fits."""
+        if self.data is None:
+            return np.full(self.n_rows, np.nan)
+        return self.data["params"][:, self.param_names.index(name)]
+
+    def param_std(self, name: str) -> np.ndarray:
+        if self.data is None:
+            return np.full(self.n_rows, np.nan)
+        return self.data["std_err"][:, self.param_names.index(name)]
+
+    @property
+    def success(self) -> np.ndarray:
+        if self.data is None:
+            return np.zeros(self.n_rows, dtype=bool)
+        return self.data["success"]
+
+    @property
+    def model_name(self) -> str | None:
+        if self.data is None:
+            return None
+        models = np.unique(self.data["model"][self.success])
+        if len(models) != 1:
+            return None
+        return self.model_names[models[0]] or None
+
+    def get_fit(self, i: int) -> FitResult | None:
+        """Rebuilds the FitResult of row i, or None if the fit failed."""
+        if not self.success[i]:
+            return None
+        row = self.data[i]
+        params = row["params"].tolist()
+        model_name = self.model_names[row["model"]] or None
+        model = _model_function(model_name)
+        predict = (lambda x: model(x, *params)) if model is not None else None
+        return FitResult(
+            params,
+            row["std_err"].copy(),
+            None,
+            metrics={name: row[name] for name in self.metric_names},
+            predict=predict,
+            param_names=self.param_names,
+            model_name=model_name,
+        )
+
+    def __getitem__(self, i: int) -> FitResult | None:
+        return self.get_fit(i)
+
+    def __len__(self):
+        return self.n_rows
+
+    def summary(self, no_print=False) -> str:
+        """One line per row with the fitted parameters and the metrics."""
+        header = ["row"] + [f"{name} ± err" for name in self.param_names]
+        header += self.metric_names
+        lines = ["| " + " | ".join(header) + " |", "|---" * len(header) + "|"]
+        for i in range(self.n_rows):
+            if not self.success[i]:
+                lines.append(f"| {i} | failed |")
+                continue
+            row = self.data[i]
+            cells = [str(i)]
+            cells += [
+                f"{p:.4g} ± {e:.2g}" for p, e in zip(row["params"], row["std_err"])
+            ]
+            cells += [f"{row[name]:.3g}" for name in self.metric_names]
+            lines.append("| " + " | ".join(cells) + " |")
+        s = "\n".join(lines)
+        if not no_print:
+            print(s)
+        return s
+
+    def __repr__(self):
+        n_ok = int(np.count_nonzero(self.success))
+        return (
+            f"FitTable({self.n_rows} rows, {n_ok} successful, "
+            f"model={self.model_name}, params={self.param_names})"
+        )
@@ -0,0 +1,201 @@
+"""Online analysis of outer-swept runs.
+
+``ExperimentHandler.run`` appends one row to ``data.ddh5`` for every value of the
+outer ``sweeps``. OnlineAnalysis listens to the handler events, fits every new row
+as soon as it's written and keeps running statistics of the fitted parameter, so a
+bad run can be spotted (and aborted) long before the whole sweep is acquired.
+"""
+
+from __future__ import annotations
+
+import glob
+import json
+import os
+from collections.abc import Callable
+
+import numpy as np
+from sqil_core import fit
+from sqil_core.experiment import ExperimentHandler
+from sqil_core.experiment._events import (
+    after_experiment,
+    before_experiment,
+    before_sequence,
+)
+from sqil_core.utils import get_data_and_info, mask_outliers
+
+from sqil_experiments.analysis.estimators import estimate_decaying_exp
+
+SUMMARY_FILENAME = "online_summary.json"
+
+
+def find_run_folder(handler: ExperimentHandler) -> str | None:
+    """Returns the folder of the run that the handler is currently acquiring."""
+    db_path_local = handler.setup["storage"]["db_path_local"]
+    settings_path = os.path.join(db_path_local, "utils", "setting.json")
+    if not os.path.isfile(settings_path):
+        return None
+    with open(settings_path) as f:
+        run_num = json.load(f).get("run_num")
+    if run_num is None:
+        return None
+    pattern = os.path.join(
+        db_path_local, "*", f"{str(run_num).zfill(5)}-{handler.exp_name}_*"
+    )
+    folders = sorted(glob.glob(pattern), key=os.path.getmtime)
+    return folders[-1] if folders else None
+
+
+class OnlineAbort(Exception):
+    """Raised from the acquisition loop when the abort condition is met."""
+
+
+def fit_decay_row(x, y) -> dict:
+    """Fits a single trace with a decaying exponential, as done by analyze_T1 and
+    analyze_T2_echo for swept data."""
+    proj = fit.transform_data(y, inv_transform=False)
+    fit_res = fit.fit_decaying_exp(x, proj, guess=estimate_decaying_exp(x, proj))
+    return {
+        "tau": fit_res.params_by_name["tau"],
+        "tau_std": fit_res.std_err[1] if fit_res.std_err is not None else np.nan,
+    }
+
+
+def running_stats(values, positive=True, threshold=3.5) -> dict:
+    """Mean and std of the values after removing failed fits and outliers."""
+    values = np.asarray(values, dtype=float)
+    valid = np.where(values > 0, values, np.nan) if positive else values
+    masked = mask_outliers(valid, threshold) if np.any(~np.isnan(valid)) else valid
+    n_valid = int(np.sum(~np.isnan(masked)))
+    return {
+        "n_rows": len(values),
+        "n_valid": n_valid,
+        "n_outliers": int(np.sum(~np.isnan(valid))) - n_valid,
+        "mean": float(np.nanmean(masked)) if n_valid else np.nan,
+        "std": float(np.nanstd(masked)) if n_valid else np.nan,
+    }
+
+
+class OnlineAnalysis:
+    """Fits the rows of an outer-swept run while it's being acquired.
+
+    Rows are read back from the run's ``data.ddh5`` before every new sequence and at
+    the end of the experiment. Each row is passed to ``row_analysis(x, y)``, which
+    returns a dictionary of scalars; running statistics are computed for ``key``
+    and written to ``online_summary.json`` in the run folder.
+
+    If ``abort_if(summary)`` returns True the acquisition is stopped by raising
+    OnlineAbort. The rows acquired so far are kept on disk and the data folder is
+    tagged as interrupted.
+
+    Example
+    -------
+    >>> t1 = T1()
+    >>> online = OnlineAnalysis(
+    ...     t1,
+    ...     key="tau",
+    ...     abort_if=lambda s: s["n_rows"] >= 5 and s["n_valid"] < s["n_rows"] / 2,
+    ... )
+    >>> with online:
+    ...     t1.run([time], sweeps={"current": currents})
+    >>> online.summary
+    """
+
+    def __init__(
+        self,
+        handler: ExperimentHandler,
+        row_analysis: Callable[[np.ndarray, np.ndarray], dict] = fit_decay_row,
+        key: str = "tau",
+        qu_id: str = "q0",
+        abort_if: Callable[[dict], bool] | None = None,
+        verbose: bool = True,
+    ):
+        self.handler = handler
+        self.row_analysis = row_analysis
+        self.key = key
+        self.qu_id = qu_id
+        self.abort_if = abort_if
+        self.verbose = verbose
+
+        self.path = None
+        self.rows: list[dict] = []
+        self.summary: dict = {}
+
+    def __enter__(self):
+        self.reset()
+        before_experiment.connect(self._on_before_experiment, sender=self.handler)
+        before_sequence.connect(self._on_before_sequence, sender=self.handler)
+        after_experiment.connect(self._on_after_experiment)
+        return self
+
+    def __exit__(self, *exc):
+        before_experiment.disconnect(self._on_before_experiment, sender=self.handler)
+        before_sequence.disconnect(self._on_before_sequence, sender=self.handler)
+        after_experiment.disconnect(self._on_after_experiment)
+        return False
+
+    def reset(self):
+        self.path = None
+        self.rows = []
+        self.summary = {}
+
+    def _on_before_experiment(self, sender, **kwargs):
+        # A new run was started with the same handler
+        self.reset()
+
+    def _on_before_sequence(self, sender, **kwargs):
+        self.update()
+        if self.abort_if is not None and self.rows and self.abort_if(self.summary):
+            raise OnlineAbort(
+                f"Online analysis aborted {self.handler.exp_name} after "
+                f"{len(self.rows)} rows: {self.summary}"
+            )
+
+    def _on_after_experiment(self, *args, **kwargs):
+        self.update()
+
+    def find_run_folder(self) -> str | None:
+        """Returns the folder of the run that is currently being acquired."""
+        return find_run_folder(self.handler)
+
+    def update(self):
+        """Analyzes the rows that were written since the last update."""
+        if self.path is None:
+            self.path = self.find_run_folder()
+        if self.path is None or not os.path.isfile(
+            os.path.join(self.path, "data.ddh5")
+        ):
+            return
+
+        qu_data, *_ = get_data_and_info(path=self.path)
+        if isinstance(qu_data, dict):
+            qu_data = qu_data[self.qu_id]
+        x_data, y_data, sweeps = qu_data
+        x_data, y_data = np.atleast_2d(x_data), np.atleast_2d(y_data)
+        if len(x_data) == 1 and len(y_data) > 1:
+            x_data = np.repeat(x_data, len(y_data), axis=0)
+
+        for i in range(len(self.rows), len(y_data)):
+            row = {"index": i}
+            if sweeps:
+                row["sweep"] = float(np.ravel(sweeps[0])[i])
+            try:
+                row.update(self.row_analysis(x_data[i], y_data[i]))
+            except Exception as e:
+                print(f"Error analyzing trace {i}", e)
+            self.rows.append(row)
+            self._update_summary()
+            if self.verbose:
+                value = row.get(self.key, np.nan)
+                print(
+                    f"[online] row {i}: {self.key} = {value:.4g} | "
+                    f"mean = {self.summary['mean']:.4g}, "
+                    f"std = {self.summary['std']:.4g} "
+                    f"({self.summary['n_valid']}/{self.summary['n_rows']} valid)"
+                )
+
+    def _update_summary(self):
+        values = [row.get(self.key, np.nan) for row in self.rows]
+        self.summary = {"key": self.key, **running_stats(values)}
+        content = {"summary": self.summary, "rows": self.rows}
+        with open(os.path.join(self.path, SUMMARY_FILENAME), "w") as f:
+            json.dump(content, f, indent=4, default=float)
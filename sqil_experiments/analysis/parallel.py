@@ -0,0 +1,202 @@
+"""Per-qubit parallel analysis.
+
+``multi_qubit_handler`` analyzes the qubits of a multi-qubit run one after the other.
+Analyses decorated with ``parallel_qubits`` accept ``parallel_qubits=True`` to run
+the single-qubit analysis of every qubit in a worker process instead, and merge the
+per-qubit results into a single AnalysisResult.
+
+Workers send back a picklable payload: fits are stripped of the raw optimizer output
+(see ``portable_fit``) and the figures already drawn are pickled. In the main process
+figures are unpickled right away, or on first use (``LazyFigure``) when
+``headless=True``. With ``headless=True`` the workers draw no figures: they are
+drawn on first use in the main process, from the analysis of the qubit run again
+there on its data.
+"""
+
+from __future__ import annotations
+
+import importlib
+import os
+import pickle
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial, wraps
+
+from sqil_core.experiment import AnalysisResult
+from sqil_core.utils import extract_h5_data, is_multi_qubit_datadict
+
+from sqil_experiments.analysis.cache import portable_fit
+from sqil_experiments.analysis.figures import LazyFigure
+
+_executor: ProcessPoolExecutor | None = None
+_executor_workers: int | None = None
+
+
+def _init_worker():
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+def get_executor(max_workers: int | None = None) -> ProcessPoolExecutor:
+    """Returns the shared worker pool, started on first use and kept alive between
+    analyses to avoid paying the import time of the workers at every run."""
+    global _executor, _executor_workers
+    max_workers = max_workers or os.cpu_count()
+    if _executor is None or _executor_workers != max_workers:
+        shutdown_executor()
+        _executor = ProcessPoolExecutor(max_workers, initializer=_init_worker)
+        _executor_workers = max_workers
+    return _executor
+
+
+def shutdown_executor():
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+    _executor, _executor_workers = None, None
+
+
+def to_payload(anal_res: AnalysisResult) -> dict:
+    """Converts an AnalysisResult into a picklable dictionary. Figures that are
+    drawn are pickled, then closed. Lazy figures that are not drawn yet are only
+    listed by key in ``lazy_figures``."""
+    import matplotlib.pyplot as plt
+
+    figures, lazy_figures = {}, []
+    for key, fig in anal_res.figures.items():
+        if isinstance(fig, LazyFigure):
+            if not fig.is_rendered:
+                lazy_figures.append(key)
+                continue
+            fig = fig.render()
+        figures[key] = pickle.dumps(fig)
+        plt.close(fig)
+    return {
+        "data_path": anal_res.data_path,
+        "output": anal_res.output,
+        "updated_params": anal_res.updated_params,
+        "figures": figures,
+        "lazy_figures": lazy_figures,
+        "fits": {k: portable_fit(v) for k, v in anal_res.fits.items()},
+        "extra_data": anal_res.extra_data,
+    }
+
+
+def from_payload(
+    payload: dict, headless: bool = False, redraw: Callable | None = None
+) -> AnalysisResult:
+    """Rebuilds the AnalysisResult sent by a worker. The figures listed in
+    ``lazy_figures`` are drawn by ``redraw(key)``, or dropped without it."""
+    payload = dict(payload)
+    figures = {}
+    for key, data in payload.pop("figures").items():
+        load = partial(pickle.loads, data)
+        figures[key] = LazyFigure(load) if headless else load()
+    for key in payload.pop("lazy_figures", []):
+        if redraw is not None:
+            draw = partial(redraw, key)
+            figures[key] = LazyFigure(draw) if headless else draw()
+    return AnalysisResult(**{**payload, "figures": figures})
+
+
+class _Redraw:
+    """Draws the figures of a qubit analyzed by a worker, from the analysis run
+    again in the main process. The analysis runs once, for the first figure."""
+
+    def __init__(self, analysis_func: Callable, kwargs: dict):
+        self.analysis_func = analysis_func
+        self.kwargs = kwargs
+        self._anal_res = None
+
+    def __call__(self, key):
+        if self._anal_res is None:
+            self._anal_res = self.analysis_func(**self.kwargs)
+        fig = self._anal_res.figures[key]
+        return fig.render() if isinstance(fig, LazyFigure) else fig
+
+
+def _analyze_qubit(func_name: str, kwargs: dict) -> dict:
+    module_name, qualname = func_name.rsplit(".", 1)
+    analysis_func = getattr(importlib.import_module(module_name), qualname)
+    return to_payload(analysis_func(**kwargs))
+
+
+def split_qubits(datadict: dict) -> dict:
+    """Splits a multi-qubit datadict into single-qubit datadicts."""
+    schema = datadict.get("metadata", {}).get("schema")
+    return {
+        qu_id: {**qu_data, "metadata": {"schema": schema}}
+        for qu_id, qu_data in datadict.items()
+        if qu_id != "metadata"
+    }
+
+
+def parallel_qubits(analysis_func):
+    """Adds the ``parallel_qubits`` and ``max_workers`` options to an analysis
+    decorated with ``multi_qubit_handler``.
+
+    The decorated function must be defined at module level. Apply it above
+    ``multi_qubit_handler``.
+
+    Example
+    -------
+    >>> @cached_analysis(version=1)
+    ... @parallel_qubits
+    ... @multi_qubit_handler
+    ... def analyze_T1(datadict, qpu=None, qu_id="q0", **kwargs): ...
+    >>> anal_res = analyze_T1(path=path, parallel_qubits=True)
+    """
+    func_name = f"{analysis_func.__module__}.{analysis_func.__qualname__}"
+
+    @wraps(analysis_func)
+    def wrapper(
+        *args,
+        path=None,
+        datadict=None,
+        qu_id=None,
+        parallel_qubits=False,
+        max_workers=None,
+        **kwargs,
+    ):
+        if not parallel_qubits or qu_id is not None or args:
+            return analysis_func(
+                *args, path=path, datadict=datadict, qu_id=qu_id, **kwargs
+            )
+
+        full_datadict = datadict
+        if full_datadict is None and path is not None:
+            full_datadict = extract_h5_data(path, get_metadata=True)
+        if full_datadict is None or not is_multi_qubit_datadict(full_datadict):
+            return analysis_func(path=path, datadict=full_datadict, **kwargs)
+
+        qubits = split_qubits(full_datadict)
+        if len(qubits) == 1:
+            return analysis_func(path=path, datadict=full_datadict, **kwargs)
+
+        # Workers read the qpu from path when it's not given
+        kwargs.pop("anal_res_tot", None)
+        executor = get_executor(max_workers)
+        qu_kwargs = {
+            qid: {**kwargs, "path": path, "datadict": qu_datadict, "qu_id": qid}
+            for qid, qu_datadict in qubits.items()
+        }
+        futures = {
+            qid: executor.submit(_analyze_qubit, func_name, qu_kwargs[qid])
+            for qid in qubits
+        }
+
+        anal_res = AnalysisResult(data_path=path)
+        headless = kwargs.get("headless", False)
+        try:
+            for qid, future in futures.items():
+                redraw = _Redraw(analysis_func, qu_kwargs[qid])
+                payload = future.result()
+                anal_res.update(from_payload(payload, headless, redraw))
+        except BrokenProcessPool:
+            shutdown_executor()
+            raise
+        return anal_res
+
+    return wrapper
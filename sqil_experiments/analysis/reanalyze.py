@@ -0,0 +1,290 @@
+"""Batch re-analysis of the runs stored in a cooldown folder.
+
+Runs are discovered from their folder name, ``<date>/<run_num>-<exp_name>_<time>``,
+and analyzed with the ``analyze`` method of the handler that has the same
+``exp_name``. Runs are distributed over a pool of worker processes. Every finished
+run is appended to a progress file, so that an interrupted re-analysis can be
+resumed, and the updated parameters of all the runs are written to a CSV table.
+
+Usage
+-----
+    python -m sqil_experiments.analysis.reanalyze <cooldown_path> -e T1 -e ramsey
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import importlib
+import json
+import os
+import re
+import time
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from sqil_experiments.analysis.figures import save_analysis
+from sqil_experiments.analysis.parallel import get_executor
+
+# Modules searched for experiment handlers
+HANDLER_MODULES = [
+    "sqil_experiments.measurements.T1",
+    "sqil_experiments.measurements.T1_adaptive",
+    "sqil_experiments.measurements.T2_echo",
+    "sqil_experiments.measurements.T2_echo_adaptive",
+    "sqil_experiments.measurements.cw_qu_spec",
+    "sqil_experiments.measurements.cw_rr_spec",
+    "sqil_experiments.measurements.dispersive_shift",
+    "sqil_experiments.measurements.interleaved_T1_echo",
+    "sqil_experiments.measurements.iq_blobs",
+    "sqil_experiments.measurements.qu_spec",
+    "sqil_experiments.measurements.qubit_temperature",
+    "sqil_experiments.measurements.qubit_temperature_adaptive",
+    "sqil_experiments.measurements.ramsey",
+    "sqil_experiments.measurements.rr_spec",
+    "sqil_experiments.measurements.time_rabi",
+]
+
+PROGRESS_FILENAME = "reanalysis_progress.jsonl"
+SUMMARY_FILENAME = "reanalysis_summary.csv"
+
+# <run_num>-<exp_name>_<YYYY-MM-DDTHHMMSS>, with an optional -<n> for duplicates
+RUN_FOLDER_PATTERN = re.compile(
+    r"^(?P<run_id>\d{5,})-(?P<name>.+)_(?P<time>\d{4}-\d{2}-\d{2}T\d{6})(-\d+)?$"
+)
+
+_handlers: dict | None = None
+
+
+def get_handlers() -> dict:
+    """Maps exp_name to handler class, for all the handlers that can be imported."""
+    global _handlers
+    if _handlers is not None:
+        return _handlers
+    from sqil_core.experiment import ExperimentHandler
+
+    _handlers = {}
+    for module_name in HANDLER_MODULES:
+        try:
+            module = importlib.import_module(module_name)
+        except Exception as e:
+            print(f"Skipping {module_name}: {e}")
+            continue
+        for obj in vars(module).values():
+            if (
+                isinstance(obj, type)
+                and issubclass(obj, ExperimentHandler)
+                and obj.__module__ == module_name
+                and "exp_name" in vars(obj)
+            ):
+                _handlers[obj.exp_name] = obj
+    return _handlers
+
+
+def discover_runs(cooldown_path: str, exp_names: list[str] | None = None) -> list:
+    """Returns the runs stored in a cooldown folder, sorted by run number.
+
+    The exp_name of a run is the handler name, without the ``_vs_<sweep>`` suffix
+    added for swept runs.
+    """
+    runs = []
+    for data_file in Path(cooldown_path).glob("*/*/data.ddh5"):
+        run_path = data_file.parent
+        match = RUN_FOLDER_PATTERN.match(run_path.name)
+        if match is None:
+            continue
+        exp_name = match["name"].split("_vs_")[0]
+        if exp_names and exp_name not in exp_names:
+            continue
+        runs.append(
+            {
+                "path": str(run_path),
+                "run_id": match["run_id"],
+                "exp_name": exp_name,
+                "sweeps": match["name"].split("_vs_")[1:],
+            }
+        )
+    return sorted(runs, key=lambda run: (run["run_id"], run["path"]))
+
+
+def _to_builtin(value):
+    if isinstance(value, dict):
+        return {k: _to_builtin(v) for k, v in value.items()}
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    return value
+
+
+def reanalyze_run(run: dict, save: bool = True, use_cache: bool = False) -> dict:
+    """Analyzes a single run and returns its progress record."""
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    record = {**run, "status": "ok", "error": None, "params": {}}
+    try:
+        handler_cls = get_handlers().get(run["exp_name"])
+        if handler_cls is None:
+            raise KeyError(f"No handler with exp_name '{run['exp_name']}'")
+        # analyze doesn't use the instruments, skip __init__ to avoid connecting
+        handler = handler_cls.__new__(handler_cls)
+        anal_res = handler.analyze(run["path"], headless=True, use_cache=use_cache)
+        if save:
+            save_analysis(anal_res, run["path"])
+        record["params"] = _to_builtin(anal_res.updated_params)
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        plt.close("all")
+    record["elapsed"] = time.perf_counter() - start
+    return record
+
+
+def read_progress(progress_path: str) -> dict:
+    """Returns the records of the runs already analyzed, keyed by path."""
+    records = {}
+    if not os.path.isfile(progress_path):
+        return records
+    with open(progress_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of an interrupted run
+                continue
+            records[record["path"]] = record
+    return records
+
+
+def write_summary(records: list, summary_path: str):
+    """Writes one row per run and qubit, with a column per updated parameter."""
+    param_names = sorted(
+        {
+            name
+            for record in records
+            for params in record["params"].values()
+            for name in params
+        }
+    )
+    columns = ["run_id", "exp_name", "qu_id", "status", "error", "path"]
+    with open(summary_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns + param_names)
+        writer.writeheader()
+        for record in sorted(records, key=lambda r: (r["run_id"], r["path"])):
+            base = {k: record[k] for k in columns if k in record}
+            if not record["params"]:
+                writer.writerow(base)
+            for qu_id, params in record["params"].items():
+                writer.writerow({**base, "qu_id": qu_id, **params})
+
+
+def reanalyze(
+    cooldown_path: str,
+    exp_names: list[str] | None = None,
+    max_workers: int | None = None,
+    output_dir: str | None = None,
+    save: bool = True,
+    use_cache: bool = False,
+    resume: bool = True,
+) -> list:
+    """Re-analyzes all the runs of a cooldown folder in parallel.
+
+    Parameters
+    ----------
+    cooldown_path : str
+        Folder containing the date folders of the runs.
+    exp_names : list[str], optional
+        Only re-analyze these experiments, by default all the known ones.
+    max_workers : int, optional
+        Number of worker processes, by default the number of CPUs.
+    output_dir : str, optional
+        Where the progress file and the summary table are written, by default
+        cooldown_path.
+    save : bool, optional
+        Save the analysis results (figures, fits, ...) in the run folders.
+    use_cache : bool, optional
+        Use the analysis cache, see ``cached_analysis``.
+    resume : bool, optional
+        Skip the runs that were successfully analyzed by a previous call.
+
+    Returns
+    -------
+    list
+        The records of all the runs, including the ones done by previous calls.
+    """
+    output_dir = output_dir or cooldown_path
+    os.makedirs(output_dir, exist_ok=True)
+    progress_path = os.path.join(output_dir, PROGRESS_FILENAME)
+
+    if not resume and os.path.isfile(progress_path):
+        os.remove(progress_path)
+    done = {
+        path: record
+        for path, record in read_progress(progress_path).items()
+        if record["status"] == "ok"
+    }
+    runs = [
+        run
+        for run in discover_runs(cooldown_path, exp_names)
+        if run["path"] not in done
+    ]
+    print(f"{len(runs)} runs to analyze, {len(done)} already done")
+
+    records = dict(done)
+    if runs:
+        executor = get_executor(max_workers)
+        futures = [executor.submit(reanalyze_run, run, save, use_cache) for run in runs]
+        with open(progress_path, "a") as progress_file:
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                record = future.result()
+                records[record["path"]] = record
+                progress_file.write(json.dumps(record) + "\n")
+                progress_file.flush()
+
+    records = list(records.values())
+    write_summary(records, os.path.join(output_dir, SUMMARY_FILENAME))
+    failed = [r for r in records if r["status"] != "ok"]
+    print(f"{len(records) - len(failed)} runs analyzed, {len(failed)} failed")
+    for record in failed:
+        print(f"  {record['run_id']} {record['exp_name']}: {record['error']}")
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Re-analyze all the runs stored in a cooldown folder."
+    )
+    parser.add_argument("cooldown_path")
+    parser.add_argument(
+        "-e",
+        "--exp-name",
+        action="append",
+        dest="exp_names",
+        help="Only re-analyze this experiment, can be repeated",
+    )
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("-o", "--output-dir", default=None)
+    parser.add_argument(
+        "--no-save", action="store_true", help="Don't save results in the run folders"
+    )
+    parser.add_argument("--use-cache", action="store_true")
+    parser.add_argument(
+        "--restart", action="store_true", help="Ignore the progress of previous calls"
+    )
+    args = parser.parse_args(argv)
+    reanalyze(
+        args.cooldown_path,
+        exp_names=args.exp_names,
+        max_workers=args.workers,
+        output_dir=args.output_dir,
+        save=not args.no_save,
+        use_cache=args.use_cache,
+        resume=not args.restart,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Display-resolution rendering of 2D sweeps.
+
+Colormaps of large sweeps (e.g. 300 x 2001 complex points) are decimated before
+plotting, so that no more than about one data point per screen pixel is drawn. The
+decimation is min/max-preserving: every bin of consecutive points is replaced by the
+two samples with the smallest and largest magnitude, so narrow features such as
+resonance dips survive. Only the plotted copy is decimated, fits keep using the
+full data.
+"""
+
+import numpy as np
+from sqil_core.utils import plot_mag_phase
+
+# (sweep points, x points) drawn at most in a single colormap
+DEFAULT_MAX_SHAPE = (400, 800)
+
+
+def minmax_indices(values: np.ndarray, bin_size: int) -> np.ndarray:
+    """Returns, for every row of a 2D array, the indices of the min and max of each
+    bin of bin_size consecutive columns, in the order in which they appear."""
+    n_rows, n_cols = values.shape
+    n_bins = int(np.ceil(n_cols / bin_size))
+    # Pad by repeating the last column, which doesn't change the extremes
+    padded = np.pad(values, ((0, 0), (0, n_bins * bin_size - n_cols)), mode="edge")
+    binned = padded.reshape(n_rows, n_bins, bin_size)
+    offsets = np.arange(n_bins) * bin_size
+    idx_min = np.argmin(binned, axis=-1) + offsets
+    idx_max = np.argmax(binned, axis=-1) + offsets
+    idx = np.stack([np.minimum(idx_min, idx_max), np.maximum(idx_min, idx_max)], -1)
+    return np.minimum(idx.reshape(n_rows, 2 * n_bins), n_cols - 1)
+
+
+def _half_bin_centers(coords: np.ndarray, bin_size: int) -> np.ndarray:
+    """Coordinates of the decimated points: the mean of each half bin along the
+    last axis."""
+    n = coords.shape[-1]
+    n_out = 2 * int(np.ceil(n / bin_size))
+    edges = np.minimum(np.round(np.arange(n_out + 1) * bin_size / 2).astype(int), n)
+    starts = np.minimum(edges[:-1], n - 1)
+    stops = np.maximum(edges[1:], starts + 1)
+    zeros = np.zeros((*coords.shape[:-1], 1))
+    cumsum = np.concatenate([zeros, np.cumsum(coords, axis=-1)], axis=-1)
+    return (cumsum[..., stops] - cumsum[..., starts]) / (stops - starts)
+
+
+def _decimate_last_axis(y_data, coords: dict, max_points):
+    """Min/max decimation of a 2D complex array along its last axis.
+
+    coords are coordinates along that axis, either 1D or with the shape of y_data
+    (e.g. a sweep stored for every point). They are replaced by the mean of each
+    half bin of the last axis.
+    """
+    n = y_data.shape[-1]
+    bin_size = int(np.ceil(2 * n / max_points))
+    if bin_size <= 2:
+        return y_data, coords, 1
+    idx = minmax_indices(np.abs(y_data), bin_size)
+    y_dec = np.take_along_axis(y_data, idx, axis=-1)
+    coords_dec = {
+        key: _half_bin_centers(np.asarray(values, dtype=float), bin_size)
+        for key, values in coords.items()
+    }
+    return y_dec, coords_dec, n / idx.shape[-1]
+
+
+def decimate_datadict(datadict: dict, max_shape=DEFAULT_MAX_SHAPE):
+    """Returns a copy of a single-qubit datadict whose 2D data fits max_shape, and
+    the decimation factors along the sweep and x axes.
+
+    The datadict is mapped using the roles in its schema ("data", "x-axis" and
+    "axis"), like sqil_core's get_data_and_info. The x-axis and the sweeps can be
+    1D or have the shape of the data, one row per outer sweep point.
+    """
+    schema = datadict["metadata"]["schema"]
+    roles = {
+        key: value.get("role") for key, value in schema.items() if type(value) is dict
+    }
+    y_key = next(k for k, r in roles.items() if r == "data")
+    x_key = next((k for k, r in roles.items() if r == "x-axis"), None)
+    sweep_keys = [k for k, r in roles.items() if r == "axis"]
+
+    y_data = np.asarray(datadict[y_key])
+    if y_data.ndim != 2 or not sweep_keys:
+        return datadict, (1, 1)
+
+    max_rows, max_cols = max_shape
+    new_datadict = dict(datadict)
+
+    # Coordinates with the shape of the data are decimated along both axes
+    x_data = np.asarray(datadict[x_key]) if x_key else np.arange(y_data.shape[1])
+    axes = {key: np.asarray(datadict[key]) for key in sweep_keys}
+    grids = {k: v for k, v in axes.items() if v.shape == y_data.shape}
+
+    # Decimate along x
+    y_data, coords, col_factor = _decimate_last_axis(
+        y_data, {"x": x_data, **grids}, max_cols
+    )
+    x_data = coords.pop("x")
+    grids = coords
+
+    # Decimate along the sweep, using the transposed data
+    sweep0 = sweep_keys[0]
+    coords = {k: v.T for k, v in grids.items()}
+    if x_data.ndim > 1:
+        coords["x"] = x_data.T
+    if sweep0 not in grids:
+        coords[sweep0] = axes[sweep0]
+    y_t, coords, row_factor = _decimate_last_axis(y_data.T, coords, max_rows)
+    y_data = y_t.T
+    if x_data.ndim > 1:
+        x_data = coords.pop("x").T
+    new_datadict.update({k: v.T if k in grids else v for k, v in coords.items()})
+    if row_factor != 1:
+        n_rows = y_data.shape[0]
+        for key in sweep_keys[1:]:
+            if key in grids:
+                continue
+            values = axes[key]
+            new_datadict[key] = values[
+                np.linspace(0, len(values) - 1, n_rows).round().astype(int)
+            ]
+
+    new_datadict[y_key] = y_data
+    if x_key:
+        new_datadict[x_key] = x_data
+    return new_datadict, (row_factor, col_factor)
+
+
+def plot_mag_phase_decimated(datadict, max_shape=DEFAULT_MAX_SHAPE, **kwargs):
+    """Same as plot_mag_phase, but large 2D sweeps are decimated to max_shape first.
+    When data is decimated, the decimation factor is written on the figure."""
+    plot_datadict, factors = decimate_datadict(datadict, max_shape)
+    fig, axs = plot_mag_phase(datadict=plot_datadict, **kwargs)
+    if factors != (1, 1):
+        fig.text(
+            0.99,
+            0.005,
+            f"Displayed decimated (min/max) by {factors[0]:.1f} x {factors[1]:.1f}",
+            ha="right",
+            va="bottom",
+            fontsize="small",
+            color="gray",
+        )
+    return fig, axs
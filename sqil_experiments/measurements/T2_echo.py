@@ -14,6 +14,14 @@ from laboneq_applications.experiments.options import TuneupExperimentOptions
 from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_handler
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.bootstrap import bootstrap_decaying_exp
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.estimators import estimate_decaying_exp
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.fit_table import FitTable
+from sqil_experiments.analysis.parallel import parallel_qubits
+from sqil_experiments.measurements.helpers.delay_planner import plan_decay_delays
+
 if TYPE_CHECKING:
     from laboneq.dsl.quantum.qpu import QPU
     from laboneq_applications.typing import QuantumElements, QubitSweepPoints
@@ -165,13 +173,35 @@ class T2Echo(ExperimentHandler):
         qubits = [self.qpu[qu_id] for qu_id in qu_ids]
         return create_experiment(self.qpu, qubits, time, options=options)
 
+    def plan_delays(self, qu_id="q0", transition="ge", **kwargs):
+        """Delays that minimize the expected variance of T2 given its current
+        value, or 2 * T1 if T2 is not known. See ``plan_decay_delays`` for the
+        options."""
+        params = self.qpu[qu_id].parameters
+        T2 = getattr(params, f"{transition}_T2", None)
+        if not T2:
+            T2 = 2 * (getattr(params, f"{transition}_T1", None) or 0)
+        if not T2 or T2 <= 0:
+            raise ValueError(
+                f"No {transition}_T2 or {transition}_T1 estimate for {qu_id}"
+            )
+        return plan_decay_delays(T2, **kwargs)
+
     def analyze(self, path, *args, **kwargs):
         return analyze_T2_echo(path=path, **kwargs)
 
 
+@cached_analysis(version=4)
+@parallel_qubits
 @multi_qubit_handler
 def analyze_T2_echo(
-    datadict, qpu=None, qu_id="q0", transition="ge", relevant_params=None, **kwargs
+    datadict,
+    qpu=None,
+    qu_id="q0",
+    transition="ge",
+    relevant_params=None,
+    headless=False,
+    **kwargs,
 ):
     # Prepare analysis result object
     anal_res = AnalysisResult()
@@ -181,7 +211,7 @@ def analyze_T2_echo(
     x_data, y_data, sweeps = qu_data
     x_info, y_info, sweep_info = qu_info
 
-    fit_res, fig = None, None
+    fit_res, plot = None, None
     qubit_params = enrich_qubit_params(qpu[qu_id]) if qpu else {}
 
     if relevant_params is None:
@@ -192,42 +222,59 @@ def analyze_T2_echo(
 
     has_sweeps = y_data.ndim > 1
     if not has_sweeps:
-        # Plot raw data and extract projection
-        fig, axs, proj, inv = plot_projection_IQ(datadict=datadict, full_output=True)
-        anal_res.add_figure(fig, "fig", qu_id)
-
-        # Fit exponential
-        fit_res = fit.fit_decaying_exp(x_data, proj)
-        x_fit = np.linspace(x_data[0], x_data[-1], 3 * len(x_data))
-        inverse_fit = inv(fit_res.predict(x_fit))
+        # Extract projection and fit exponential
+        proj, inv = fit.transform_data(y_data, inv_transform=True)
+        fit_res = fit.fit_decaying_exp(
+            x_data, proj, guess=estimate_decaying_exp(x_data, proj)
+        )
         anal_res.add_fit(fit_res, "fit", qu_id)
 
         # Update parameters
         T2 = fit_res.params_by_name["tau"]
         anal_res.add_params({f"{transition}_T2": T2}, qu_id)
 
-        # Plot the fit
-        axs[0].plot(
-            x_fit * x_info.scale, fit_res.predict(x_fit) * y_info.scale, "tab:red"
-        )
-        axs[1].plot(
-            inverse_fit.real * y_info.scale,
-            inverse_fit.imag * y_info.scale,
-            "tab:red",
+        # Bootstrap confidence interval
+        boot = bootstrap_decaying_exp(x_data, proj, tau=T2)
+        anal_res.add_output(
+            {
+                f"{transition}_T2_std": boot["tau_std"],
+                f"{transition}_T2_ci": boot["tau_ci"],
+            },
+            qu_id,
         )
+
+        def plot():
+            # Plot raw data and the fit
+            fig, axs = plot_projection_IQ(datadict=datadict, proj_data=proj)
+            x_fit = np.linspace(x_data[0], x_data[-1], 3 * len(x_data))
+            inverse_fit = inv(fit_res.predict(x_fit))
+            axs[0].plot(
+                x_fit * x_info.scale, fit_res.predict(x_fit) * y_info.scale, "tab:red"
+            )
+            axs[1].plot(
+                inverse_fit.real * y_info.scale,
+                inverse_fit.imag * y_info.scale,
+                "tab:red",
+            )
+            return fig
+
     elif y_data.ndim == 2:
         T2s = np.zeros(len(y_data))
+        fit_table = FitTable(len(y_data))
         for i in range(len(y_data)):
             fit_res = None
             x, y = x_data[i], y_data[i]
             try:
                 proj = fit.transform_data(y, inv_transform=False)
-                fit_res = fit.fit_decaying_exp(x, proj)
+                fit_res = fit.fit_decaying_exp(
+                    x, proj, guess=estimate_decaying_exp(x, proj)
+                )
             except Exception as e:
                 print(f"Error ananlyzing trace {i}", e)
+            fit_table.set_row(i, fit_res)
             if fit_res is not None:
-                anal_res.add_fit(fit_res, f"fit idx {i}", qu_id)
                 T2s[i] = fit_res.params_by_name["tau"]
+        anal_res.add_fit(fit_table, "fits", qu_id)
 
         T2s_masked = np.where(T2s > 0, T2s, np.nan)
         T2s_masked = mask_outliers(T2s_masked)
@@ -236,26 +283,33 @@ def analyze_T2_echo(
         T2 = np.nanmean(T2s_masked)
         anal_res.add_params({f"{transition}_T2": T2}, qu_id)
 
-        # Plot
-        T2_info = ParamInfo(f"{transition}_T2")
-        T2_scaled = T2s_masked * T2_info.scale
-        sweep_scaled = sweeps[0] * sweep_info[0].scale
-        fig, axs = plt.subplots(1, 1)
-        anal_res.add_figure(fig, "fig", qu_id)
-        axs.plot(sweep_scaled, T2_scaled, ".-")
-        axs.axhline(y=T2 * T2_info.scale, color="tab:pink", linestyle="--")
-        axs.set_ylabel(T2_info.name_and_unit)
-        axs.set_xlabel(sweep_info[0].name_and_unit)
-
-    finalize_plot(
-        fig,
-        f"T2 echo ({transition})",
-        qu_id,
-        fit_res,
-        qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+        def plot():
+            T2_info = ParamInfo(f"{transition}_T2")
+            T2_scaled = T2s_masked * T2_info.scale
+            sweep_scaled = sweeps[0] * sweep_info[0].scale
+            fig, axs = plt.subplots(1, 1)
+            axs.plot(sweep_scaled, T2_scaled, ".-")
+            axs.axhline(y=T2 * T2_info.scale, color="tab:pink", linestyle="--")
+            axs.set_ylabel(T2_info.name_and_unit)
+            axs.set_xlabel(sweep_info[0].name_and_unit)
+            return fig
+
+    if plot is not None:
+
+        def render():
+            fig = plot()
+            finalize_plot(
+                fig,
+                f"T2 echo ({transition})",
+                qu_id,
+                fit_res,
+                qubit_params,
+                updated_params=anal_res.updated_params.get(qu_id, {}),
+                sweep_info=sweep_info,
+                relevant_params=relevant_params,
+            )
+            return fig
+
+        anal_res.add_figure(make_figure(render, headless), "fig", qu_id)
 
     return anal_res
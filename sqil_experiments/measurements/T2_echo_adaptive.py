@@ -6,6 +6,19 @@ from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_
 from sqil_core.utils import *
 from time_rabi import TimeRabi
 
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.parallel import parallel_qubits
+from sqil_experiments.measurements.helpers.calibration_graph import (
+    CalibrationGraph,
+    CalibrationNode,
+    next_sweep_point,
+    sweep_consumes,
+    within,
+)
+from sqil_experiments.measurements.helpers.compile_pipeline import CompilePipeline
+from sqil_experiments.measurements.helpers.delay_planner import default_decay_delays
+from sqil_experiments.measurements.helpers.handler_pool import HandlerPool
 from sqil_experiments.measurements.T2_echo import T2Echo
 
 
@@ -17,70 +30,106 @@ class T2EchoAdaptive(ExperimentHandler):
         "T2_std": {"role": "data", "unit": "s", "scale": 1e6},
     }
 
+    def run(self, *args, **kwargs):
+        # Keep the child experiments connected for the whole run and compile the
+        # next one while the current one acquires, when it does not depend on it
+        with HandlerPool(self, pipeline=CompilePipeline()) as self.pool:
+            self.calibration = CalibrationGraph(self.pool)
+            res = super().run(*args, **kwargs)
+        self.compile_trace = self.pool.pipeline.trace
+        return res
+
     def sequence(
-        self, exp_params, qu_ids=["q0"], transition="ge", options=None, *args, **kwargs
+        self,
+        exp_params,
+        qu_ids=["q0"],
+        transition="ge",
+        options=None,
+        *args,
+        calibration_ttl=0,
+        sweep_tolerance=None,
+        **kwargs,
     ):
         spec_options, rabi_options, T2_options = options
         spec_params, rabi_params, T2_params = exp_params
+        freq_param = f"resonance_frequency_{transition}"
+        length_param = f"{transition}_drive_length"
 
-        # Perform qubit spectroscopy
-        qu_spec = QuSpec(qpu=self.qpu)
-        qu_spec_res = qu_spec.run(
-            spec_params,
-            transition=transition,
-            qu_ids=["q0"],
-            options=spec_options,
-            update_params=True,
-            relevant_params=["readout_amplitude", "spectroscopy_amplitude"],
-        )
-        # If not qubit frequency is found skip
-        qu_freq = qu_spec_res.updated_params.get("q0", {}).get(
-            "resonance_frequency_ge", np.nan
-        )
-        if np.isnan(qu_freq):
-            return {"qu_freq": np.nan, "T2": np.nan}
+        # Linear and log delays around the T2 of the previous point
+        if not T2_params:
+            params = self.qpu.quantum_elements[0].parameters
+            T2_value = params.ge_T2 or 2 * (params.ge_T1 or 0)
+            if not 0 < T2_value <= 1e-3:
+                T2_value = 50e-6
+            T2_params = [default_decay_delays(T2_value)]
 
-        # Perform time rabi
-        time_rabi = TimeRabi()
-        time_rabi_res = time_rabi.run(
-            rabi_params,
-            transition=transition,
-            qu_ids=["q0"],
-            options=rabi_options,
-            update_params=True,
-            relevant_params=["ge_drive_amplitude_pi", "resonance_frequency_ge"],
+        # Qubit spectroscopy and time rabi are rerun at every point. With a
+        # calibration_ttl in seconds they are reused until it expires, or until the
+        # sweep or their inputs change
+        graph = self.calibration
+        graph.add(
+            CalibrationNode(
+                "qu_spec",
+                QuSpec,
+                (spec_params,),
+                {
+                    "transition": transition,
+                    "qu_ids": ["q0"],
+                    "options": spec_options,
+                    "update_params": True,
+                    "relevant_params": ["readout_amplitude", "spectroscopy_amplitude"],
+                },
+                produces=[freq_param],
+                consumes=sweep_consumes(kwargs.get("sweeps"), sweep_tolerance),
+                ttl=calibration_ttl,
+                check=within(np.min(spec_params), np.max(spec_params)),
+            )
         )
-
-        T2_exp = T2Echo()
-        # Automatically compute T2 sweep times
-        if not T2_params:
-            T2_max = 2 * T2_exp.qpu.quantum_elements[0].parameters.ge_T1
-            if T2_max > 1e-3:
-                T2_max = 50e-6
-            time = np.hstack(
-                [
-                    np.linspace(0, T2_max, 11),
-                    np.logspace(
-                        np.log(T2_max * 1.1), np.log(5 * T2_max), 11, base=np.e
-                    ),
-                ]
+        graph.add(
+            CalibrationNode(
+                "time_rabi",
+                TimeRabi,
+                (rabi_params,),
+                {
+                    "transition": transition,
+                    "qu_ids": ["q0"],
+                    "options": rabi_options,
+                    "update_params": True,
+                    "relevant_params": ["ge_drive_amplitude_pi", freq_param],
+                },
+                produces=[length_param],
+                consumes=[freq_param],
+                ttl=calibration_ttl,
+            )
+        )
+        graph.add(
+            CalibrationNode(
+                "T2_echo",
+                T2Echo,
+                (T2_params,),
+                {"options": T2_options, "update_params": True},
+                produces=["ge_T2"],
+                consumes=[length_param],
+                ttl=0,
+                check=None,
             )
-            T2_params = [time]
-        # Perform T2 experiment
-        T2_res = T2_exp.run(
-            T2_params,
-            options=T2_options,
-            update_params=True,
         )
+        # While T2_echo acquires, compile the calibration of the next sweep point
+        next_point = next_sweep_point(kwargs.get("sweeps"), self.qpu["q0"].parameters)
+        results = graph.run("T2_echo", next_point=next_point)
+
+        # If not qubit frequency is found skip
+        if graph.failed == "qu_spec":
+            return {"qu_freq": np.nan, "T2": np.nan}
+        qu_freq = getattr(self.qpu["q0"].parameters, freq_param)
 
-        # Extract fitted T2 value and standard error
-        T2_extracted = T2_res.updated_params.get("q0", {}).get("ge_T2", np.nan)
-        T2_std = np.nan
+        # Extract fitted T2 value and bootstrap standard error
+        T2_res = results.get("T2_echo")
+        T2_extracted, T2_std = np.nan, np.nan
+        if T2_res is not None:
+            T2_extracted = T2_res.updated_params.get("q0", {}).get("ge_T2", np.nan)
         if not np.isnan(T2_extracted):
-            try:
-                T2_std = T2_res.fits["q0 - fit"].std_err[1]
-            except _:
-                pass
+            T2_std = T2_res.output.get("q0", {}).get("ge_T2_std", np.nan)
 
         # Remove figures from memory
         plt.close("all")
@@ -89,12 +138,23 @@ class T2EchoAdaptive(ExperimentHandler):
         return {"qu_freq": qu_freq, "T2": T2_extracted, "T2_std": T2_std}
 
     def analyze(self, path, *args, **kwargs):
+        # Compile and acquisition times of the child experiments
+        if getattr(self, "pool", None) is not None:
+            self.pool.save_trace(path)
         return analyze_T2_adaptive(path=path, **kwargs)
 
 
+@cached_analysis(version=1)
+@parallel_qubits
 @multi_qubit_handler
 def analyze_T2_adaptive(
-    datadict, qpu=None, qu_id="q0", transition="ge", relevant_params=None, **kwargs
+    datadict,
+    qpu=None,
+    qu_id="q0",
+    transition="ge",
+    relevant_params=None,
+    headless=False,
+    **kwargs,
 ):
     # Prepare analysis result object
     anal_res = AnalysisResult()
@@ -103,7 +163,6 @@ def analyze_T2_adaptive(
     *_, sweeps = qu_data
     *_, sweep_info = qu_info
 
-    fit_res, fig = None, None
     qubit_params = enrich_qubit_params(qpu[qu_id]) if qpu else {}
 
     if relevant_params is None:
@@ -130,74 +189,80 @@ def analyze_T2_adaptive(
     T2_std_scaled = T2_stds_masked * T2_info.scale
 
     # T2 vs sweep
-    fig, ax = plt.subplots(1, 1)
-    anal_res.add_figure(fig, f"fig", qu_id)
-    sweep_scaled = sweeps[0] * sweep_info[0].scale
-
-    ax.errorbar(
-        sweep_scaled,
-        T2_scaled,
-        yerr=T2_std_scaled,
-        fmt="-o",
-        capthick=2,
-        elinewidth=2,
-        label=T2_info.name,
-    )
-    ax.axhline(
-        y=np.nanmean(T2_scaled), color="tab:pink", linestyle="--", label="T2 avg"
-    )
-    ax.set_xlabel(sweep_info[0].name_and_unit)
-    ax.set_ylabel(T2_info.name_and_unit)
-    ax.legend(loc="upper left")
-    # Qubit frequency vs sweep
-    ax_freq = ax.twinx()
-    ax_freq.plot(
-        sweep_scaled,
-        qu_freq_scaled,
-        "o-",
-        color="tab:orange",
-        alpha=0.5,
-        label=qu_freq_info.name,
-    )
-    ax_freq.set_ylabel(qu_freq_info.name_and_unit)
-    ax_freq.legend(loc="lower left")
-
-    finalize_plot(
-        fig,
-        f"T2 echo ({transition})",
-        qu_id,
-        fit_res=None,
-        qubit_params=qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+    def plot_sweep():
+        fig, ax = plt.subplots(1, 1)
+        sweep_scaled = sweeps[0] * sweep_info[0].scale
+
+        ax.errorbar(
+            sweep_scaled,
+            T2_scaled,
+            yerr=T2_std_scaled,
+            fmt="-o",
+            capthick=2,
+            elinewidth=2,
+            label=T2_info.name,
+        )
+        ax.axhline(
+            y=np.nanmean(T2_scaled), color="tab:pink", linestyle="--", label="T2 avg"
+        )
+        ax.set_xlabel(sweep_info[0].name_and_unit)
+        ax.set_ylabel(T2_info.name_and_unit)
+        ax.legend(loc="upper left")
+        # Qubit frequency vs sweep
+        ax_freq = ax.twinx()
+        ax_freq.plot(
+            sweep_scaled,
+            qu_freq_scaled,
+            "o-",
+            color="tab:orange",
+            alpha=0.5,
+            label=qu_freq_info.name,
+        )
+        ax_freq.set_ylabel(qu_freq_info.name_and_unit)
+        ax_freq.legend(loc="lower left")
+
+        finalize_plot(
+            fig,
+            f"T2 echo ({transition})",
+            qu_id,
+            fit_res=None,
+            qubit_params=qubit_params,
+            updated_params=anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        return fig
+
+    anal_res.add_figure(make_figure(plot_sweep, headless), "fig", qu_id)
 
     # T2 vs qubit frequency
-    fig, ax = plt.subplots(1, 1)
-    anal_res.add_figure(fig, f"fig_freq", qu_id)
-    ax.errorbar(
-        qu_freq_scaled,
-        T2_scaled,
-        yerr=T2_std_scaled,
-        fmt="-o",
-        capthick=2,
-        elinewidth=2,
-    )
-
-    ax.axhline(y=np.nanmean(T2_scaled), color="tab:pink", linestyle="--")
-    ax.set_xlabel(qu_freq_info.name_and_unit)
-    ax.set_ylabel(T2_info.name_and_unit)
-
-    finalize_plot(
-        fig,
-        f"T2 echo ({transition})",
-        qu_id,
-        fit_res=None,
-        qubit_params=qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+    def plot_freq():
+        fig, ax = plt.subplots(1, 1)
+        ax.errorbar(
+            qu_freq_scaled,
+            T2_scaled,
+            yerr=T2_std_scaled,
+            fmt="-o",
+            capthick=2,
+            elinewidth=2,
+        )
+
+        ax.axhline(y=np.nanmean(T2_scaled), color="tab:pink", linestyle="--")
+        ax.set_xlabel(qu_freq_info.name_and_unit)
+        ax.set_ylabel(T2_info.name_and_unit)
+
+        finalize_plot(
+            fig,
+            f"T2 echo ({transition})",
+            qu_id,
+            fit_res=None,
+            qubit_params=qubit_params,
+            updated_params=anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        return fig
+
+    anal_res.add_figure(make_figure(plot_freq, headless), "fig_freq", qu_id)
 
     return anal_res
@@ -12,6 +12,9 @@ from numpy.typing import ArrayLike
 from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_handler
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.parallel import parallel_qubits
 from sqil_experiments.measurements.rr_spec import rr_spec_analysis
 
 
@@ -116,6 +119,8 @@ class DispersiveShift(ExperimentHandler):
         return analyze_dispersive_shift(path=path, **kwargs)
 
 
+@cached_analysis(version=2)
+@parallel_qubits
 @multi_qubit_handler
 def analyze_dispersive_shift(
     datadict,
@@ -124,6 +129,7 @@ def analyze_dispersive_shift(
     qpu=None,
     at_sweep_idx=None,
     relevant_params=[],
+    headless=False,
     **kwargs,
 ) -> AnalysisResult:
     # Prepare analysis result object
@@ -149,10 +155,14 @@ def analyze_dispersive_shift(
         del schema_e["data_g"]
 
         datadict["metadata"]["schema"] = schema_g
-        anal_res_g = rr_spec_analysis(datadict=datadict, qpu=qpu, qu_id=qu_id)
+        anal_res_g = rr_spec_analysis(
+            datadict=datadict, qpu=qpu, qu_id=qu_id, headless=True
+        )
 
         datadict["metadata"]["schema"] = schema_e
-        anal_res_e = rr_spec_analysis(datadict=datadict, qpu=qpu, qu_id=qu_id)
+        anal_res_e = rr_spec_analysis(
+            datadict=datadict, qpu=qpu, qu_id=qu_id, headless=True
+        )
 
         # Extract resonance frequencies
         fr_g = anal_res_g.updated_params.get("q0", {}).get(
@@ -173,58 +183,71 @@ def analyze_dispersive_shift(
             chi = fr_e - fr_g
             anal_res.add_params({f"{transition}_chi_shift": chi}, qu_id)
 
-        # Plotting
-        # Grab all Line2D objects from ax1 and ax2
-        g_lines = anal_res_g.figures["q0_fig"].axes[1].get_lines()
-        e_lines = anal_res_e.figures["q0_fig"].axes[1].get_lines()
-        # Extract x and y labels
-        x_label = anal_res_g.figures["q0_fig"].axes[2].get_xlabel()
-        y_label = anal_res_g.figures["q0_fig"].axes[1].get_ylabel()
-        # Close figures
-        plt.close("all")
-
-        # Create new figure and add both lines
-        fig, ax = plt.subplots(1, 1)
-        anal_res.add_figure(fig, "fig", qu_id)
-        for lines, lab in zip([g_lines, e_lines], ["g", "e"]):
-            ax.plot(lines[0].get_xdata(), lines[0].get_ydata(), "o", label=lab)
-            ax.plot(lines[1].get_xdata(), lines[1].get_ydata(), color="tab:red")
-
-        # Draw two vertical lines
-        x1, x2 = fr_g * 1e-9, fr_e * 1e-9
-        ax.axvline(x=x1, color="tab:blue", linestyle="--")
-        ax.axvline(x=x2, color="tab:orange", linestyle="--")
-        # Draw the arrow with two heads (symbolizing distance between lines)
-        arrow = patches.FancyArrowPatch(
-            (x1, 0),  # Start point (x1, 0)
-            (x2, 0),  # End point (x2, 0)
-            arrowstyle="<|-|>",  # Arrow style with two heads
-            mutation_scale=20,  # Size of the arrows
-            color="black",
-            linewidth=2,
-        )
-        # Add the arrow to the plot
-        ax.add_patch(arrow)
-        # Add text above the arrow
-        midpoint_x = (x1 + x2) / 2  # Find the midpoint of the x-coordinates
-        ax.text(midpoint_x, 0.005, r"$\chi$", ha="center", va="bottom")
-
-        ax.set_xlabel(x_label)
-        ax.set_ylabel(y_label)
-        ax.legend()
+        def plot():
+            # The rr_spec figures are only drawn to copy their lines
+            fig_g = anal_res_g.figures["q0_fig"].render()
+            fig_e = anal_res_e.figures["q0_fig"].render()
+            # Grab all Line2D objects from ax1 and ax2
+            g_lines = fig_g.axes[1].get_lines()
+            e_lines = fig_e.axes[1].get_lines()
+            # Extract x and y labels
+            x_label = fig_g.axes[2].get_xlabel()
+            y_label = fig_g.axes[1].get_ylabel()
+            # Close figures
+            plt.close(fig_g)
+            plt.close(fig_e)
+
+            # Create new figure and add both lines
+            set_plot_style(plt)
+            fig, ax = plt.subplots(1, 1)
+            for lines, lab in zip([g_lines, e_lines], ["g", "e"]):
+                ax.plot(lines[0].get_xdata(), lines[0].get_ydata(), "o", label=lab)
+                ax.plot(lines[1].get_xdata(), lines[1].get_ydata(), color="tab:red")
+
+            # Draw two vertical lines
+            x1, x2 = fr_g * 1e-9, fr_e * 1e-9
+            ax.axvline(x=x1, color="tab:blue", linestyle="--")
+            ax.axvline(x=x2, color="tab:orange", linestyle="--")
+            # Draw the arrow with two heads (symbolizing distance between lines)
+            arrow = patches.FancyArrowPatch(
+                (x1, 0),  # Start point (x1, 0)
+                (x2, 0),  # End point (x2, 0)
+                arrowstyle="<|-|>",  # Arrow style with two heads
+                mutation_scale=20,  # Size of the arrows
+                color="black",
+                linewidth=2,
+            )
+            # Add the arrow to the plot
+            ax.add_patch(arrow)
+            # Add text above the arrow
+            midpoint_x = (x1 + x2) / 2  # Find the midpoint of the x-coordinates
+            ax.text(midpoint_x, 0.005, r"$\chi$", ha="center", va="bottom")
+
+            ax.set_xlabel(x_label)
+            ax.set_ylabel(y_label)
+            ax.legend()
+            return fig
+
     else:
-        fig, axs = plot_mag_phase(datadict=datadict, raw=True)
-        anal_res.add_figure(fig, "fig", qu_id)
-
-    finalize_plot(
-        fig,
-        f"Dispersive shift ({transition})",
-        qu_id,
-        fit_res,
-        qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+
+        def plot():
+            fig, axs = plot_mag_phase(datadict=datadict, raw=True)
+            return fig
+
+    def render():
+        fig = plot()
+        finalize_plot(
+            fig,
+            f"Dispersive shift ({transition})",
+            qu_id,
+            fit_res,
+            qubit_params,
+            updated_params=anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        return fig
+
+    anal_res.add_figure(make_figure(render, headless), "fig", qu_id)
 
     return anal_res
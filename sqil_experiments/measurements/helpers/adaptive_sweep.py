@@ -0,0 +1,116 @@
+"""Coarse-to-fine sweeps for spectroscopy.
+
+A dense uniform sweep spends most of its points far from the features of interest. A
+coarse-to-fine sweep first acquires a coarse grid, locates the features on it, then
+acquires dense windows only around them, all the windows in a single pass. The two
+passes are merged into one dataset with an irregular x-axis.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable
+
+import numpy as np
+
+DEFAULT_ZOOM_POINTS = 101
+# Half width of a zoom window, in linewidths of the feature
+DEFAULT_ZOOM_LINEWIDTHS = 5
+# Minimum half width of a zoom window, in coarse steps
+MIN_ZOOM_STEPS = 2
+# Below this number of coarse points no further feature is searched
+MIN_LOCATE_POINTS = 10
+
+
+def merge_passes(passes: list[tuple[np.ndarray, np.ndarray]]):
+    """Merges (x, y) passes into a single dataset sorted by x. When the same x is
+    acquired more than once, the last pass is kept."""
+    x = np.concatenate([np.asarray(p[0]) for p in passes])
+    y = np.concatenate([np.asarray(p[1]) for p in passes])
+    # np.unique keeps the first occurrence, reverse to keep the last pass
+    x, idx = np.unique(x[::-1], return_index=True)
+    return x, y[::-1][idx]
+
+
+def locate_features(
+    x,
+    y,
+    locate: Callable,
+    n_features: int = 1,
+    n_linewidths: float = DEFAULT_ZOOM_LINEWIDTHS,
+) -> list[tuple[float, float]]:
+    """Finds up to n_features (center, half_span) windows on coarse data.
+
+    ``locate(x, y)`` returns the (center, linewidth) of the dominant feature of the
+    data, or None. After every feature is found, its window is removed from the data
+    and the next one is searched in the remaining points.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    min_half_span = MIN_ZOOM_STEPS * np.median(np.abs(np.diff(x)))
+    windows = []
+    for _ in range(n_features):
+        if len(x) < MIN_LOCATE_POINTS:
+            break
+        try:
+            feature = locate(x, y)
+        except Exception as e:
+            print("Error locating feature", e)
+            feature = None
+        if feature is None:
+            break
+        center, linewidth = feature
+        if not (np.min(x) <= center <= np.max(x)) or not np.isfinite(linewidth):
+            break
+        half_span = max(n_linewidths * abs(linewidth), min_half_span)
+        windows.append((center, half_span))
+        keep = np.abs(x - center) > half_span
+        x, y = x[keep], y[keep]
+    return windows
+
+
+def coarse_to_fine(
+    acquire: Callable,
+    coarse_x,
+    locate: Callable,
+    n_features: int = 1,
+    zoom_points: int = DEFAULT_ZOOM_POINTS,
+    n_linewidths: float = DEFAULT_ZOOM_LINEWIDTHS,
+):
+    """Acquires a coarse sweep, then dense windows around the features found on it.
+
+    Parameters
+    ----------
+    acquire : Callable
+        ``acquire(x)`` runs the experiment on the sweep values x and returns the
+        data, with the same length as x.
+    coarse_x : np.ndarray
+        Coarse sweep, it also defines the range of the zoom windows.
+    locate : Callable
+        ``locate(x, y)`` returns the (center, linewidth) of the dominant feature of
+        the data, or None.
+    n_features : int, optional
+        Maximum number of features to zoom on, by default 1.
+    zoom_points : int, optional
+        Number of points of every zoom window, by default 101.
+    n_linewidths : float, optional
+        Half width of the zoom windows in linewidths of the feature, by default 5.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, list]
+        The merged x and y, sorted by x, and the (center, half_span) of the zoom
+        windows.
+    """
+    coarse_x = np.asarray(coarse_x)
+    coarse_y = acquire(coarse_x)
+    passes = [(coarse_x, coarse_y)]
+
+    windows = locate_features(coarse_x, coarse_y, locate, n_features, n_linewidths)
+    if windows:
+        zoom_x = np.concatenate(
+            [np.linspace(c - s, c + s, zoom_points) for c, s in windows]
+        )
+        zoom_x = zoom_x[(zoom_x >= np.min(coarse_x)) & (zoom_x <= np.max(coarse_x))]
+        passes.append((zoom_x, acquire(zoom_x)))
+
+    x, y = merge_passes(passes)
+    return x, y, windows
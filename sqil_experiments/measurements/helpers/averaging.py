@@ -0,0 +1,130 @@
+"""Averaging of repeated acquisitions of a compiled experiment.
+
+The results of every repetition are accumulated in place with Welford's algorithm,
+which gives the mean and the variance of each point without keeping the individual
+repetitions. The next acquisition is submitted before the results of the current one
+are saved, so that writing the data overlaps with the measurement.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class WelfordAccumulator:
+    """Running mean and variance of the data of a set of result handles.
+
+    For complex data the variance is the one of the distance from the mean,
+    E[|x - mean|^2].
+
+    Example
+    -------
+    >>> acc = WelfordAccumulator(["ground_state", "excited_state"])
+    >>> for _ in range(10):
+    ...     result = session.run(compiled_exp)
+    ...     acc.update({h: result.get_data(h) for h in acc.handles})
+    >>> acc.mean("ground_state"), acc.sem("ground_state")
+    """
+
+    def __init__(self, handles: list[str]):
+        self.handles = list(handles)
+        self.count = 0
+        self._mean: dict[str, np.ndarray] = {}
+        self._m2: dict[str, np.ndarray] = {}
+
+    def update(self, values: dict):
+        """Adds one repetition, values maps each handle to its data."""
+        self.count += 1
+        for handle in self.handles:
+            x = np.asarray(values[handle])
+            if self.count == 1:
+                self._mean[handle] = np.array(x, dtype=np.result_type(x, float))
+                self._m2[handle] = np.zeros(x.shape)
+                continue
+            mean = self._mean[handle]
+            delta = x - mean
+            mean += delta / self.count
+            self._m2[handle] += np.real(delta * np.conj(x - mean))
+
+    def mean(self, handle: str) -> np.ndarray:
+        return self._mean[handle]
+
+    def variance(self, handle: str) -> np.ndarray:
+        """Sample variance of the repetitions, NaN with less than 2 of them."""
+        if self.count < 2:
+            return np.full(self._m2[handle].shape, np.nan)
+        return self._m2[handle] / (self.count - 1)
+
+    def std(self, handle: str) -> np.ndarray:
+        return np.sqrt(self.variance(handle))
+
+    def sem(self, handle: str) -> np.ndarray:
+        """Standard error of the mean."""
+        return np.sqrt(self.variance(handle) / self.count)
+
+    def max_sem(self) -> float:
+        """Largest standard error of the mean over all the handles and points."""
+        return max(float(np.max(self.sem(handle))) for handle in self.handles)
+
+    def __repr__(self):
+        return f"WelfordAccumulator({self.handles}, count={self.count})"
+
+
+def _converged(acc: WelfordAccumulator, tolerance, min_avg: int) -> bool:
+    return tolerance is not None and acc.count >= min_avg and acc.max_sem() <= tolerance
+
+
+def external_average(
+    session,
+    compiled_exp,
+    handles: list[str],
+    external_avg: int,
+    writer=None,
+    repetition_key: str = "repetition",
+    tolerance: float | None = None,
+    min_avg: int = 2,
+) -> WelfordAccumulator:
+    """Runs a compiled experiment repeatedly and averages the given handles.
+
+    Parameters
+    ----------
+    session : Session
+        LabOne Q session the experiment is run on.
+    compiled_exp : CompiledExperiment
+        The experiment to repeat.
+    handles : list[str]
+        Result handles to accumulate.
+    external_avg : int
+        Maximum number of repetitions.
+    writer : DDH5Writer, optional
+        If given, the data of every repetition is added to it, together with the
+        repetition index under ``repetition_key``. Its datadict must have these
+        fields.
+    tolerance : float, optional
+        Stop once the standard error of the mean of every point is below this
+        value, after at least ``min_avg`` repetitions.
+
+    Returns
+    -------
+    WelfordAccumulator
+        Mean, variance and number of repetitions of each handle.
+    """
+    acc = WelfordAccumulator(handles)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(session.run, compiled_exp)
+        submitted = 1
+        while pending is not None:
+            result = pending.result()
+            values = {handle: result.get_data(handle) for handle in handles}
+            acc.update(values)
+
+            pending = None
+            if submitted < external_avg and not _converged(acc, tolerance, min_avg):
+                pending = executor.submit(session.run, compiled_exp)
+                submitted += 1
+            # Saved while the next repetition is acquired
+            if writer is not None:
+                writer.add_data(**{repetition_key: acc.count - 1}, **values)
+    return acc
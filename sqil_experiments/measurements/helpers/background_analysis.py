@@ -0,0 +1,212 @@
+"""Analysis in a background process, so that a run returns as soon as its data is
+saved.
+
+With background analysis enabled, ``handler.run`` stores the data as usual and
+submits the analysis of the run to the worker pool of ``analysis.parallel``. The run
+returns an AnalysisFuture instead of the AnalysisResult. The worker saves the
+figures and fits in the data folder. The updated parameters are applied to the QPU
+of the handler, and saved to the QPU files, on the main thread when the result is
+collected:
+
+- by ``future.result()``;
+- by ``wait_for_analyses()``, the barrier for code that needs the fitted
+  parameters right away;
+- at the start of the next run of the same handler, for the analyses that are
+  already done.
+"""
+
+from __future__ import annotations
+
+import importlib
+import os
+import shutil
+from collections.abc import Callable
+from concurrent.futures import Future
+
+from laboneq import serializers
+
+from sqil_experiments.analysis.figures import save_analysis
+from sqil_experiments.analysis.parallel import from_payload, get_executor, to_payload
+
+# Analyses that have not been collected yet
+_pending: list[AnalysisFuture] = []
+
+
+def _analyze_run(module_name: str, qualname: str, path: str, args, kwargs):
+    import matplotlib.pyplot as plt
+
+    handler_cls = getattr(importlib.import_module(module_name), qualname)
+    # analyze doesn't use the instruments, skip __init__ to avoid connecting
+    handler = handler_cls.__new__(handler_cls)
+    try:
+        anal_res = handler.analyze(path, *args, **{**kwargs, "headless": True})
+        if anal_res is None:
+            return None
+        save_analysis(anal_res, path)
+        return to_payload(anal_res)
+    finally:
+        plt.close("all")
+
+
+def _server_path(path: str) -> str | None:
+    """Server copy of a run folder, from the paths.md saved with the data."""
+    try:
+        with open(os.path.join(path, "paths.md")) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    return lines[1] if len(lines) > 1 else None
+
+
+class AnalysisFuture:
+    """Handle on the background analysis of a run.
+
+    ``result()`` waits for the analysis, applies the updated parameters to the QPU
+    of the handler (unless the run had ``update_params=False``) and returns the
+    AnalysisResult. The parameters are applied only once. If the worker fails, e.g.
+    because the arguments of the run cannot be pickled, ``fallback()`` analyzes the
+    run in the main process instead.
+    """
+
+    def __init__(
+        self,
+        future: Future,
+        handler,
+        path: str,
+        update_params: bool = True,
+        fallback: Callable | None = None,
+        qpu_owner=None,
+    ):
+        self.future = future
+        self.handler = handler
+        self.path = path
+        self.update_params = update_params
+        self.fallback = fallback
+        self.qpu_owner = qpu_owner or handler
+        self._result = None
+        self._collected = False
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self, timeout: float | None = None):
+        if self._collected:
+            return self._result
+        try:
+            payload = self.future.result(timeout)
+            self._result = from_payload(payload, headless=True) if payload else None
+        except TimeoutError:
+            raise
+        except Exception as e:
+            print(f"Error while analyzing {self.path} in the background: {e}")
+            self._result = self._analyze_inline()
+        self._collected = True
+        if self in _pending:
+            _pending.remove(self)
+        if self._result is not None and self.update_params:
+            self._apply_params()
+        return self._result
+
+    def _analyze_inline(self):
+        if self.fallback is None:
+            return None
+        try:
+            anal_res = self.fallback()
+            if anal_res is not None:
+                save_analysis(anal_res, self.path)
+            return anal_res
+        except Exception as e:
+            print(f"Error while analyzing {self.path}: {e}")
+            return None
+
+    def _apply_params(self):
+        qpu = self.qpu_owner.qpu
+        for qu_id, params in self._result.updated_params.items():
+            qpu[qu_id].update(**params)
+        storage = self.handler.setup["storage"]
+        serializers.save(qpu, os.path.join(self.path, "qpu_new.json"))
+        qpu_filename = storage.get("qpu_filename", "qpu.json")
+        serializers.save(qpu, os.path.join(storage["db_path_local"], qpu_filename))
+        # The run folder was copied to the server before the analysis finished
+        server_path = _server_path(self.path)
+        if server_path and os.path.abspath(server_path) != os.path.abspath(self.path):
+            try:
+                shutil.copytree(self.path, server_path, dirs_exist_ok=True)
+            except OSError as e:
+                print(f"Error copying {self.path} to {server_path}: {e}")
+
+    def __repr__(self):
+        state = "done" if self.done() else "running"
+        return f"AnalysisFuture({self.path!r}, {state})"
+
+
+def collect_done_analyses(handler=None):
+    """Collects the analyses that are already done, optionally only the ones of a
+    handler, without waiting for the others."""
+    for future in list(_pending):
+        if (handler is None or future.handler is handler) and future.done():
+            future.result()
+
+
+def wait_for_analyses(handler=None) -> list:
+    """Barrier: waits for all the pending analyses, or only the ones of a handler,
+    applies their parameters and returns their results."""
+    futures = [f for f in list(_pending) if handler is None or f.handler is handler]
+    return [future.result() for future in futures]
+
+
+def enable_background_analysis(handler, max_workers: int | None = None, qpu_owner=None):
+    """Runs the analyses of a handler in a background process.
+
+    ``handler.run`` then returns an AnalysisFuture. Use ``wait_for_analyses()``
+    before running code that needs the fitted parameters. The parameters are
+    applied to ``qpu_owner.qpu``, by default the QPU of the handler. Give the parent
+    of a HandlerPool when the handler runs in a pool, since every run replaces the
+    QPU of the handler.
+
+    Example
+    -------
+    >>> t1 = T1()
+    >>> enable_background_analysis(t1)
+    >>> future = t1.run(delays, qu_ids=["q0"])  # returns once the data is saved
+    >>> ...  # queue the next measurement
+    >>> anal_res = future.result()  # or wait_for_analyses()
+    """
+    handler_cls = type(handler)
+    analyze = handler.analyze
+    before_analyze = getattr(analyze, "before_analyze", None)
+
+    def analyze_in_background(path, *args, **kwargs):
+        if before_analyze is not None:
+            before_analyze(path)
+        kwargs = {k: v for k, v in kwargs.items() if k != "qpu"}
+        future = get_executor(max_workers).submit(
+            _analyze_run,
+            handler_cls.__module__,
+            handler_cls.__qualname__,
+            path,
+            args,
+            kwargs,
+        )
+        analysis_future = AnalysisFuture(
+            future,
+            handler,
+            path,
+            kwargs.get("update_params", True),
+            fallback=lambda: analyze(path, *args, **kwargs),
+            qpu_owner=qpu_owner,
+        )
+        _pending.append(analysis_future)
+        return analysis_future
+
+    run = handler.run
+
+    def run_after_collecting(*args, **kwargs):
+        collect_done_analyses(handler)
+        return run(*args, **kwargs)
+
+    if not getattr(analyze, "in_background", False):
+        analyze_in_background.in_background = True
+        analyze_in_background.before_analyze = before_analyze
+        handler.analyze = analyze_in_background
+        handler.run = run_after_collecting
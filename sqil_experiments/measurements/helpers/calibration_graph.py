@@ -0,0 +1,346 @@
+"""Calibration graph that reruns a calibration only when it is out of date.
+
+Every node of the graph is an experiment that produces some QPU parameters (e.g.
+qu_spec produces ``resonance_frequency_ge``) and consumes others. Nodes are ordered
+by their dependencies and, when a target is requested, each of its ancestors is
+rerun only if it is stale:
+
+- it never ran, or its previous run failed;
+- its last run is older than its time to live (TTL);
+- one of the parameters it consumes changed since its last run, e.g. because an
+  upstream node was rerun or because of the outer sweep;
+- its validity check fails.
+
+Otherwise the parameters already on the QPU are used as they are. If the pool has a
+CompilePipeline, the next stale node is compiled while the current one runs, as long
+as it does not consume the parameters the current one produces. In a chain every
+node usually consumes what the previous one produces, so ``run`` also takes the
+values of the next point of the outer sweep: while the target acquires, the first
+node that the next point makes stale is compiled with those values.
+"""
+
+from __future__ import annotations
+
+import itertools
+import time
+from collections.abc import Callable
+
+import numpy as np
+
+# Sweep keys that do not change the state of the device
+PASSIVE_SWEEP_KEYS = ("index",)
+
+
+def _same_value(a, b, tolerance: float = 0) -> bool:
+    if a is None or b is None:
+        return a is b
+    try:
+        if tolerance:
+            return bool(np.all(np.abs(np.asarray(a) - np.asarray(b)) <= tolerance))
+        return bool(np.array_equal(a, b, equal_nan=True))
+    except TypeError:
+        return a == b
+
+
+def finite_params(params: dict) -> bool:
+    """Default validity check, every produced parameter is finite and non-zero."""
+    for value in params.values():
+        try:
+            if value is None or not np.all(np.isfinite(value)) or np.all(value == 0):
+                return False
+        except TypeError:
+            continue
+    return True
+
+
+def within(low: float, high: float) -> Callable:
+    """Validity check, every produced parameter is finite and in [low, high]."""
+
+    def check(params: dict) -> bool:
+        return finite_params(params) and all(
+            low <= value <= high for value in params.values()
+        )
+
+    return check
+
+
+def sweep_consumes(sweeps: dict | None, tolerances: dict | None = None) -> dict:
+    """QPU parameters changed by the sweeps of a run, without the passive ones,
+    with their tolerance (0 if not given)."""
+    tolerances = tolerances or {}
+    return {
+        key: tolerances.get(key, 0)
+        for key in (sweeps or {})
+        if key not in PASSIVE_SWEEP_KEYS
+    }
+
+
+def next_sweep_point(sweeps: dict | None, params, qu_id: str = "q0") -> dict | None:
+    """Values of the sweeps at the point after the one the parameters are at, in
+    the order of the product of the sweeps, without the passive sweeps. None at the
+    last point or if the parameters are not on a point of the sweeps."""
+    sweeps = {
+        key: value[qu_id] if isinstance(value, dict) else value
+        for key, value in (sweeps or {}).items()
+        if key not in PASSIVE_SWEEP_KEYS
+    }
+    if not sweeps:
+        return None
+    current = [getattr(params, key, None) for key in sweeps]
+    points = itertools.product(*sweeps.values())
+    for point in points:
+        if all(_same_value(a, b) for a, b in zip(point, current)):
+            following = next(points, None)
+            return dict(zip(sweeps, following)) if following else None
+    return None
+
+
+class CalibrationNode:
+    """One experiment of a calibration graph.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the node, e.g. "qu_spec_ge".
+    handler_cls : type
+        ExperimentHandler class run by the node.
+    args : tuple, optional
+        Positional arguments of the run, e.g. the sweep values.
+    kwargs : dict, optional
+        Keyword arguments of the run, e.g. the options.
+    produces : list[str], optional
+        QPU parameters updated by the node.
+    consumes : list[str] | dict[str, float], optional
+        QPU parameters the node depends on. A dictionary gives the absolute change
+        of each of them that is tolerated before the node is rerun, by default any
+        change reruns it.
+    ttl : float, optional
+        Time in seconds after which the node is rerun, by default never. A TTL of 0
+        reruns the node every time.
+    check : Callable, optional
+        ``check(params)`` gets the current values of the produced parameters and
+        returns False if they are not valid anymore, by default ``finite_params``.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler_cls: type,
+        args: tuple = (),
+        kwargs: dict | None = None,
+        produces: list[str] | tuple = (),
+        consumes: list[str] | tuple | dict = (),
+        ttl: float = np.inf,
+        check: Callable | None = finite_params,
+    ):
+        self.name = name
+        self.handler_cls = handler_cls
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.produces = list(produces)
+        if not isinstance(consumes, dict):
+            consumes = {param: 0 for param in consumes}
+        self.consumes = dict(consumes)
+        self.ttl = ttl
+        self.check = check
+
+    def __repr__(self):
+        return (
+            f"CalibrationNode({self.name!r}, produces={self.produces}, "
+            f"consumes={list(self.consumes)}, ttl={self.ttl})"
+        )
+
+
+class CalibrationGraph:
+    """Calibration nodes of a qubit, run through a HandlerPool.
+
+    Nodes can be added again with new arguments, e.g. at every point of an adaptive
+    sweep, without losing the record of their last run.
+
+    Example
+    -------
+    >>> graph = CalibrationGraph(self.pool)
+    >>> graph.add(CalibrationNode(
+    ...     "qu_spec", QuSpec, (spec_params,), {"options": spec_options},
+    ...     produces=["resonance_frequency_ge"], ttl=600,
+    ... ))
+    >>> graph.add(CalibrationNode(
+    ...     "time_rabi", TimeRabi, (rabi_params,), {"options": rabi_options},
+    ...     produces=["ge_drive_length"], consumes=["resonance_frequency_ge"],
+    ... ))
+    >>> graph.run("time_rabi")  # qu_spec runs only if it is stale
+    """
+
+    def __init__(self, pool, qu_id: str = "q0"):
+        self.pool = pool
+        self.qu_id = qu_id
+        self.nodes: dict[str, CalibrationNode] = {}
+        # name -> (time of the last run, consumed values at the last run)
+        self._records: dict[str, tuple[float, dict]] = {}
+        self.runs: dict[str, int] = {}
+        self.skips: dict[str, int] = {}
+        # Node that failed in the last run, if any
+        self.failed: str | None = None
+
+    def add(self, node: CalibrationNode) -> CalibrationNode:
+        self.nodes[node.name] = node
+        return node
+
+    @property
+    def _params(self):
+        return self.pool.parent.qpu[self.qu_id].parameters
+
+    def _values(self, names) -> dict:
+        return {name: getattr(self._params, name, None) for name in names}
+
+    def producer_of(self, param: str) -> CalibrationNode | None:
+        for node in self.nodes.values():
+            if param in node.produces:
+                return node
+        return None
+
+    def order(self, target: str) -> list[CalibrationNode]:
+        """The target and its ancestors, sorted so that every node comes after the
+        nodes producing its inputs."""
+        ordered, visiting = [], set()
+
+        def visit(name):
+            if any(node.name == name for node in ordered):
+                return
+            if name in visiting:
+                raise ValueError(f"Calibration graph has a cycle through {name!r}")
+            visiting.add(name)
+            for param in self.nodes[name].consumes:
+                producer = self.producer_of(param)
+                if producer is not None and producer.name != name:
+                    visit(producer.name)
+            visiting.discard(name)
+            ordered.append(self.nodes[name])
+
+        visit(target)
+        return ordered
+
+    def stale_reason(self, name: str) -> str | None:
+        """Why the node must be rerun, or None if it is fresh."""
+        node = self.nodes[name]
+        record = self._records.get(name)
+        if record is None:
+            return "never run"
+        run_time, consumed = record
+        if time.time() - run_time >= node.ttl:
+            return "expired"
+        for param, value in self._values(node.consumes).items():
+            if not _same_value(value, consumed.get(param), node.consumes[param]):
+                return f"{param} changed"
+        if node.check is not None and not node.check(self._values(node.produces)):
+            return "check failed"
+        return None
+
+    def invalidate(self, name: str | None = None):
+        """Forces a node, or all the nodes, to rerun."""
+        if name is None:
+            self._records.clear()
+        else:
+            self._records.pop(name, None)
+
+    def _run_node(self, node: CalibrationNode):
+        consumed = self._values(node.consumes)
+        res = self.pool.run(node.handler_cls, *node.args, **node.kwargs)
+        self.runs[node.name] = self.runs.get(node.name, 0) + 1
+
+        updated = {}
+        if res is not None and hasattr(res, "updated_params"):
+            updated = res.updated_params.get(self.qu_id, {})
+        produced = {param: updated.get(param) for param in node.produces}
+        if not finite_params(produced):
+            self._records.pop(node.name, None)
+            return res, False
+        self._records[node.name] = (time.time(), consumed)
+        return res, True
+
+    def _prefetch_next(self, node: CalibrationNode, following: list):
+        """Compiles the next node that has to run in the background, if its inputs
+        do not depend on the node about to run."""
+        if getattr(self.pool, "pipeline", None) is None:
+            return
+        for next_node in following:
+            depends = set(next_node.consumes) & set(node.produces)
+            if not depends and self.stale_reason(next_node.name) is None:
+                # Skipped, look at the one after
+                continue
+            if not depends:
+                self.pool.prefetch(
+                    next_node.handler_cls, *next_node.args, **next_node.kwargs
+                )
+            return
+
+    def _prefetch_next_point(self, nodes: list, next_point: dict):
+        """Compiles in the background the first node that the values of the next
+        point of the sweep make stale, with the QPU parameters set to them."""
+        if getattr(self.pool, "pipeline", None) is None:
+            return
+        current = self._values(next_point)
+        for node in nodes:
+            changed = [
+                param
+                for param in node.consumes
+                if param in next_point
+                and not _same_value(
+                    next_point[param], current[param], node.consumes[param]
+                )
+            ]
+            if not changed:
+                continue
+            qubit = self.pool.parent.qpu[self.qu_id]
+            try:
+                qubit.update(**next_point)
+                self.pool.prefetch(node.handler_cls, *node.args, **node.kwargs)
+            finally:
+                qubit.update(**current)
+            return
+
+    def run(
+        self, target: str, force: bool = False, next_point: dict | None = None
+    ) -> dict:
+        """Brings the target up to date, rerunning only the stale nodes.
+
+        Parameters
+        ----------
+        target : str
+            Name of the node to bring up to date.
+        force : bool, optional
+            Rerun the target even if it is fresh, by default False.
+        next_point : dict, optional
+            Values of the next point of the outer sweep, see ``next_sweep_point``.
+            The node it makes stale is compiled while the target runs.
+
+        Returns
+        -------
+        dict
+            The results of the nodes that were run, by name. If a node fails to
+            produce its parameters, the run stops there and the nodes after it are
+            not in the dictionary. ``self.failed`` is then the name of that node.
+        """
+        self.failed = None
+        results = {}
+        nodes = self.order(target)
+        for i, node in enumerate(nodes):
+            reason = self.stale_reason(node.name)
+            if force and node.name == target:
+                reason = reason or "forced"
+            if reason is None:
+                self.skips[node.name] = self.skips.get(node.name, 0) + 1
+                continue
+            print(f"Calibration {node.name}: {reason}")
+            self._prefetch_next(node, nodes[i + 1 :])
+            if next_point and node.name == target:
+                self._prefetch_next_point(nodes, next_point)
+            res, ok = self._run_node(node)
+            results[node.name] = res
+            if not ok:
+                self.failed = node.name
+                break
+        return results
+
+    def __repr__(self):
+        return f"CalibrationGraph({list(self.nodes)}, runs={self.runs}, skips={self.skips})"
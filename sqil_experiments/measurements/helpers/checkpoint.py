@@ -0,0 +1,314 @@
+"""Checkpoints of outer-swept runs, to resume them after a crash.
+
+When an outer-swept run is interrupted (kernel crash, instrument timeout, ...) the
+data folder is tagged ``__interrupted__`` and holds the sweep points acquired so
+far. With checkpoints enabled, every run also keeps in its data folder:
+
+- ``checkpoint.json``: the handler, the sweep cursor (number of points done), the
+  total number of points and the child runs of every point, for the adaptive
+  experiments;
+- ``checkpoint_args.pkl``: the arguments of the run;
+- ``qpu_checkpoint.json``: the QPU at the last checkpoint, including the parameters
+  updated by the child runs.
+
+The checkpoint is written every time the handler builds the sequence of a new
+sweep point and at the end of the run. ``resume(path)`` reconnects to the
+instruments, restores the QPU and acquires the missing sweep points in the same
+``data.ddh5``. The number of points already saved is read from the data file. With
+several sweeps the last, incomplete row of the outermost sweep is acquired again.
+
+Example
+-------
+>>> t1_adaptive = T1Adaptive()
+>>> enable_checkpoints(t1_adaptive)
+>>> t1_adaptive.run(exp_params, sweeps={"current": currents}, options=options)
+>>> # ... the kernel crashes, restart it and run
+>>> resume(path)
+"""
+
+from __future__ import annotations
+
+import importlib
+import json
+import os
+import pickle
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+import h5py
+import numpy as np
+from laboneq import serializers
+
+from sqil_experiments.analysis.online import find_run_folder
+
+CHECKPOINT_FILENAME = "checkpoint.json"
+ARGS_FILENAME = "checkpoint_args.pkl"
+QPU_FILENAME = "qpu_checkpoint.json"
+
+
+def sweep_shape(sweeps: dict | None) -> tuple[int, ...]:
+    """Number of values of every sweep. Sweeps given per qubit must have the same
+    length for all the qubits."""
+    shape = []
+    for value in (sweeps or {}).values():
+        if isinstance(value, dict):
+            value = next(iter(value.values()))
+        shape.append(len(value))
+    return tuple(shape)
+
+
+def _slice_sweep(value, start: int):
+    if isinstance(value, dict):
+        return {qu_id: values[start:] for qu_id, values in value.items()}
+    return value[start:]
+
+
+def remaining_sweeps(sweeps: dict | None, n_done: int) -> tuple[dict | None, int]:
+    """Sweeps of the points left after the first n_done, and the number of points
+    to keep.
+
+    The points are the product of the sweeps, the first sweep being the outermost.
+    The remaining points start at the first incomplete row of the outermost sweep,
+    so that they are again a product of sweeps.
+    """
+    shape = sweep_shape(sweeps)
+    if not shape:
+        return None, 0
+    row_size = int(np.prod(shape[1:]))
+    first_row = n_done // row_size
+    keys = list(sweeps)
+    remaining = dict(sweeps)
+    remaining[keys[0]] = _slice_sweep(sweeps[keys[0]], first_row)
+    return remaining, first_row * row_size
+
+
+def _datasets(group: h5py.Group) -> dict:
+    datasets = {}
+    group.visititems(
+        lambda name, obj: (
+            datasets.update({name: obj}) if isinstance(obj, h5py.Dataset) else None
+        )
+    )
+    return datasets
+
+
+def saved_points(path: str) -> int:
+    """Number of sweep points saved in the data file of a run."""
+    data_path = os.path.join(path, "data.ddh5")
+    if not os.path.isfile(data_path):
+        return 0
+    with h5py.File(data_path, "r") as f:
+        if "data" not in f:
+            return 0
+        lengths = [len(ds) for ds in _datasets(f["data"]).values()]
+    return min(lengths, default=0)
+
+
+def _read_points(path: str, n_points: int) -> dict:
+    with h5py.File(os.path.join(path, "data.ddh5"), "r") as f:
+        return {name: ds[:n_points] for name, ds in _datasets(f["data"]).items()}
+
+
+@contextmanager
+def _append_to(path: str, n_keep: int):
+    """Makes the runs write their data in an existing folder instead of a new one,
+    keeping its first n_keep points."""
+    from sqil_core.experiment import _experiment
+
+    writer_cls = _experiment.DDH5Writer
+    data_path = Path(path, "data.ddh5")
+
+    class AppendingWriter(writer_cls):
+        def __init__(self, datadict, basedir=".", *args, name=None, **kwargs):
+            super().__init__(datadict, basedir, name=name, filepath=data_path)
+            if n_keep:
+                points = _read_points(path, n_keep)
+                names = [name for name, _ in self.datadict.data_items()]
+                self.datadict.add_data(**{k: points[k] for k in names})
+
+        def add_tag(self, tags):
+            tags = [tags] if isinstance(tags, str) else tags
+            for tag in tags:
+                if tag == "__complete__":
+                    Path(path, "__interrupted__.tag").unlink(missing_ok=True)
+                if not Path(path, f"{tag}.tag").exists():
+                    super().add_tag(tag)
+
+        def save_text(self, name, text):
+            with open(Path(path, name), "w", encoding="utf-8") as f:
+                f.write(text)
+
+    _experiment.DDH5Writer = AppendingWriter
+    try:
+        yield
+    finally:
+        _experiment.DDH5Writer = writer_cls
+
+
+class Checkpointer:
+    """Writes the checkpoints of the runs of a handler, see ``enable_checkpoints``."""
+
+    def __init__(self, handler, path: str | None = None, offset: int = 0):
+        self.handler = handler
+        # Set when resuming, the folder and the points done before this run
+        self.fixed_path = path
+        self.offset = offset
+        self.n_points: int | None = None
+        self.path: str | None = None
+        self.cursor = 0
+        self.children: list[dict] = []
+        self._run_args = None
+        self._n_calls = 0
+        self._n_child_runs = 0
+
+    def _new_run(self):
+        self._run_args = self.handler._run_args
+        self._n_calls = 0
+        self._n_child_runs = len(
+            getattr(getattr(self.handler, "pool", None), "runs", [])
+        )
+        self.path = self.fixed_path or find_run_folder(self.handler)
+        if self.fixed_path is None:
+            self.children = []
+            args, run_kwargs = self._run_args
+            self.n_points = int(np.prod(sweep_shape(run_kwargs.get("sweeps"))))
+            if self.path is not None:
+                try:
+                    with open(os.path.join(self.path, ARGS_FILENAME), "wb") as f:
+                        pickle.dump((args, run_kwargs), f)
+                except Exception as e:
+                    print(f"Cannot save the arguments of the run: {e}")
+
+    def _collect_children(self, point: int):
+        runs = getattr(getattr(self.handler, "pool", None), "runs", [])
+        for run in runs[self._n_child_runs :]:
+            self.children.append({"point": point, **run})
+        self._n_child_runs = len(runs)
+
+    def before_point(self):
+        if self.handler._run_args is not self._run_args:
+            self._new_run()
+        self._n_calls += 1
+        # The data of the previous points is already saved
+        self.cursor = self.offset + self._n_calls - 1
+        self._collect_children(self.cursor - 1)
+        self.save()
+
+    def after_run(self, path: str):
+        self.path = self.path or path
+        self.cursor = self.offset + self._n_calls
+        self._collect_children(self.cursor - 1)
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        handler_cls = type(self.handler)
+        state = {
+            "handler": f"{handler_cls.__module__}:{handler_cls.__qualname__}",
+            "exp_name": handler_cls.exp_name,
+            "cursor": self.cursor,
+            "n_points": self.n_points,
+            "complete": self.n_points is not None and self.cursor >= self.n_points,
+            "updated": datetime.now().isoformat(timespec="seconds"),
+            "children": self.children,
+        }
+        serializers.save(self.handler.qpu, os.path.join(self.path, QPU_FILENAME))
+        tmp_path = os.path.join(self.path, f"{CHECKPOINT_FILENAME}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, CHECKPOINT_FILENAME))
+
+
+def enable_checkpoints(handler, path: str | None = None, offset: int = 0):
+    """Writes a checkpoint in the data folder before every sweep point of the runs
+    of a handler and at the end of the run, and returns the Checkpointer."""
+    checkpointer = Checkpointer(handler, path, offset)
+    sequence = handler.sequence
+    analyze = handler.analyze
+
+    # The signature is used to save the arguments of the run
+    @wraps(sequence)
+    def sequence_with_checkpoint(*args, **kwargs):
+        checkpointer.before_point()
+        return sequence(*args, **kwargs)
+
+    def save_checkpoint(run_path):
+        checkpointer.after_run(run_path)
+        before_analyze = getattr(analyze, "before_analyze", None)
+        if before_analyze is not None:
+            before_analyze(run_path)
+
+    def analyze_with_checkpoint(run_path, *args, **kwargs):
+        checkpointer.after_run(run_path)
+        return analyze(run_path, *args, **kwargs)
+
+    # Also called by wrappers that replace analyze, e.g. background analysis
+    analyze_with_checkpoint.before_analyze = save_checkpoint
+    handler.sequence = sequence_with_checkpoint
+    handler.analyze = analyze_with_checkpoint
+    handler.checkpointer = checkpointer
+    return checkpointer
+
+
+def read_checkpoint(path: str) -> dict:
+    with open(os.path.join(path, CHECKPOINT_FILENAME)) as f:
+        return json.load(f)
+
+
+def resume(path: str, setup_path: str = "", emulation: bool = False):
+    """Acquires the missing sweep points of an interrupted run in its own folder,
+    then analyzes the whole run.
+
+    Parameters
+    ----------
+    path : str
+        Data folder of the interrupted run.
+    setup_path : str, optional
+        Setup file, by default the one in config.yaml.
+    emulation : bool, optional
+        Run in emulation mode, by default False.
+
+    Returns
+    -------
+    The result of the run, or None if the run was already complete.
+    """
+    state = read_checkpoint(path)
+    with open(os.path.join(path, ARGS_FILENAME), "rb") as f:
+        args, run_kwargs = pickle.load(f)
+    sweeps = run_kwargs.get("sweeps")
+    remaining, n_keep = remaining_sweeps(sweeps, saved_points(path))
+    complete = n_keep >= state["n_points"] if sweeps else state["complete"]
+    if complete:
+        print(f"{path} is already complete")
+        return None
+
+    module_name, qualname = state["handler"].split(":")
+    handler_cls = getattr(importlib.import_module(module_name), qualname)
+    qpu = serializers.load(os.path.join(path, QPU_FILENAME))
+    handler = handler_cls(setup_path=setup_path, emulation=emulation, qpu=qpu)
+    checkpointer = enable_checkpoints(handler, path=path, offset=n_keep)
+    checkpointer.n_points = state["n_points"]
+    checkpointer.children = [c for c in state["children"] if c["point"] < n_keep]
+
+    # The analysis needs the QPU from the start of the run
+    qpu_old_path = os.path.join(path, "qpu_old.json")
+    with open(qpu_old_path) as f:
+        qpu_old = f.read()
+    analyze = handler.analyze
+
+    def restore_qpu_and_analyze(run_path, *analyze_args, **analyze_kwargs):
+        with open(qpu_old_path, "w") as f:
+            f.write(qpu_old)
+        return analyze(run_path, *analyze_args, **analyze_kwargs)
+
+    restore_qpu_and_analyze.before_analyze = analyze.before_analyze
+    handler.analyze = restore_qpu_and_analyze
+
+    if n_keep == 0:
+        Path(path, "data.ddh5").unlink(missing_ok=True)
+    print(f"Resuming {path} from point {n_keep} of {state['n_points']}")
+    with _append_to(path, n_keep):
+        return handler.run(*args, **{**run_kwargs, "sweeps": remaining})
@@ -0,0 +1,231 @@
+"""Cache of compiled LabOne Q experiments.
+
+Handlers rebuild and compile their experiment at every run, even when the same
+sequence was compiled moments earlier (e.g. repeating a T1 for statistics). The
+compiled experiments are cached, keyed by a fingerprint of the DSL experiment and of
+the device setup. The serialized experiment contains the sweep values, the options
+(acquisition loop, averaging, ...) and the pulse and signal calibration taken from the
+qubit parameters, so any change in the DSL arguments or in the calibration gives a
+new key.
+
+Entries are kept in memory and the least recently used ones are spilled to disk,
+where they are removed by age once the folder exceeds its maximum size.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+
+from laboneq import serializers
+
+DEFAULT_MAX_ENTRIES = 16
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "sqil_experiments", "compiled"
+)
+DEFAULT_MAX_SIZE = 1024**3  # bytes
+
+# UIDs generated by global counters differ every time the same experiment is built.
+# The LabOne Q auto UIDs covered are pulses (p0), oscillators (osc_0), sections
+# created outside an experiment context (__section_0) and sweep parameters (par0).
+# "$ref" ids are local to the serialized document and are left as they are.
+AUTO_UID_PATTERN = re.compile(rb'"uid":"(p\d+|osc_\d+|__\w+?_\d+|par\d+)"')
+
+
+def _normalize_auto_uids(serialized: bytes) -> bytes:
+    """Replaces the auto generated UIDs by their order of appearance."""
+    uids = {}
+
+    def replace(match):
+        uid = uids.setdefault(match[1], len(uids))
+        return b'"uid":"<auto_%d>"' % uid
+
+    return AUTO_UID_PATTERN.sub(replace, serialized)
+
+
+def experiment_fingerprint(experiment, device_setup=None, compiler_settings=None):
+    """Returns the sha256 of an experiment, the device setup it is compiled for and
+    the compiler settings."""
+    sha = hashlib.sha256()
+    sha.update(_normalize_auto_uids(serializers.to_json(experiment)))
+    if device_setup is not None:
+        sha.update(_normalize_auto_uids(serializers.to_json(device_setup)))
+    sha.update(repr(sorted((compiler_settings or {}).items())).encode())
+    return sha.hexdigest()
+
+
+class CompiledExperimentCache:
+    """Least recently used cache of compiled experiments.
+
+    At most ``max_entries`` compiled experiments are kept in memory. Older entries
+    are serialized to ``cache_dir`` and loaded back on the next hit. The files in
+    ``cache_dir`` are removed by age once their total size exceeds ``max_size``
+    bytes. Set ``cache_dir=False`` to keep the cache in memory only.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        cache_dir: str | None = None,
+        max_size: int = DEFAULT_MAX_SIZE,
+    ):
+        self.max_entries = max_entries
+        self.cache_dir = (
+            None if cache_dir is False else Path(cache_dir or DEFAULT_CACHE_DIR)
+        )
+        self.max_size = max_size
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str):
+        compiled_exp = self._entries.get(key)
+        if compiled_exp is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return compiled_exp
+
+        compiled_exp = self._load(key)
+        if compiled_exp is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.disk_hits += 1
+        self._store(key, compiled_exp)
+        return compiled_exp
+
+    def put(self, key: str, compiled_exp):
+        self._entries.pop(key, None)
+        self._store(key, compiled_exp)
+
+    def _store(self, key: str, compiled_exp):
+        self._entries[key] = compiled_exp
+        while len(self._entries) > self.max_entries:
+            old_key, old = self._entries.popitem(last=False)
+            self._spill(old_key, old)
+
+    def _load(self, key: str):
+        if self.cache_dir is None:
+            return None
+        entry = self._entry_path(key)
+        try:
+            with open(entry, "rb") as f:
+                compiled_exp = serializers.from_json(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Corrupted entry or written by an incompatible LabOne Q version
+            entry.unlink(missing_ok=True)
+            return None
+        entry.unlink(missing_ok=True)
+        return compiled_exp
+
+    def _spill(self, key: str, compiled_exp):
+        if self.cache_dir is None:
+            return
+        try:
+            serialized = serializers.to_json(compiled_exp)
+        except Exception as e:
+            print(f"Compiled experiment not spilled to disk: {e}")
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry = self._entry_path(key)
+        tmp = entry.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(serialized)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        """Removes the oldest spilled entries until the folder fits max_size."""
+        if self.cache_dir is None or not self.cache_dir.exists():
+            return
+        entries = [(p, p.stat()) for p in self.cache_dir.glob("*.json")]
+        total = sum(st.st_size for _, st in entries)
+        for p, st in sorted(entries, key=lambda e: e[1].st_mtime):
+            if total <= self.max_size:
+                break
+            p.unlink(missing_ok=True)
+            total -= st.st_size
+
+    def clear(self):
+        self._entries.clear()
+        if self.cache_dir is not None:
+            for p in self.cache_dir.glob("*.json"):
+                p.unlink(missing_ok=True)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return (
+            f"CompiledExperimentCache({len(self)} in memory, hits={self.hits} "
+            f"({self.disk_hits} from disk), misses={self.misses})"
+        )
+
+
+_default_cache: CompiledExperimentCache | None = None
+
+
+def get_compile_cache() -> CompiledExperimentCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = CompiledExperimentCache(
+            cache_dir=os.environ.get("SQIL_COMPILE_CACHE_DIR")
+        )
+    return _default_cache
+
+
+class CachedCompileSession:
+    """Wraps a LabOne Q Session so that ``compile`` goes through a
+    CompiledExperimentCache. Everything else is forwarded to the session."""
+
+    def __init__(self, session, cache: CompiledExperimentCache | None = None):
+        self.session = session
+        self.cache = get_compile_cache() if cache is None else cache
+
+    def compile(self, experiment, compiler_settings: dict | None = None):
+        key = experiment_fingerprint(
+            experiment, self.session.device_setup, compiler_settings
+        )
+        compiled_exp = self.cache.get(key)
+        if compiled_exp is None:
+            compiled_exp = self.session.compile(
+                experiment, compiler_settings=compiler_settings
+            )
+            self.cache.put(key, compiled_exp)
+        return compiled_exp
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def enable_compile_cache(handler, cache: CompiledExperimentCache | None = None):
+    """Routes the compilations of an experiment handler through the compiled
+    experiment cache and returns the cache.
+
+    Example
+    -------
+    >>> t1 = T1()
+    >>> compile_cache = enable_compile_cache(t1)
+    >>> for _ in range(10):
+    ...     t1.run(delays, qu_ids=["q0"])  # compiled only once
+    >>> compile_cache
+    """
+    session = handler.zi_session
+    if isinstance(session, CachedCompileSession):
+        if cache is not None:
+            session.cache = cache
+        return session.cache
+    handler.zi_session = CachedCompileSession(session, cache)
+    return handler.zi_session.cache
@@ -0,0 +1,217 @@
+"""Compile the next experiment of a chain while the current one acquires.
+
+The experiments of an adaptive run are built, compiled, acquired and analyzed one
+after the other. Compiling is CPU bound and can run in a worker process while the
+instruments acquire, as long as the next experiment does not depend on parameters
+that the current one is about to fit.
+
+A CompilePipeline compiles experiments in a worker process ahead of time, keyed by
+their fingerprint (see ``compile_cache``). When the experiment is later compiled
+for real, a PipelinedSession looks for a prefetched compilation with the same
+fingerprint. If the experiment changed in the meantime, e.g. because a parameter it
+uses was updated by a fit, the fingerprints differ and the experiment is compiled
+again. Every compile and acquisition is recorded in a PipelineTrace, which reports
+how much of the compile time was hidden behind the acquisitions.
+"""
+
+from __future__ import annotations
+
+import importlib
+import json
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from laboneq import serializers
+
+from sqil_experiments.measurements.helpers.compile_cache import experiment_fingerprint
+
+
+def _import_modules(module_names: list[str]):
+    """Worker initializer, imports the modules that register pulse functionals."""
+    for name in module_names:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"Error importing {name} in the compile worker: {e}")
+
+
+def _compile_in_worker(experiment_json, device_setup_json, compiler_settings):
+    from laboneq.simple import Session
+
+    start = time.time()
+    session = Session(serializers.from_json(device_setup_json))
+    compiled_exp = session.compile(
+        serializers.from_json(experiment_json), compiler_settings=compiler_settings
+    )
+    return serializers.to_json(compiled_exp), start, time.time()
+
+
+class PipelineTrace:
+    """Time intervals of the compilations and acquisitions of a pipeline.
+
+    Each event is a dict with ``label``, ``kind`` ("compile", "prefetch" or
+    "acquire"), ``start`` and ``end`` (seconds since the epoch).
+    """
+
+    def __init__(self):
+        self.events: list[dict] = []
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+
+    def add(self, label: str, kind: str, start: float, end: float):
+        self.events.append({"label": label, "kind": kind, "start": start, "end": end})
+
+    def _total(self, kind: str) -> float:
+        return sum(e["end"] - e["start"] for e in self.events if e["kind"] == kind)
+
+    def overlap(self) -> float:
+        """Time in seconds during which a prefetch compiled while acquiring."""
+        acquisitions = [e for e in self.events if e["kind"] == "acquire"]
+        total = 0.0
+        for e in self.events:
+            if e["kind"] != "prefetch":
+                continue
+            for a in acquisitions:
+                total += max(0.0, min(e["end"], a["end"]) - max(e["start"], a["start"]))
+        return total
+
+    def summary(self) -> dict:
+        prefetch = self._total("prefetch")
+        overlap = self.overlap()
+        return {
+            "compile_s": self._total("compile"),
+            "prefetch_s": prefetch,
+            "acquire_s": self._total("acquire"),
+            "overlap_s": overlap,
+            "overlap_fraction": overlap / prefetch if prefetch else 0.0,
+            "prefetch_hits": self.prefetch_hits,
+            "prefetch_misses": self.prefetch_misses,
+        }
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "events": self.events}, f, indent=2)
+
+    def __repr__(self):
+        s = self.summary()
+        return (
+            f"PipelineTrace(compile {s['compile_s']:.2f} s in foreground, "
+            f"{s['prefetch_s']:.2f} s prefetched, {s['overlap_s']:.2f} s hidden "
+            f"behind {s['acquire_s']:.2f} s of acquisition, "
+            f"{s['prefetch_hits']} hits, {s['prefetch_misses']} misses)"
+        )
+
+
+class CompilePipeline:
+    """Compiles experiments ahead of time in a worker process.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of worker processes, by default 1.
+    """
+
+    def __init__(self, max_workers: int = 1):
+        self.max_workers = max_workers
+        self.trace = PipelineTrace()
+        self._executor: ProcessPoolExecutor | None = None
+        # fingerprint -> (future, label)
+        self._pending: dict[str, tuple[Future, str]] = {}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Custom pulses must be registered in the worker to load the experiments
+            modules = [name for name in sys.modules if name.startswith("sqil_")]
+            self._executor = ProcessPoolExecutor(
+                self.max_workers, initializer=_import_modules, initargs=(modules,)
+            )
+        return self._executor
+
+    def prefetch(self, session, experiment, compiler_settings=None, label=""):
+        """Starts compiling an experiment in the background."""
+        device_setup = session.device_setup
+        key = experiment_fingerprint(experiment, device_setup, compiler_settings)
+        if key in self._pending:
+            return key
+        future = self._get_executor().submit(
+            _compile_in_worker,
+            serializers.to_json(experiment),
+            serializers.to_json(device_setup),
+            compiler_settings,
+        )
+        self._pending[key] = (future, label)
+        return key
+
+    def take(self, key: str):
+        """The compiled experiment prefetched with this fingerprint, or None."""
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return None
+        future, label = pending
+        try:
+            compiled_json, start, end = future.result()
+        except Exception as e:
+            print(f"Error compiling {label} in the background: {e}")
+            return None
+        self.trace.add(label, "prefetch", start, end)
+        return serializers.from_json(compiled_json)
+
+    def close(self):
+        # Prefetched experiments that were never used
+        for future, label in self._pending.values():
+            future.cancel()
+            self.trace.prefetch_misses += 1
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PipelinedSession:
+    """Wraps a LabOne Q Session so that ``compile`` uses the experiments prefetched
+    by a CompilePipeline and every compile and run is traced. Everything else is
+    forwarded to the session."""
+
+    def __init__(self, session, pipeline: CompilePipeline, label: str = ""):
+        self.session = session
+        self.pipeline = pipeline
+        self.label = label
+
+    def compile(self, experiment, compiler_settings: dict | None = None, **kwargs):
+        trace = self.pipeline.trace
+        if self.pipeline._pending:
+            key = experiment_fingerprint(
+                experiment, self.session.device_setup, compiler_settings
+            )
+            compiled_exp = self.pipeline.take(key)
+            if compiled_exp is not None:
+                trace.prefetch_hits += 1
+                return compiled_exp
+        start = time.time()
+        compiled_exp = self.session.compile(
+            experiment, compiler_settings=compiler_settings, **kwargs
+        )
+        trace.add(self.label, "compile", start, time.time())
+        return compiled_exp
+
+    def prefetch(self, experiment, compiler_settings: dict | None = None):
+        return self.pipeline.prefetch(
+            self.session, experiment, compiler_settings, label=self.label
+        )
+
+    def run(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.session.run(*args, **kwargs)
+        finally:
+            self.pipeline.trace.add(self.label, "acquire", start, time.time())
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
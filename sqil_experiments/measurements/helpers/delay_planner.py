@@ -0,0 +1,283 @@
+"""Delay grids that minimize the expected variance of a fitted decay time.
+
+For a model y(t; theta) with Gaussian noise, the covariance of the fitted parameters
+is the inverse of the Fisher information F = sum_i g(t_i) g(t_i)^T, where g is the
+gradient of the model with respect to the parameters. The planner picks, from a fine
+grid of candidate delays, the n points that minimize the relative variance of tau,
+[F^-1]_tau,tau / tau^2, averaged over a log-normal prior on tau (Bayesian c-optimal
+design). The prior keeps the design robust when the current estimate of tau is off,
+and can be narrowed as the estimate improves, e.g. between repetitions.
+
+The points are chosen greedily and then improved by exchanging one point at a time,
+with rank-one updates of F^-1 evaluated for all the candidates at once. Left alone,
+the design collapses on a few clusters of points, which is optimal only if the
+model and the prior are exact. Two selected delays are therefore at least half the
+mean spacing apart, and the decay designs keep a log-spaced backbone of delays.
+
+Over a true tau between T/3 and 3T, T being the estimate, the 22 linear and log
+delays used by the adaptive experiments still give a smaller error than 22 planned
+ones when tau is below T/2, so the planned delays are opt-in (``plan_delays``)
+and the adaptive experiments use ``default_decay_delays``.
+"""
+
+from __future__ import annotations
+
+from functools import lru_cache
+
+import numpy as np
+from scipy.stats import norm
+
+DEFAULT_N_POINTS = 16
+# Standard deviation of log(tau) of the prior
+DEFAULT_PRIOR_WIDTH = 0.5
+# Longest delay, in units of the current tau estimate
+DEFAULT_MAX_DELAY_FACTOR = 5
+N_CANDIDATES = 400
+# Minimum number of candidates per period of the Ramsey oscillations
+CANDIDATES_PER_PERIOD = 20
+# Minimum distance between two delays, in units of the mean spacing
+MIN_SPACING = 0.5
+# Number of log-spaced delays, from tau / 4 to the longest delay, plus t = 0
+N_BACKBONE = 6
+N_PRIOR_SAMPLES = 16
+MAX_EXCHANGE_SWEEPS = 20
+RIDGE = 1e-9
+
+
+def _decay_gradient(t, tau):
+    """Gradient of A exp(-t / tau) + y0 with respect to (A, log tau, y0), A = 1."""
+    decay = np.exp(-t / tau)
+    return np.stack([decay, t / tau * decay, np.ones_like(t)], axis=-1)
+
+
+def _ramsey_gradient(t, tau, detuning, phi=0.0):
+    """Gradient of A exp(-t / tau) cos(2 pi f t + phi) + y0 with respect to
+    (A, log tau, y0, phi, log f), A = 1."""
+    decay = np.exp(-t / tau)
+    phase = 2 * np.pi * detuning * t + phi
+    cos, sin = decay * np.cos(phase), decay * np.sin(phase)
+    return np.stack(
+        [cos, t / tau * cos, np.ones_like(t), -sin, -2 * np.pi * detuning * t * sin],
+        axis=-1,
+    )
+
+
+def _prior_samples(tau, prior_width, n_samples=N_PRIOR_SAMPLES):
+    """Equally spaced quantiles of the log-normal prior on tau."""
+    if prior_width <= 0:
+        return np.array([tau])
+    z = norm.ppf((np.arange(n_samples) + 0.5) / n_samples)
+    return tau * np.exp(prior_width * z)
+
+
+def _pair_products(grads):
+    """g_p g_q for every candidate and every pair p <= q, shape (S, M, P(P+1)/2)."""
+    p, q = np.triu_indices(grads.shape[-1])
+    return grads[..., p] * grads[..., q]
+
+
+def _target_variance(f_inv, grads, pairs, target):
+    """[ (F + g g^T)^-1 ]_target for every candidate g, with Sherman-Morrison.
+
+    f_inv has shape (S, P, P), grads (S, M, P) and pairs the output of
+    ``_pair_products``, the result is (S, M).
+    """
+    n_params = f_inv.shape[-1]
+    p, q = np.triu_indices(n_params)
+    # g^T F^-1 g as a dot product with the upper triangle of F^-1
+    weights = np.where(p == q, 1.0, 2.0) * f_inv[:, p, q]
+    denominator = 1 + (pairs @ weights[..., None])[..., 0]
+    # (F^-1 g)_target, F^-1 is symmetric
+    u = (grads @ f_inv[:, :, target, None])[..., 0]
+    return f_inv[:, target, target][:, None] - u**2 / denominator
+
+
+def _information_inverse(grads, selected):
+    n_params = grads.shape[-1]
+    g = grads[:, selected, :]
+    info = np.swapaxes(g, 1, 2) @ g + RIDGE * np.eye(n_params)
+    return np.linalg.inv(info)
+
+
+def _design_cost(grads, pairs, others, target, min_gap):
+    """Mean variance of the target after adding each candidate to others, infinite
+    for the candidates closer than min_gap to one of them."""
+    f_inv = _information_inverse(grads, others)
+    cost = _target_variance(f_inv, grads, pairs, target).mean(axis=0)
+    for i in others:
+        cost[max(0, i - min_gap + 1) : i + min_gap] = np.inf
+    return cost
+
+
+def optimal_design(
+    grads, n_points: int, target: int = 1, min_gap: int = 1, fixed=()
+) -> np.ndarray:
+    """Selects n_points candidates minimizing the mean variance of a parameter.
+
+    Parameters
+    ----------
+    grads : np.ndarray
+        Model gradient at every candidate, for every prior sample, shape (S, M, P).
+    n_points : int
+        Number of candidates to select, without repetitions.
+    target : int, optional
+        Index of the parameter whose variance is minimized, by default 1.
+    min_gap : int, optional
+        Minimum distance between two selected candidates, in number of candidates,
+        by default 1. Keeps the design from collapsing on a few clusters of
+        points, which is optimal only if the model and the prior are exact.
+    fixed : list[int], optional
+        Candidates that are always selected, e.g. a log-spaced backbone. They count
+        in n_points.
+
+    Returns
+    -------
+    np.ndarray
+        Sorted indices of the selected candidates.
+    """
+    n_candidates = grads.shape[1]
+    n_points = min(n_points, n_candidates)
+    min_gap = max(min_gap, 1)
+    pairs = _pair_products(grads)
+    selected = list(dict.fromkeys(int(i) for i in fixed))[:n_points]
+    n_fixed = len(selected)
+    # Greedy forward selection
+    while len(selected) < n_points:
+        cost = _design_cost(grads, pairs, selected, target, min_gap)
+        if not np.isfinite(cost).any():
+            break
+        selected.append(int(np.argmin(cost)))
+
+    # Exchange one point at a time while the design improves
+    best = _information_inverse(grads, selected)[:, target, target].mean()
+    for _ in range(MAX_EXCHANGE_SWEEPS):
+        improved = False
+        for i in range(n_fixed, len(selected)):
+            others = selected[:i] + selected[i + 1 :]
+            cost = _design_cost(grads, pairs, others, target, min_gap)
+            j = int(np.argmin(cost))
+            if cost[j] < best * (1 - 1e-9) and j != selected[i]:
+                selected[i], best, improved = j, cost[j], True
+        if not improved:
+            break
+    return np.sort(selected)
+
+
+def _min_gap(n_candidates: int, n_points: int) -> int:
+    return max(1, int(MIN_SPACING * n_candidates / n_points))
+
+
+def _log_backbone(candidates, tau, n_points=N_BACKBONE) -> list[int]:
+    """Indices of the candidates closest to 0 and to log-spaced delays from tau / 4
+    to the longest candidate."""
+    if n_points < 2:
+        return []
+    delays = np.concatenate([[0], np.geomspace(tau / 4, candidates[-1], n_points - 1)])
+    return [int(np.argmin(np.abs(candidates - delay))) for delay in delays]
+
+
+def relative_tau_std(delays, tau: float, snr: float = 1.0) -> float:
+    """Expected relative standard error of tau, for a decay of amplitude 1 and
+    measurement noise 1 / snr on every point."""
+    grads = _decay_gradient(np.asarray(delays, dtype=float), tau)
+    info = grads.T @ grads + RIDGE * np.eye(grads.shape[-1])
+    return float(np.sqrt(np.linalg.inv(info)[1, 1])) / snr
+
+
+def default_decay_delays(tau: float, n_points: int = 11) -> np.ndarray:
+    """Delays used by the adaptive T1 and echo experiments, n_points linear up to tau
+    and n_points logarithmic from 1.1 * tau to 5 * tau."""
+    return np.hstack(
+        [
+            np.linspace(0, tau, n_points),
+            np.logspace(np.log(1.1 * tau), np.log(5 * tau), n_points, base=np.e),
+        ]
+    )
+
+
+def plan_decay_delays(
+    tau: float,
+    n_points: int = DEFAULT_N_POINTS,
+    prior_width: float = DEFAULT_PRIOR_WIDTH,
+    max_delay: float | None = None,
+) -> np.ndarray:
+    """Delays for a T1 or echo experiment, y = A exp(-t / tau) + y0.
+
+    Parameters
+    ----------
+    tau : float
+        Current estimate of the decay time.
+    n_points : int, optional
+        Number of delays, by default 16.
+    prior_width : float, optional
+        Uncertainty on the estimate, as standard deviation of log(tau), by default
+        0.5. Use a smaller value once tau is known better.
+    max_delay : float, optional
+        Longest delay, by default 5 * tau.
+
+    Returns
+    -------
+    np.ndarray
+        Sorted delays.
+    """
+    max_delay = max_delay or DEFAULT_MAX_DELAY_FACTOR * tau
+    candidates = np.linspace(0, max_delay, N_CANDIDATES)
+    taus = _prior_samples(tau, prior_width)
+    grads = np.stack([_decay_gradient(candidates, t) for t in taus])
+    selected = optimal_design(
+        grads,
+        n_points,
+        min_gap=_min_gap(N_CANDIDATES, n_points),
+        fixed=_log_backbone(candidates, tau, min(N_BACKBONE, n_points // 2)),
+    )
+    return candidates[selected]
+
+
+def plan_ramsey_delays(
+    tau: float,
+    detuning: float,
+    n_points: int = 2 * DEFAULT_N_POINTS,
+    prior_width: float = DEFAULT_PRIOR_WIDTH,
+    max_delay: float | None = None,
+) -> np.ndarray:
+    """Delays for a Ramsey experiment, y = A exp(-t / tau) cos(2 pi f t + phi) + y0,
+    where f is the detuning. The variance of tau is minimized, with the frequency
+    and the phase fitted as nuisance parameters. The plans are cached, since they
+    take up to a few seconds for long delays and large detunings."""
+    max_delay = max_delay or DEFAULT_MAX_DELAY_FACTOR * tau
+    return np.array(
+        _plan_ramsey_delays(
+            float(tau), float(detuning), int(n_points), float(prior_width), max_delay
+        )
+    )
+
+
+@lru_cache(maxsize=64)
+def _plan_ramsey_delays(tau, detuning, n_points, prior_width, max_delay) -> tuple:
+    n_candidates = max(
+        N_CANDIDATES, int(CANDIDATES_PER_PERIOD * max_delay * abs(detuning))
+    )
+    candidates = np.linspace(0, max_delay, n_candidates)
+    taus = _prior_samples(tau, prior_width)
+    grads = np.stack([_ramsey_gradient(candidates, t, detuning) for t in taus])
+    selected = optimal_design(grads, n_points, min_gap=_min_gap(n_candidates, n_points))
+    return tuple(candidates[selected])
+
+
+def refine_decay_delays(
+    x,
+    y,
+    n_points: int = DEFAULT_N_POINTS,
+    prior_width: float = DEFAULT_PRIOR_WIDTH / 2,
+    max_delay: float | None = None,
+) -> np.ndarray:
+    """Plans the delays of the next repetition from the projected data (x, y) of the
+    previous one, with a narrower prior centered on the decay time estimated from
+    it."""
+    from sqil_experiments.analysis.estimators import estimate_decaying_exp
+
+    tau = estimate_decaying_exp(np.asarray(x), np.asarray(y))[1]
+    if tau is None or not np.isfinite(tau) or tau <= 0:
+        # No decay found, keep the range of the previous grid
+        tau, prior_width = np.ptp(x) / DEFAULT_MAX_DELAY_FACTOR, DEFAULT_PRIOR_WIDTH
+    return plan_decay_delays(tau, n_points, prior_width, max_delay)
@@ -0,0 +1,210 @@
+"""Wall time and data volume of an experiment, estimated without hardware.
+
+``dry_run`` builds the experiment of a handler from the QPU in the database, without
+connecting to the instruments:
+
+- LabOne Q experiments are compiled for the device setup of the setup file and the
+  real-time duration is read from the compiled schedule. It includes the count,
+  the sweeps, the pulse lengths, the reset delays and the repetition time. The
+  first and last points of the outer sweeps are compiled, since the outer sweeps
+  can change the timing (e.g. a swept ``reset_delay_length``).
+- CW experiments are estimated from the number of VNA points, the averages and the
+  bandwidth of the readout.
+
+The time spent outside of the real-time schedule (compilation, upload, data
+saving, ...) is learned from the previous runs of the same experiment, see
+``record_run``. Until there is such a record, the compilation time of the dry run
+is used as overhead.
+
+Example
+-------
+>>> estimate = dry_run(T1, [time], options=options, sweeps={"current": currents})
+>>> print(format_estimate(estimate))
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from laboneq.dsl.enums import AveragingMode
+from laboneq.dsl.experiment import Acquire, AcquireLoopRt, Sweep
+from laboneq.simple import Experiment as LaboneQExperiment
+from laboneq.simple import Session
+from sqil_core.experiment import ExperimentHandler
+
+from sqil_experiments.measurements.helpers.checkpoint import sweep_shape
+from sqil_experiments.measurements.helpers.early_stopping import _acquire_loops
+
+OVERHEADS_FILENAME = "overheads.json"
+# Overheads kept per exp_name
+OVERHEAD_HISTORY = 20
+BYTES_PER_VALUE = 16  # complex128
+
+
+def offline_handler(handler_cls: type, setup_path: str = "") -> ExperimentHandler:
+    """Creates a handler with the QPU of the database and, if the setup has Zurich
+    Instruments, a LabOne Q session that compiles without being connected."""
+    # Skip the __init__ of the subclass, some don't accept no_instruments
+    handler = handler_cls.__new__(handler_cls)
+    ExperimentHandler.__init__(handler, setup_path=setup_path, no_instruments=True)
+    for config in handler.setup.get("instruments", {}).values():
+        if config.get("type") == "ZI" and config.get("generate_setup"):
+            handler.zi_setup = config["generate_setup"]()
+            handler.zi_session = Session(handler.zi_setup, log_level=logging.WARN)
+            handler.is_zi_exp = True
+    return handler
+
+
+def acquired_values(sections, multiplier: int = 1) -> int:
+    """Number of values acquired by one run of the real-time part of an experiment.
+    Single-shot acquisitions count every shot."""
+    total = 0
+    for section in sections:
+        if isinstance(section, Acquire):
+            total += multiplier
+            continue
+        section_multiplier = multiplier
+        if isinstance(section, Sweep) and section.parameters:
+            section_multiplier *= len(section.parameters[0].values)
+        if (
+            isinstance(section, AcquireLoopRt)
+            and section.averaging_mode == AveragingMode.SINGLE_SHOT
+        ):
+            section_multiplier *= section.count
+        total += acquired_values(getattr(section, "children", []), section_multiplier)
+    return total
+
+
+def _sweep_point(sweeps: dict, qu_ids: list, index: int) -> dict:
+    """QPU parameters of the first (index=0) or last (index=-1) outer sweep point."""
+    point = {qu_id: {} for qu_id in qu_ids}
+    for key, values in sweeps.items():
+        for qu_id in qu_ids:
+            qu_values = values[qu_id] if isinstance(values, dict) else values
+            point[qu_id][key] = qu_values[index]
+    return point
+
+
+def _compile_point(handler, args, run_kwargs) -> dict:
+    experiment = handler.sequence(*args, **run_kwargs)
+    if not isinstance(experiment, LaboneQExperiment):
+        raise TypeError(f"{handler.exp_name} does not build a LabOne Q experiment")
+    start = time.perf_counter()
+    compiled_exp = handler.zi_session.compile(experiment)
+    loops = list(_acquire_loops(experiment.sections))
+    return {
+        "realtime_s": float(compiled_exp.estimated_runtime),
+        "compile_s": time.perf_counter() - start,
+        "count": loops[0].count if loops else 1,
+        "values": acquired_values(experiment.sections),
+    }
+
+
+def _cw_point(handler, args, qu_ids) -> dict:
+    params = handler.qpu[qu_ids[0]].parameters
+    bandwidth = getattr(params, "readout_acquire_bandwith", None)
+    if not bandwidth:
+        raise TypeError(f"{handler.exp_name} has no LabOne Q or VNA parameters")
+    averages = getattr(params, "readout_acquire_averages", 1) or 1
+    n_values = int(np.size(args[0])) if args else 1
+    return {
+        "realtime_s": n_values * averages / bandwidth,
+        "compile_s": 0.0,
+        "count": averages,
+        "values": n_values,
+    }
+
+
+def overheads_path(handler) -> str:
+    db_path_local = handler.setup["storage"]["db_path_local"]
+    return os.path.join(db_path_local, "utils", OVERHEADS_FILENAME)
+
+
+def load_overheads(path: str) -> dict:
+    """Overheads per sweep point of the previous runs, by exp_name."""
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def record_run(estimate: dict, wall_s: float):
+    """Records the time a run took beyond its real-time schedule, to estimate the
+    overhead of the next runs of the same experiment."""
+    path = estimate["overheads_path"]
+    overheads = load_overheads(path)
+    overhead = max(0.0, wall_s / estimate["n_points"] - estimate["realtime_s"])
+    history = overheads.setdefault(estimate["exp_name"], [])
+    history.append(overhead)
+    del history[:-OVERHEAD_HISTORY]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(overheads, f, indent=2)
+
+
+def dry_run(
+    handler_cls: type, *args, qu_ids=None, setup_path: str = "", **kwargs
+) -> dict:
+    """Estimates the wall time and data volume of ``handler.run(*args, **kwargs)``.
+
+    Returns
+    -------
+    dict
+        - ``n_points``: number of outer sweep points;
+        - ``count``: averages (or shots) per point;
+        - ``shot_s``: real-time duration of one average of the sequence;
+        - ``realtime_s``: real-time duration of one point;
+        - ``compile_s``: compilation time of one point in the dry run;
+        - ``overhead_s``: estimated overhead per point, from the previous runs;
+        - ``wall_s``: estimated duration of the whole run;
+        - ``data_bytes``: estimated size of the acquired data.
+    """
+    handler = offline_handler(handler_cls, setup_path)
+    qu_ids = list(np.atleast_1d(qu_ids if qu_ids is not None else ["q0"]))
+    run_kwargs = {**kwargs, "qu_ids": qu_ids, "pulse_sheet": False}
+    sweeps = kwargs.get("sweeps") or {}
+    n_points = int(np.prod(sweep_shape(sweeps)))
+
+    points = []
+    for index in [0, -1] if n_points > 1 else [0]:
+        for qu_id, params in _sweep_point(sweeps, qu_ids, index).items():
+            handler.qpu[qu_id].update(**params)
+        if handler.is_zi_exp:
+            points.append(_compile_point(handler, args, run_kwargs))
+        else:
+            points.append(_cw_point(handler, args, qu_ids))
+    realtime_s = float(np.mean([p["realtime_s"] for p in points]))
+    compile_s = float(np.mean([p["compile_s"] for p in points]))
+    count = points[0]["count"]
+
+    path = overheads_path(handler)
+    history = load_overheads(path).get(handler_cls.exp_name)
+    overhead_s = float(np.median(history)) if history else compile_s
+    return {
+        "exp_name": handler_cls.exp_name,
+        "n_points": n_points,
+        "count": count,
+        "shot_s": realtime_s / count,
+        "realtime_s": realtime_s,
+        "compile_s": compile_s,
+        "overhead_s": overhead_s,
+        "overhead_from_history": bool(history),
+        "wall_s": n_points * (realtime_s + overhead_s),
+        "data_bytes": n_points * points[0]["values"] * BYTES_PER_VALUE,
+        "overheads_path": path,
+    }
+
+
+def format_estimate(estimate: dict) -> str:
+    overhead_source = "past runs" if estimate["overhead_from_history"] else "compile"
+    return (
+        f"{estimate['exp_name']}: {estimate['n_points']} points x "
+        f"({estimate['realtime_s']:.3g} s real time + {estimate['overhead_s']:.3g} s "
+        f"overhead from {overhead_source}) = {estimate['wall_s'] / 60:.1f} min, "
+        f"{estimate['data_bytes'] / 1e6:.3g} MB, "
+        f"{estimate['count']} x {estimate['shot_s'] * 1e6:.3g} us per average"
+    )
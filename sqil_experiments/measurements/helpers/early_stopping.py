@@ -0,0 +1,292 @@
+"""Chunked acquisition that stops as soon as the data is good enough.
+
+The number of shots of an experiment is fixed by the count of its real-time acquire
+loop. An EarlyStoppingSession compiles the experiment with the count split into
+equal chunks, runs the chunks back to back and keeps the running mean and variance
+of every result handle. It stops as soon as a target signal-to-noise ratio or a
+target uncertainty on a fitted parameter is reached, or when the requested count is
+exhausted. The results returned have the same handles as a normal run, plus a
+``<qubit>/shots/result`` handle with the number of shots actually averaged.
+"""
+
+from __future__ import annotations
+
+import copy
+import json
+import os
+import weakref
+from collections.abc import Callable
+
+import numpy as np
+from laboneq.dsl.enums import AveragingMode
+from laboneq.dsl.experiment import AcquireLoopRt
+from laboneq.dsl.result.results import Results
+
+from sqil_experiments.measurements.helpers.averaging import WelfordAccumulator
+
+DEFAULT_N_CHUNKS = 16
+# Chunks acquired before the stopping criteria are evaluated
+DEFAULT_MIN_CHUNKS = 3
+SHOTS_KEY = "shots"
+
+
+def _complex_median(x):
+    if np.iscomplexobj(x):
+        return np.median(x.real) + 1j * np.median(x.imag)
+    return np.median(x)
+
+
+def signal_to_noise(acc: WelfordAccumulator) -> float:
+    """Smallest signal-to-noise ratio over the handles of an accumulator.
+
+    The signal is the largest distance of a point from the median of the data, or
+    the magnitude of the data if it has a single point. The noise is the median
+    standard error of the mean.
+    """
+    snrs = []
+    for handle in acc.handles:
+        mean = np.asarray(acc.mean(handle))
+        if mean.size > 1:
+            signal = np.max(np.abs(mean - _complex_median(mean)))
+        else:
+            signal = np.max(np.abs(mean))
+        noise = np.median(acc.sem(handle))
+        snrs.append(signal / noise if noise > 0 else np.inf)
+    return float(min(snrs))
+
+
+def fit_uncertainty(
+    fit_func: Callable, x, param: int | str = 0, handle=None, project=np.abs
+) -> Callable:
+    """Uncertainty callback for EarlyStoppingSession based on a sqil_core fit.
+
+    Parameters
+    ----------
+    fit_func : Callable
+        Fit function, e.g. ``fit_lorentzian``, called as ``fit_func(x, y)``.
+    x : np.ndarray
+        Sweep values of the data.
+    param : int | str, optional
+        Index or name of the fitted parameter whose standard error is returned,
+        by default 0.
+    handle : str, optional
+        Result handle to fit, by default the first one.
+    project : Callable, optional
+        Applied to the data before the fit, by default np.abs.
+
+    Example
+    -------
+    >>> # Resonance frequency of a Lorentzian known to +-50 kHz
+    >>> uncertainty = fit_uncertainty(fit_lorentzian, frequencies, param=1)
+    >>> enable_early_stopping(rr_spec, target_std=50e3, uncertainty=uncertainty)
+    """
+
+    def uncertainty(means: dict) -> float:
+        y = means[handle] if handle is not None else next(iter(means.values()))
+        fit_res = fit_func(np.asarray(x), project(np.ravel(y)))
+        if isinstance(param, str):
+            param_idx = fit_res.param_names.index(param)
+        else:
+            param_idx = param
+        std_err = fit_res.std_err
+        if std_err is None:
+            return np.inf
+        return float(std_err[param_idx])
+
+    return uncertainty
+
+
+def _acquire_loops(sections):
+    for section in sections:
+        if isinstance(section, AcquireLoopRt):
+            yield section
+        yield from _acquire_loops(getattr(section, "children", []))
+
+
+class EarlyStoppingSession:
+    """Wraps a LabOne Q Session to acquire averaged experiments in chunks and stop
+    early. Everything else is forwarded to the session.
+
+    Parameters
+    ----------
+    session : Session
+        The session to wrap, it can also be a CachedCompileSession.
+    n_chunks : int, optional
+        Number of chunks the count is split into, by default 16.
+    target_snr : float, optional
+        Stop when the signal-to-noise ratio of every handle reaches this value.
+    target_std : float, optional
+        Stop when ``uncertainty`` returns a value below this one.
+    uncertainty : Callable, optional
+        ``uncertainty(means)`` returns the uncertainty of the parameter of interest
+        given the mean data of every handle, see ``fit_uncertainty``.
+    min_chunks : int, optional
+        Chunks acquired before the criteria are evaluated, by default 3.
+
+    Only experiments with averaged acquisitions are chunked, single-shot ones are
+    run in one go. If no target is given, experiments are compiled and run
+    unchanged.
+    """
+
+    def __init__(
+        self,
+        session,
+        n_chunks: int = DEFAULT_N_CHUNKS,
+        target_snr: float | None = None,
+        target_std: float | None = None,
+        uncertainty: Callable | None = None,
+        min_chunks: int = DEFAULT_MIN_CHUNKS,
+    ):
+        if target_std is not None and uncertainty is None:
+            raise ValueError("target_std requires an uncertainty callback")
+        self.session = session
+        self.n_chunks = n_chunks
+        self.target_snr = target_snr
+        self.target_std = target_std
+        self.uncertainty = uncertainty
+        self.min_chunks = min_chunks
+        # Chunking of the compiled experiments, by id. The entries hold a weak
+        # reference and are removed when the compiled experiment is deleted.
+        self._plans: dict[int, tuple] = {}
+        # One record per run, with the shots actually acquired
+        self.records: list[dict] = []
+
+    def compile(self, experiment, compiler_settings: dict | None = None, **kwargs):
+        if self.target_snr is None and self.target_std is None:
+            return self.session.compile(
+                experiment, compiler_settings=compiler_settings, **kwargs
+            )
+        loops = list(_acquire_loops(experiment.sections))
+        count = loops[0].count if loops else 1
+        averaged = loops and all(
+            loop.averaging_mode != AveragingMode.SINGLE_SHOT for loop in loops
+        )
+        n_chunks = max(1, min(self.n_chunks, count)) if averaged else 1
+        chunk_count = count // n_chunks
+        if n_chunks > 1:
+            experiment = copy.deepcopy(experiment)
+            for loop in _acquire_loops(experiment.sections):
+                loop.count = chunk_count
+        compiled_exp = self.session.compile(
+            experiment, compiler_settings=compiler_settings, **kwargs
+        )
+        key = id(compiled_exp)
+        ref = weakref.ref(compiled_exp, lambda _: self._plans.pop(key, None))
+        self._plans[key] = (ref, count, chunk_count, n_chunks)
+        return compiled_exp
+
+    def _converged(self, acc: WelfordAccumulator) -> tuple[bool, dict]:
+        stats = {}
+        if acc.count < max(self.min_chunks, 2):
+            return False, stats
+        converged = False
+        if self.target_snr is not None:
+            stats["snr"] = signal_to_noise(acc)
+            converged |= stats["snr"] >= self.target_snr
+        if self.target_std is not None:
+            means = {handle: acc.mean(handle) for handle in acc.handles}
+            try:
+                stats["std"] = self.uncertainty(means)
+            except Exception as e:
+                print("Error evaluating the uncertainty", e)
+                stats["std"] = np.inf
+            converged |= stats["std"] <= self.target_std
+        return converged, stats
+
+    def run(self, compiled_experiment=None, **kwargs):
+        plan = self._plans.get(id(compiled_experiment))
+        if plan is None or plan[0]() is not compiled_experiment:
+            return self.session.run(compiled_experiment, **kwargs)
+        _, count, chunk_count, n_chunks = plan
+
+        acc, stats, converged = None, {}, False
+        while not converged and (acc is None or acc.count < n_chunks):
+            result = self.session.run(compiled_experiment, **kwargs)
+            if acc is None:
+                acc = WelfordAccumulator(result.acquired_results.keys())
+            acc.update({h: result.acquired_results[h].data for h in acc.handles})
+            converged, stats = self._converged(acc)
+
+        shots = acc.count * chunk_count
+        self.records.append(
+            {
+                "requested_shots": count,
+                "shots": shots,
+                "chunks": acc.count,
+                "chunk_shots": chunk_count,
+                "stopped_early": bool(converged),
+                **{k: float(v) for k, v in stats.items()},
+            }
+        )
+        return self._averaged_results(result, acc, shots)
+
+    @staticmethod
+    def _averaged_results(result: Results, acc: WelfordAccumulator, shots: int):
+        """Results of the last chunk with the data replaced by the running mean,
+        and the number of shots of every qubit under ``<qubit>/shots/result``."""
+        acquired_results = {}
+        for handle in acc.handles:
+            acquired = copy.copy(result.acquired_results[handle])
+            acquired.data = acc.mean(handle)
+            acquired_results[handle] = acquired
+            qu_id = handle.split("/")[0]
+            shots_handle = f"{qu_id}/{SHOTS_KEY}/result"
+            if shots_handle not in acquired_results:
+                shots_result = copy.copy(acquired)
+                shots_result.data = np.full(np.shape(acquired.data), shots)
+                shots_result.handle = shots_handle
+                acquired_results[shots_handle] = shots_result
+        return Results(
+            experiment=result.experiment,
+            device_setup=result.device_setup,
+            acquired_results=acquired_results,
+            neartime_callback_results=result.neartime_callback_results,
+            execution_errors=result.execution_errors,
+            pipeline_jobs_timestamps=result.pipeline_jobs_timestamps,
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def enable_early_stopping(handler, **kwargs) -> EarlyStoppingSession:
+    """Acquires the experiments of a handler in chunks that stop early, see
+    EarlyStoppingSession for the options, and returns the session.
+
+    The shots actually acquired are saved in the dataset as ``shots`` and in
+    ``acquisition.json`` in the data folder, together with the number of chunks
+    and the final SNR or uncertainty.
+
+    Example
+    -------
+    >>> rr_spec = RRSpec()
+    >>> enable_early_stopping(rr_spec, target_snr=20)
+    >>> rr_spec.run(frequencies, options=options)  # options.count = 2**15
+    """
+    session = handler.zi_session
+    if isinstance(session, EarlyStoppingSession):
+        session = session.session
+    handler.zi_session = EarlyStoppingSession(session, **kwargs)
+
+    # The shots field goes first, the analysis reads the last data field
+    if handler.is_zi_exp and SHOTS_KEY not in handler.db_schema:
+        handler.db_schema = {SHOTS_KEY: {"role": "data"}, **handler.db_schema}
+
+    analyze = handler.analyze
+
+    def save_records(path):
+        records = handler.zi_session.records
+        if records:
+            with open(os.path.join(path, "acquisition.json"), "w") as f:
+                json.dump(records, f, indent=2)
+            records.clear()
+
+    def analyze_and_save_records(path, *args, **analyze_kwargs):
+        save_records(path)
+        return analyze(path, *args, **analyze_kwargs)
+
+    if not getattr(analyze, "before_analyze", None):
+        # Also called by wrappers that replace analyze, e.g. background analysis
+        analyze_and_save_records.before_analyze = save_records
+        handler.analyze = analyze_and_save_records
+    return handler.zi_session
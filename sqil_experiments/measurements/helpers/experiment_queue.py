@@ -0,0 +1,530 @@
+"""Persistent queue of experiments for unattended measurement batches.
+
+The queue is a JSON file with a list of jobs. Every job runs one experiment handler,
+by exp_name or class name, with the same arguments as ``handler.run``. Arrays are
+written as lists or as ``{"linspace": [start, stop, num]}`` (also ``logspace``,
+``geomspace`` and ``arange``), options as a dictionary of option values:
+
+    [
+        {
+            "exp": "qubit_spectroscopy",
+            "args": [[{"linspace": [4.0e9, 4.4e9, 201]}]],
+            "kwargs": {"qu_ids": ["q0"], "transition": "ge"},
+            "options": {"class": "QuSpecOptions", "count": 4096},
+            "priority": 10
+        },
+        {"exp": "T1", "args": [[{"linspace": [0, 200e-6, 41]}]], "retries": 2}
+    ]
+
+Jobs run by decreasing priority, then in the order they were added. A job that
+raises is retried up to ``retries`` times, on a new handler that reconnects to the
+instruments, then marked as failed, and the queue goes on with the next job. The state of every job is saved in the queue file after
+each change, so that an interrupted batch can be resumed by running the queue again.
+
+The scheduler keeps the instruments and the LabOne Q session of every handler
+connected for the whole batch (see HandlerPool) and analyzes each run in the
+background. By default a job waits for all the analyses that update the QPU before
+it starts, so the analysis overlaps the next acquisition only for the jobs that opt
+in with ``"wait_for_params"``:
+
+- ``false``: the job starts right away;
+- a list of QPU parameters, e.g. ``["resonance_frequency_ge"]``: the job waits only
+  for the analyses of the experiments that updated one of them on their last run,
+  or that never ran.
+
+The duration
+of every job is recorded per exp_name and used to estimate the next ones. Before
+they ever ran, ``estimate`` computes the expected duration and data volume of the
+pending jobs with a dry run, without the instruments (see ``dry_run``).
+
+Usage
+-----
+    python -m sqil_experiments.measurements.helpers.experiment_queue add queue.json jobs.json
+    python -m sqil_experiments.measurements.helpers.experiment_queue estimate queue.json
+    python -m sqil_experiments.measurements.helpers.experiment_queue run queue.json
+    python -m sqil_experiments.measurements.helpers.experiment_queue status queue.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import enum
+import importlib
+import json
+import os
+import sys
+import time
+import typing
+from datetime import datetime
+
+import numpy as np
+
+from sqil_experiments.analysis.reanalyze import get_handlers
+from sqil_experiments.measurements.helpers.background_analysis import (
+    enable_background_analysis,
+)
+from sqil_experiments.measurements.helpers.dry_run import (
+    dry_run,
+    format_estimate,
+    record_run,
+)
+from sqil_experiments.measurements.helpers.handler_pool import HandlerPool
+
+ARRAY_CONSTRUCTORS = {
+    "linspace": np.linspace,
+    "logspace": np.logspace,
+    "geomspace": np.geomspace,
+    "arange": np.arange,
+}
+# Modules searched for option classes, after the module of the handler
+OPTIONS_MODULES = ["laboneq_applications.experiments.options"]
+# Durations kept per exp_name for the estimates
+HISTORY_LENGTH = 20
+
+PENDING, RUNNING, ANALYZING, DONE, FAILED = (
+    "pending",
+    "running",
+    "analyzing",
+    "done",
+    "failed",
+)
+
+
+def decode_value(value):
+    """Converts the JSON value of an argument into the value passed to the run.
+
+    Lists of numbers become arrays and ``{"linspace": [...]}`` dictionaries are
+    replaced by the corresponding array. Everything else is decoded recursively.
+    """
+    if isinstance(value, dict):
+        if len(value) == 1 and next(iter(value)) in ARRAY_CONSTRUCTORS:
+            name, args = next(iter(value.items()))
+            return ARRAY_CONSTRUCTORS[name](*args)
+        return {k: decode_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        if value and all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) for v in value
+        ):
+            return np.asarray(value)
+        return [decode_value(v) for v in value]
+    return value
+
+
+def _find_handler(name: str) -> type:
+    handlers = get_handlers()
+    if name in handlers:
+        return handlers[name]
+    for handler_cls in handlers.values():
+        if handler_cls.__name__ == name:
+            return handler_cls
+    raise KeyError(f"No handler with exp_name or class name '{name}'")
+
+
+def _options_class(handler_cls: type, name: str | None) -> type:
+    module = sys.modules[handler_cls.__module__]
+    if name is None:
+        # Options class in the signature of the experiment, e.g. QuSpecOptions
+        func = getattr(module, "create_experiment", handler_cls.sequence)
+        try:
+            annotation = typing.get_type_hints(func).get("options")
+        except Exception:
+            annotation = None
+        for candidate in typing.get_args(annotation) or (annotation,):
+            if isinstance(candidate, type) and candidate is not type(None):
+                return candidate
+        raise ValueError(
+            f"Cannot find the options class of {handler_cls.__name__}, "
+            + "give it as options['class']"
+        )
+    for module_name in [handler_cls.__module__, *OPTIONS_MODULES]:
+        options_cls = getattr(importlib.import_module(module_name), name, None)
+        if options_cls is not None:
+            return options_cls
+    raise KeyError(f"No options class '{name}'")
+
+
+def build_options(handler_cls: type, spec: dict | list | None):
+    """Creates the options of a run from their dictionary, or a list of options for
+    the adaptive experiments. Enum options can be given by name, e.g.
+    ``"acquisition_type": "SPECTROSCOPY"``."""
+    if spec is None:
+        return None
+    if isinstance(spec, list):
+        return [build_options(handler_cls, s) for s in spec]
+    spec = dict(spec)
+    options = _options_class(handler_cls, spec.pop("class", None))()
+    for key, value in spec.items():
+        default = getattr(options, key)
+        if isinstance(default, enum.Enum) and isinstance(value, str):
+            value = type(default)[value]
+        setattr(options, key, decode_value(value))
+    return options
+
+
+class _QueueParent:
+    """Holds the QPU shared by the jobs of the queue, see HandlerPool."""
+
+    def __init__(self, emulation: bool = False):
+        self.qpu = None
+        self.emulation = emulation
+
+
+class ExperimentQueue:
+    """Persistent queue of experiment jobs, stored in a JSON file.
+
+    Parameters
+    ----------
+    path : str
+        The queue file, created if it doesn't exist.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs: list[dict] = []
+        # exp_name -> durations in seconds of the last runs
+        self.history: dict[str, list[float]] = {}
+        # exp_name -> QPU parameters updated by the analysis of the last run
+        self.produces: dict[str, list[str]] = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.jobs = state.get("jobs", [])
+            self.history = state.get("history", {})
+            self.produces = state.get("produces", {})
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        state = {"jobs": self.jobs, "history": self.history, "produces": self.produces}
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def add(self, spec: dict) -> dict:
+        """Adds a job to the queue and returns it."""
+        if "exp" not in spec:
+            raise ValueError("A job needs the 'exp' of its handler")
+        _find_handler(spec["exp"])
+        job = {
+            "id": max((job["id"] for job in self.jobs), default=0) + 1,
+            "args": [],
+            "kwargs": {},
+            "options": None,
+            "priority": 0,
+            "retries": 1,
+            "wait_for_params": True,
+            "estimate_s": None,
+            **spec,
+            "status": PENDING,
+            "attempts": 0,
+            "error": None,
+        }
+        self.jobs.append(job)
+        self.save()
+        return job
+
+    def next_job(self) -> dict | None:
+        pending = [job for job in self.jobs if job["status"] == PENDING]
+        if not pending:
+            return None
+        return min(pending, key=lambda job: (-job["priority"], job["id"]))
+
+    def estimate(self, job: dict) -> float | None:
+        """Expected duration of a job in seconds, from its dry run or the previous
+        runs of the same experiment, or None if there is neither."""
+        if job.get("estimate_s") is not None:
+            return job["estimate_s"]
+        if job.get("dry_run"):
+            return job["dry_run"]["wall_s"]
+        durations = self.history.get(job["exp"])
+        return float(np.mean(durations)) if durations else None
+
+    def dry_run(self, setup_path: str = ""):
+        """Estimates the duration and data volume of the pending jobs without the
+        instruments, see ``dry_run``."""
+        total_bytes = 0
+        for job in self.jobs:
+            if job["status"] != PENDING:
+                continue
+            handler_cls = _find_handler(job["exp"])
+            kwargs = decode_value(job["kwargs"])
+            options = build_options(handler_cls, job["options"])
+            if options is not None:
+                kwargs["options"] = options
+            try:
+                job["dry_run"] = dry_run(
+                    handler_cls,
+                    *decode_value(job["args"]),
+                    setup_path=setup_path,
+                    **kwargs,
+                )
+            except Exception as e:
+                print(f"Cannot dry run job {job['id']} ({job['exp']}): {e}")
+                continue
+            total_bytes += job["dry_run"]["data_bytes"]
+            print(f"{job['id']:>4}  {format_estimate(job['dry_run'])}")
+        self.save()
+        print(f"Data: ~{total_bytes / 1e6:.3g} MB")
+
+    def remaining(self) -> tuple[float, int]:
+        """Estimated time of the pending jobs, and the number of them without an
+        estimate."""
+        total, unknown = 0.0, 0
+        for job in self.jobs:
+            if job["status"] in (PENDING, RUNNING):
+                estimate = self.estimate(job)
+                if estimate is None:
+                    unknown += 1
+                else:
+                    total += estimate
+        return total, unknown
+
+    def reset(self, statuses=(FAILED,)):
+        """Puts the jobs with these statuses back in the queue."""
+        for job in self.jobs:
+            if job["status"] in statuses:
+                job.update(status=PENDING, attempts=0, error=None)
+        self.save()
+
+    def _record_duration(self, job: dict, duration: float):
+        durations = self.history.setdefault(job["exp"], [])
+        durations.append(duration)
+        del durations[:-HISTORY_LENGTH]
+
+    def __repr__(self):
+        lines = []
+        for job in sorted(self.jobs, key=lambda job: (-job["priority"], job["id"])):
+            estimate = self.estimate(job)
+            estimate = f"~{estimate / 60:.1f} min" if estimate else "no estimate"
+            line = (
+                f"{job['id']:>4}  {job['status']:<9}  p{job['priority']:<3}  "
+                f"{job['exp']:<28}  {estimate}"
+            )
+            if job["error"]:
+                line += f"  ({job['error']})"
+            lines.append(line)
+        total, unknown = self.remaining()
+        lines.append(
+            f"Remaining: ~{total / 60:.1f} min"
+            + (f" + {unknown} jobs without estimate" if unknown else "")
+        )
+        return "\n".join(lines)
+
+
+class QueueScheduler:
+    """Runs the jobs of an ExperimentQueue.
+
+    Parameters
+    ----------
+    queue : ExperimentQueue
+        The queue to run.
+    max_jobs : int, optional
+        Stop after this many jobs, by default run until the queue is empty.
+    **handler_kwargs
+        Passed to the constructor of the handlers, e.g. ``setup_path`` or
+        ``emulation``.
+    """
+
+    def __init__(self, queue: ExperimentQueue, max_jobs=None, **handler_kwargs):
+        self.queue = queue
+        self.max_jobs = max_jobs
+        self.handler_kwargs = handler_kwargs
+        # job id -> AnalysisFuture
+        self._analyses: dict = {}
+
+    def _collect(self, wait: bool = False, job_ids=None):
+        """Records the analyses that are done, or waits for them if wait is True.
+        Only the analyses of job_ids are waited for, by default all of them."""
+        for job_id, future in list(self._analyses.items()):
+            waited = wait and (job_ids is None or job_id in job_ids)
+            if not waited and not future.done():
+                continue
+            anal_res = future.result()
+            job = next(job for job in self.queue.jobs if job["id"] == job_id)
+            job["status"] = DONE
+            job["finished"] = datetime.now().isoformat(timespec="seconds")
+            job["params"] = {}
+            if anal_res is not None:
+                job["params"] = json.loads(
+                    json.dumps(anal_res.updated_params, default=float)
+                )
+                self.queue.produces[job["exp"]] = sorted(
+                    {param for params in job["params"].values() for param in params}
+                )
+            else:
+                job["error"] = "analysis failed"
+            del self._analyses[job_id]
+            self.queue.save()
+
+    def _wait_for_params(self, job: dict):
+        """Barrier before a job that uses the parameters fitted by the previous
+        ones, see ``wait_for_params`` in the module docstring."""
+        consumes = job["wait_for_params"]
+        if not consumes:
+            return
+        job_ids = []
+        for job_id, future in self._analyses.items():
+            if not future.update_params:
+                continue
+            exp = next(j["exp"] for j in self.queue.jobs if j["id"] == job_id)
+            produces = self.queue.produces.get(exp)
+            if consumes is True or produces is None or set(produces) & set(consumes):
+                job_ids.append(job_id)
+        if job_ids:
+            print("Waiting for the analyses that update the QPU")
+            self._collect(wait=True, job_ids=job_ids)
+
+    def _run_job(self, pool: HandlerPool, job: dict):
+        handler_cls = _find_handler(job["exp"])
+        handler = pool.get(handler_cls)
+        if pool.parent.qpu is None:
+            pool.parent.qpu = handler.qpu
+        enable_background_analysis(handler, qpu_owner=pool.parent)
+
+        kwargs = decode_value(job["kwargs"])
+        options = build_options(handler_cls, job["options"])
+        if options is not None:
+            kwargs["options"] = options
+        return pool.run(handler_cls, *decode_value(job["args"]), **kwargs)
+
+    def run(self) -> ExperimentQueue:
+        queue = self.queue
+        # Jobs interrupted by a previous run start again
+        for job in queue.jobs:
+            if job["status"] in (RUNNING, ANALYZING):
+                job["status"] = PENDING
+        queue.save()
+
+        parent = _QueueParent(self.handler_kwargs.pop("emulation", False))
+        n_jobs = 0
+        with HandlerPool(parent, **self.handler_kwargs) as pool:
+            try:
+                while self.max_jobs is None or n_jobs < self.max_jobs:
+                    self._collect()
+                    job = queue.next_job()
+                    if job is None:
+                        break
+                    self._wait_for_params(job)
+                    self._run_next(pool, job)
+                    n_jobs += 1
+            finally:
+                self._collect(wait=True)
+        print(queue)
+        return queue
+
+    def _run_next(self, pool: HandlerPool, job: dict):
+        queue = self.queue
+        total, unknown = queue.remaining()
+        estimate = queue.estimate(job)
+        print(
+            f"Job {job['id']} ({job['exp']}), attempt {job['attempts'] + 1}, "
+            + (f"~{estimate / 60:.1f} min" if estimate else "no estimate")
+            + f", ~{total / 60:.1f} min left in the queue"
+            + (f" + {unknown} jobs without estimate" if unknown else "")
+        )
+        job.update(
+            status=RUNNING,
+            attempts=job["attempts"] + 1,
+            started=datetime.now().isoformat(timespec="seconds"),
+        )
+        queue.save()
+
+        start = time.time()
+        try:
+            res = self._run_job(pool, job)
+        except KeyboardInterrupt:
+            job.update(status=PENDING, attempts=job["attempts"] - 1)
+            queue.save()
+            raise
+        except Exception as e:
+            job["error"] = f"{type(e).__name__}: {e}"
+            job["status"] = PENDING if job["attempts"] <= job["retries"] else FAILED
+            print(f"Job {job['id']} ({job['exp']}) failed: {job['error']}")
+            queue.save()
+            # The retry reconnects, in case the instruments are in a bad state
+            try:
+                pool.drop(_find_handler(job["exp"]))
+            except KeyError:
+                pass
+            return
+
+        job["duration_s"] = time.time() - start
+        job["error"] = None
+        queue._record_duration(job, job["duration_s"])
+        if job.get("dry_run"):
+            try:
+                record_run(job["dry_run"], job["duration_s"])
+            except OSError as e:
+                print(f"Cannot record the overhead of job {job['id']}: {e}")
+        path = getattr(res, "path", None) or getattr(res, "data_path", None)
+        job["path"] = path
+        if hasattr(res, "future"):
+            job["status"] = ANALYZING
+            self._analyses[job["id"]] = res
+        else:
+            job["status"] = DONE
+            job["finished"] = datetime.now().isoformat(timespec="seconds")
+        queue.save()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Persistent queue of experiments for unattended measurements."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="Add the jobs of a JSON file")
+    add_parser.add_argument("queue", help="Queue file")
+    add_parser.add_argument("jobs", help="JSON file with a job or a list of jobs")
+
+    run_parser = subparsers.add_parser("run", help="Run the pending jobs")
+    run_parser.add_argument("queue", help="Queue file")
+    run_parser.add_argument(
+        "--setup-path", default="", help="Setup file, by default from config.yaml"
+    )
+    run_parser.add_argument("--emulation", action="store_true")
+    run_parser.add_argument("--max-jobs", type=int, default=None)
+
+    estimate_parser = subparsers.add_parser(
+        "estimate", help="Estimate the pending jobs with a dry run"
+    )
+    estimate_parser.add_argument("queue", help="Queue file")
+    estimate_parser.add_argument(
+        "--setup-path", default="", help="Setup file, by default from config.yaml"
+    )
+
+    status_parser = subparsers.add_parser("status", help="Show the jobs")
+    status_parser.add_argument("queue", help="Queue file")
+
+    reset_parser = subparsers.add_parser("reset", help="Queue failed jobs again")
+    reset_parser.add_argument("queue", help="Queue file")
+    reset_parser.add_argument(
+        "--all", action="store_true", help="Also queue the jobs already done"
+    )
+    args = parser.parse_args(argv)
+
+    queue = ExperimentQueue(args.queue)
+    if args.command == "add":
+        with open(args.jobs) as f:
+            specs = json.load(f)
+        for spec in specs if isinstance(specs, list) else [specs]:
+            job = queue.add(spec)
+            print(f"Added job {job['id']} ({job['exp']})")
+    elif args.command == "run":
+        QueueScheduler(
+            queue,
+            max_jobs=args.max_jobs,
+            setup_path=args.setup_path,
+            emulation=args.emulation,
+        ).run()
+    elif args.command == "estimate":
+        queue.dry_run(args.setup_path)
+        print(queue)
+    elif args.command == "reset":
+        queue.reset((FAILED, DONE) if args.all else (FAILED,))
+        print(queue)
+    else:
+        print(queue)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Pool of child experiment handlers for experiments that run other experiments.
+
+Adaptive experiments (e.g. ``T1Adaptive``) run a chain of experiments at every
+point of their sweep. Creating a new handler for each of them reads the setup file,
+regenerates the device setup and reconnects to the instruments. A HandlerPool
+creates each child handler once, keeps its instruments and LabOne Q session
+connected until the pool is closed, and runs all the children on the QPU of the
+parent, so that the parameters updated by one experiment are used by the next one.
+Creating a handler resets the experiment event listeners, so the pool restores the
+listeners of the parent and of the online analyses after creating a child, and
+subscribes the hooks of a child only while it runs.
+With a CompilePipeline, the next child experiment can be compiled in the background
+while the current one acquires.
+"""
+
+from __future__ import annotations
+
+import os
+import weakref
+from contextlib import contextmanager
+
+from blinker import ANY
+from blinker.base import ANY_ID
+from qcodes import Instrument as QCodesInstrument
+from sqil_core.experiment import ExperimentHandler
+from sqil_core.experiment._events import (
+    after_experiment,
+    after_sequence,
+    before_experiment,
+    before_sequence,
+)
+
+from sqil_experiments.measurements.helpers.compile_pipeline import (
+    CompilePipeline,
+    PipelinedSession,
+)
+
+COMPILE_TRACE_FILENAME = "compile_trace.json"
+
+EVENTS = (before_experiment, before_sequence, after_sequence, after_experiment)
+
+
+def _listeners(event) -> list[tuple]:
+    """Returns (receiver, sender, weak) for every connection of an event."""
+    listeners = []
+    for receiver_id, sender_ids in list(event._by_receiver.items()):
+        ref = event.receivers.get(receiver_id)
+        weak = isinstance(ref, weakref.ref)
+        receiver = ref() if weak else ref
+        if receiver is None:
+            continue
+        for sender_id in sender_ids:
+            sender = ANY
+            if sender_id != ANY_ID:
+                sender_ref = event._weak_senders.get(sender_id)
+                sender = sender_ref() if sender_ref is not None else None
+                if sender is None:
+                    continue
+            listeners.append((receiver, sender, weak))
+    return listeners
+
+
+def _is_instrument_listener(receiver) -> bool:
+    qualname = getattr(receiver, "__qualname__", "")
+    return qualname.startswith("Instrument._subscribe_to_events")
+
+
+def _connect_hooks(handler: ExperimentHandler):
+    before_experiment.connect(handler.on_before_experiment, weak=False)
+    after_experiment.connect(handler.on_after_experiment, weak=False)
+
+
+def _disconnect_hooks(handler: ExperimentHandler):
+    before_experiment.disconnect(handler.on_before_experiment)
+    after_experiment.disconnect(handler.on_after_experiment)
+
+
+class HandlerPool:
+    """Child handlers of a parent experiment, one per handler class.
+
+    Parameters
+    ----------
+    parent : ExperimentHandler
+        The experiment running the children. Its QPU is shared with the children.
+    pipeline : CompilePipeline, optional
+        If given, the children compile through it and can be prefetched. It is
+        closed together with the pool.
+    **handler_kwargs
+        Passed to the constructor of the child handlers. By default the children
+        use the emulation setting of the parent.
+
+    Example
+    -------
+    >>> class MyAdaptive(ExperimentHandler):
+    ...     def run(self, *args, **kwargs):
+    ...         with HandlerPool(self) as self.pool:
+    ...             return super().run(*args, **kwargs)
+    ...
+    ...     def sequence(self, exp_params, *args, **kwargs):
+    ...         spec_res = self.pool.run(QuSpec, spec_params, qu_ids=["q0"])
+    ...         ...
+    """
+
+    def __init__(
+        self,
+        parent: ExperimentHandler,
+        pipeline: CompilePipeline | None = None,
+        **handler_kwargs,
+    ):
+        self.parent = parent
+        self.pipeline = pipeline
+        self.handler_kwargs = {
+            "emulation": getattr(parent, "emulation", False),
+            **handler_kwargs,
+        }
+        self.handlers: dict[type, ExperimentHandler] = {}
+        # exp_name and data folder of every child run, in order
+        self.runs: list[dict] = []
+
+    def get(self, handler_cls: type) -> ExperimentHandler:
+        """Returns the child handler of the given class, creating it if needed."""
+        handler = self.handlers.get(handler_cls)
+        if handler is None:
+            listeners = {event: _listeners(event) for event in EVENTS}
+            handler = handler_cls(qpu=self.parent.qpu, **self.handler_kwargs)
+            self._restore(listeners, handler)
+            session = getattr(handler, "zi_session", None)
+            if self.pipeline is not None and session is not None:
+                handler.zi_session = PipelinedSession(
+                    session, self.pipeline, label=handler.exp_name
+                )
+            self.handlers[handler_cls] = handler
+        return handler
+
+    @staticmethod
+    def _restore(listeners: dict, handler: ExperimentHandler):
+        """Reconnects the listeners cleared by the creation of a child handler. The
+        instruments of the new child replace the previous ones, which control the
+        same devices, and its hooks are only connected while it runs."""
+        _disconnect_hooks(handler)
+        has_instruments = bool(handler.instruments)
+        for event, connections in listeners.items():
+            for receiver, sender, weak in connections:
+                if has_instruments and _is_instrument_listener(receiver):
+                    continue
+                event.connect(receiver, sender=sender, weak=weak)
+
+    @contextmanager
+    def _subscribed(self, handler: ExperimentHandler):
+        """Connects the hooks of the child, instead of the ones of the parent and
+        of the other children, while it runs."""
+        for other in [self.parent, *self.handlers.values()]:
+            _disconnect_hooks(other)
+        _connect_hooks(handler)
+        try:
+            yield
+        finally:
+            _disconnect_hooks(handler)
+            _connect_hooks(self.parent)
+
+    def run(self, handler_cls: type, *args, **kwargs):
+        """Runs a child experiment on the QPU of the parent.
+
+        Same as ``handler.run``, but the instruments are not disconnected at the end.
+        The QPU with the parameters updated by the child replaces the one of the
+        parent.
+        """
+        handler = self.get(handler_cls)
+        exp_name = handler.exp_name
+        handler.qpu = self.parent.qpu
+        try:
+            db_type = handler.setup.get("storage", {}).get("db_type", "")
+            with self._subscribed(handler):
+                if db_type == "plottr":
+                    res = handler.run_with_plottr(*args, **kwargs)
+                else:
+                    res = handler.run_raw(*args, **kwargs)
+            path = getattr(res, "path", None) or getattr(res, "data_path", None)
+            self.runs.append({"exp_name": handler.exp_name, "path": path})
+            return res
+        finally:
+            # Sweeps append their name to exp_name at every run
+            handler.exp_name = exp_name
+            self.parent.qpu = handler.qpu
+
+    def prefetch(self, handler_cls: type, *args, qu_ids=None, **kwargs) -> bool:
+        """Builds a child experiment with the current parameters of the parent and
+        starts compiling it in the background. Returns False if the pool has no
+        pipeline or the child does not build a LabOne Q experiment."""
+        if self.pipeline is None:
+            return False
+        handler = self.get(handler_cls)
+        session = getattr(handler, "zi_session", None)
+        if not handler.is_zi_exp or not isinstance(session, PipelinedSession):
+            return False
+        handler.qpu = self.parent.qpu
+        run_kwargs = {**kwargs, "qu_ids": qu_ids or ["q0"], "pulse_sheet": False}
+        try:
+            experiment = handler.sequence(*args, **run_kwargs)
+            session.prefetch(experiment)
+        except Exception as e:
+            print(f"Error prefetching {handler.exp_name}: {e}")
+            return False
+        return True
+
+    def save_trace(self, path: str):
+        """Saves the compile trace of the pipeline in the data folder path."""
+        if self.pipeline is not None:
+            self.pipeline.trace.save(os.path.join(path, COMPILE_TRACE_FILENAME))
+
+    @staticmethod
+    def _disconnect(handler: ExperimentHandler):
+        for instrument in handler.instruments or []:
+            try:
+                instrument.disconnect()
+            except Exception as e:
+                print(f"Error disconnecting {instrument}: {e}")
+
+    def drop(self, handler_cls: type):
+        """Disconnects the child handler of the given class and removes it from the
+        pool, e.g. after an error, so that the next run creates it again and
+        reconnects to the instruments. The QCodes instruments of the handler are
+        closed, the other children using them are dropped too."""
+        handler = self.handlers.pop(handler_cls, None)
+        if handler is None:
+            return
+        self._disconnect(handler)
+        devices = []
+        for instrument in handler.instruments or []:
+            device = getattr(instrument, "device", None)
+            if isinstance(device, QCodesInstrument):
+                devices.append(device)
+                device.close()
+        for other_cls, other in list(self.handlers.items()):
+            other_devices = [
+                getattr(i, "device", None) for i in other.instruments or []
+            ]
+            if any(d is device for d in other_devices for device in devices):
+                self.handlers.pop(other_cls)
+                self._disconnect(other)
+
+    def close(self):
+        """Disconnects the instruments of all the child handlers."""
+        if self.pipeline is not None:
+            self.pipeline.close()
+        if not self.handlers:
+            return
+        QCodesInstrument.close_all()
+        for handler in self.handlers.values():
+            self._disconnect(handler)
+        self.handlers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,342 @@
+"""Order of the outer sweep points for slow instruments.
+
+The outer ``sweeps`` of a run are acquired as the product of their values, the first
+sweep being the outermost. When a sweep drives a slow instrument, e.g. a current
+source that ramps at ``ramp_step`` every ``ramp_step_delay``, every jump back to the
+first value of a sweep is spent ramping. With a sweep order enabled, the points of a
+run are acquired in one of these orders:
+
+- ``"serpentine"``: every sweep runs back and forth, so that consecutive points
+  differ by one step of a single sweep. The direction of every sweep is chosen so
+  that the run starts from the point closest to where the instruments are;
+- ``"nearest"``: greedy nearest neighbour, the next point is always the one that
+  takes the shortest time to reach, for irregular or unsorted sweep values;
+- ``"logical"``: the order of the product, as without a sweep order.
+
+The time to move between two points is the sum over the sweeps of the change of the
+value times the seconds per unit of the sweep. For the sweeps bound to a current
+source it is ``ramp_step_delay / ramp_step``, the other sweeps are given with
+``seconds_per_unit``. The values of the first qubit are used.
+
+With ``overlap=True`` the slow instruments start ramping to the next point as soon
+as its sequence is built, while the experiment compiles, instead of after the
+compilation.
+
+The data is saved in the order of acquisition, every point with its own sweep
+values, and put back in the order of the product before the analysis. The order is
+saved in ``sweep_order.json`` in the data folder. An interrupted run keeps the order
+of acquisition and cannot be resumed with ``checkpoint.resume``.
+
+Example
+-------
+>>> qu_spec = QuSpec()
+>>> enable_sweep_order(qu_spec, "serpentine")
+>>> qu_spec.run(frequencies, sweeps={"current": currents, "readout_amplitude": amps})
+"""
+
+from __future__ import annotations
+
+import itertools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+import h5py
+import numpy as np
+
+from sqil_experiments.measurements.helpers.checkpoint import _datasets, sweep_shape
+
+ORDERS = ("logical", "serpentine", "nearest")
+SWEEP_ORDER_FILENAME = "sweep_order.json"
+
+
+def slow_instruments(handler) -> list:
+    """Instruments of a handler that ramp to their values, e.g. current sources."""
+    instruments = getattr(handler, "instruments", None) or []
+    return [
+        instrument
+        for instrument in instruments
+        if getattr(instrument, "ramp_step", None)
+        and getattr(instrument, "ramp_step_delay", None)
+    ]
+
+
+def ramp_rates(handler) -> dict[str, float]:
+    """Seconds per unit of the variables of the slow instruments of a handler, e.g.
+    ``{"current": 8000}`` for a current source ramping 1 uA every 8 ms."""
+    rates = {}
+    for instrument in slow_instruments(handler):
+        rate = instrument.ramp_step_delay / instrument.ramp_step
+        for name in instrument.variables:
+            rates[name] = max(rates.get(name, 0.0), rate)
+    return rates
+
+
+def _serpentine(shape: tuple[int, ...]) -> list[tuple[int, ...]]:
+    if not shape:
+        return [()]
+    inner = _serpentine(shape[1:])
+    order = []
+    for i in range(shape[0]):
+        order += [(i, *rest) for rest in (inner if i % 2 == 0 else inner[::-1])]
+    return order
+
+
+def _point_values(sweep_grid: dict, qu_id: str, weights: np.ndarray) -> np.ndarray:
+    """Values of the sweeps at every point, zero for the sweeps without a cost."""
+    values = np.zeros((len(sweep_grid[qu_id]), len(weights)))
+    for i, point in enumerate(sweep_grid[qu_id]):
+        for k, value in enumerate(point):
+            if weights[k]:
+                values[i, k] = value
+    return values
+
+
+def move_time(values: np.ndarray, weights: np.ndarray, start=None) -> float:
+    """Time spent moving through the points, in their order, from start."""
+    if start is not None:
+        values = np.vstack([start, values])
+    steps = np.abs(np.diff(values, axis=0)) * weights
+    return float(np.nansum(steps))
+
+
+def serpentine_order(shape, values, weights, start=None) -> np.ndarray:
+    """Serpentine order of a product of sweeps, in the direction that starts the
+    closest to start."""
+    snake = np.array(_serpentine(tuple(shape)))
+    best, best_time = None, np.inf
+    for flips in itertools.product([False, True], repeat=len(shape)):
+        indices = np.where(flips, np.array(shape) - 1 - snake, snake)
+        order = np.ravel_multi_index(indices.T, shape)
+        time = move_time(values[order[:1]], weights, start)
+        if time < best_time:
+            best, best_time = order, time
+    return best
+
+
+def nearest_order(values, weights, start=None) -> np.ndarray:
+    """Greedy nearest neighbour order of the points, from start."""
+    n_points = len(values)
+    visited = np.zeros(n_points, dtype=bool)
+    current = start if start is not None else values[0]
+    order = []
+    for _ in range(n_points):
+        times = np.nansum(np.abs(values - current) * weights, axis=1)
+        times[visited] = np.inf
+        # argmin keeps the order of the product between points at the same time
+        index = int(np.argmin(times))
+        order.append(index)
+        visited[index] = True
+        current = values[index]
+    return np.array(order)
+
+
+class SweepOrder:
+    """Orders the outer sweep points of the runs of a handler, see
+    ``enable_sweep_order``."""
+
+    def __init__(
+        self,
+        handler,
+        order: str = "serpentine",
+        seconds_per_unit: dict | None = None,
+        overlap: bool = True,
+    ):
+        if order not in ORDERS:
+            raise ValueError(f"Unknown sweep order '{order}', use one of {ORDERS}")
+        self.handler = handler
+        self.order = order
+        self.seconds_per_unit = {**ramp_rates(handler), **(seconds_per_unit or {})}
+        self.overlap = overlap
+        # Permutation of the run being acquired, point i is the logical point
+        # permutation[i]
+        self.permutation: np.ndarray | None = None
+        # Sweep values of the last point acquired, where the instruments are
+        self.last_point: dict | None = None
+        self._ramp: threading.Thread | None = None
+
+    def _start(self, sweep_keys: list, qu_id: str) -> np.ndarray:
+        """Where the instruments are: the last point of the previous run, or the
+        values of the QPU."""
+        start = []
+        for key in sweep_keys:
+            value = (self.last_point or {}).get(key)
+            if value is None:
+                value = getattr(self.handler.qpu[qu_id].parameters, key, None)
+            try:
+                start.append(float(value))
+            except (TypeError, ValueError):
+                start.append(np.nan)
+        return np.array(start)
+
+    def plan(
+        self, sweeps: dict, sweep_keys: list, sweep_grid: dict, qu_ids: list
+    ) -> np.ndarray:
+        """Permutation of the points of the product of the sweeps."""
+        shape = sweep_shape(sweeps)
+        weights = np.array([self.seconds_per_unit.get(k, 0.0) for k in sweep_keys])
+        values = _point_values(sweep_grid, qu_ids[0], weights)
+        start = self._start(sweep_keys, qu_ids[0])
+        if self.order == "serpentine":
+            permutation = serpentine_order(shape, values, weights, start)
+        elif self.order == "nearest":
+            permutation = nearest_order(values, weights, start)
+        else:
+            permutation = np.arange(len(values))
+
+        if weights.any():
+            logical = move_time(values, weights, start)
+            ordered = move_time(values[permutation], weights, start)
+            print(
+                f"Sweep order {self.order}: ~{ordered:.0f} s of ramps instead of "
+                f"~{logical:.0f} s"
+            )
+        self.permutation = permutation
+        last = sweep_grid[qu_ids[0]][permutation[-1]]
+        self.last_point = dict(zip(sweep_keys, last, strict=False))
+        return permutation
+
+    def start_ramp(self):
+        """Ramps the slow instruments to the values of the QPU in the background."""
+        self.join_ramp()
+
+        def ramp():
+            for instrument in slow_instruments(self.handler):
+                try:
+                    # Same call as the before_sequence event
+                    instrument.on_before_sequence(self.handler)
+                except Exception as e:
+                    print(f"Error ramping {instrument.name} in the background: {e}")
+
+        self._ramp = threading.Thread(target=ramp, daemon=True)
+        self._ramp.start()
+
+    def join_ramp(self):
+        if self._ramp is not None:
+            self._ramp.join()
+            self._ramp = None
+
+    def reindex(self, path: str):
+        """Puts the data of a run back in the order of the product of the sweeps."""
+        if self.permutation is None:
+            return
+        permutation, self.permutation = self.permutation, None
+        inverse = np.argsort(permutation)
+        data_path = os.path.join(path, "data.ddh5")
+        with h5py.File(data_path, "r+") as f:
+            for dataset in _datasets(f["data"]).values():
+                if len(dataset) == len(permutation):
+                    dataset[...] = dataset[()][inverse]
+        with open(os.path.join(path, SWEEP_ORDER_FILENAME), "w") as f:
+            json.dump(
+                {"order": self.order, "acquired": permutation.tolist()}, f, indent=2
+            )
+
+
+class _RampJoinSession:
+    """Wraps a LabOne Q Session so that ``compile`` returns once the background
+    ramp is done. Everything else is forwarded to the session."""
+
+    def __init__(self, session, sweep_order: SweepOrder):
+        self.session = session
+        self.sweep_order = sweep_order
+
+    def compile(self, *args, **kwargs):
+        try:
+            return self.session.compile(*args, **kwargs)
+        finally:
+            self.sweep_order.join_ramp()
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+@contextmanager
+def _ordered_sweeps(sweep_order: SweepOrder, sweeps):
+    """Makes the run acquire the points of ``sweeps`` in the order of sweep_order."""
+    from sqil_core.experiment import _experiment
+
+    parse_sweeps = _experiment.parse_sweeps
+
+    def parse_sweeps_in_order(sweeps_arg, qu_ids):
+        sweep_keys, sweep_grid, sweep_len, sweep_schema = parse_sweeps(
+            sweeps_arg, qu_ids
+        )
+        # The sweeps of the child runs keep their order
+        if sweeps_arg is sweeps:
+            permutation = sweep_order.plan(sweeps, sweep_keys, sweep_grid, qu_ids)
+            sweep_grid = {
+                qu_id: [grid[i] for i in permutation]
+                for qu_id, grid in sweep_grid.items()
+            }
+        return sweep_keys, sweep_grid, sweep_len, sweep_schema
+
+    _experiment.parse_sweeps = parse_sweeps_in_order
+    try:
+        yield
+    finally:
+        _experiment.parse_sweeps = parse_sweeps
+        sweep_order.join_ramp()
+
+
+def enable_sweep_order(
+    handler,
+    order: str = "serpentine",
+    seconds_per_unit: dict | None = None,
+    overlap: bool = True,
+) -> SweepOrder:
+    """Acquires the outer sweep points of the runs of a handler in the given order,
+    see SweepOrder, and returns it.
+
+    Parameters
+    ----------
+    handler : ExperimentHandler
+        The handler.
+    order : str, optional
+        ``"serpentine"``, ``"nearest"`` or ``"logical"``, by default serpentine.
+    seconds_per_unit : dict, optional
+        Time to change every sweep by one unit, for the sweeps that are not bound to
+        a current source, e.g. ``{"readout_frequency": 1e-9}``.
+    overlap : bool, optional
+        Ramp the slow instruments while the next point compiles, by default True.
+    """
+    sweep_order = SweepOrder(handler, order, seconds_per_unit, overlap)
+    run = handler.run
+    sequence = handler.sequence
+    analyze = handler.analyze
+    before_analyze = getattr(analyze, "before_analyze", None)
+
+    def run_in_order(*args, **kwargs):
+        with _ordered_sweeps(sweep_order, kwargs.get("sweeps")):
+            return run(*args, **kwargs)
+
+    # The signature is used to save the arguments of the run
+    @wraps(sequence)
+    def sequence_and_ramp(*args, **kwargs):
+        if sweep_order.overlap:
+            sweep_order.start_ramp()
+        return sequence(*args, **kwargs)
+
+    def reindex(path):
+        sweep_order.reindex(path)
+        if before_analyze is not None:
+            before_analyze(path)
+
+    def analyze_in_order(path, *args, **kwargs):
+        sweep_order.reindex(path)
+        return analyze(path, *args, **kwargs)
+
+    # Also called by wrappers that replace analyze, e.g. background analysis
+    analyze_in_order.before_analyze = reindex
+    handler.run = run_in_order
+    handler.sequence = sequence_and_ramp
+    handler.analyze = analyze_in_order
+    # Without a session that waits for the ramp, it would overlap the acquisition
+    sweep_order.overlap = overlap and bool(handler.is_zi_exp)
+    sweep_order.overlap &= bool(slow_instruments(handler))
+    if sweep_order.overlap:
+        handler.zi_session = _RampJoinSession(handler.zi_session, sweep_order)
+    handler.sweep_order = sweep_order
+    return sweep_order
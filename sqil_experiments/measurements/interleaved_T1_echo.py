@@ -20,6 +20,11 @@ from numpy.typing import ArrayLike
 from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_handler
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.estimators import estimate_decaying_exp
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.fit_table import FitTable
+from sqil_experiments.analysis.parallel import parallel_qubits
 from sqil_experiments.measurements.T2_echo import EchoExperimentOptions
 
 if TYPE_CHECKING:
@@ -164,9 +169,17 @@ class InterleavedT1Echo(ExperimentHandler):
         return analyze_interleaved_T1_echo(path=path, **kwargs)
 
 
+@cached_analysis(version=4)
+@parallel_qubits
 @multi_qubit_handler
 def analyze_interleaved_T1_echo(
-    datadict, qpu=None, qu_id="q0", transition="ge", relevant_params=None, **kwargs
+    datadict,
+    qpu=None,
+    qu_id="q0",
+    transition="ge",
+    relevant_params=None,
+    headless=False,
+    **kwargs,
 ):
     # Prepare analysis result object
     anal_res = AnalysisResult()
@@ -195,26 +208,31 @@ def analyze_interleaved_T1_echo(
     )
 
     T1s, T2s = np.zeros(len(proj_T1)), np.zeros(len(proj_echo))
+    fits_T1, fits_echo = FitTable(len(proj_T1)), FitTable(len(proj_echo))
     for i in range(len(times)):
         fit_res_T1, fit_res_echo = None, None
         time, data_T1, data_echo = times[i], proj_T1[i], proj_echo[i]
 
         # Analyze T1
         try:
-            fit_res_T1 = sqil.fit.fit_decaying_exp(time, data_T1)
+            fit_res_T1 = sqil.fit.fit_decaying_exp(
+                time, data_T1, guess=estimate_decaying_exp(time, data_T1)
+            )
         except Exception as e:
             print(f"Error ananlyzing T1 trace {i}", e)
+        fits_T1.set_row(i, fit_res_T1)
         if fit_res_T1 is not None:
-            anal_res.add_fit(fit_res_T1, f"{i} - T1", qu_id)
             T1s[i] = fit_res_T1.params_by_name["tau"]
 
         # Analyze echo
         try:
-            fit_res_echo = sqil.fit.fit_decaying_exp(time, data_echo)
+            fit_res_echo = sqil.fit.fit_decaying_exp(
+                time, data_echo, guess=estimate_decaying_exp(time, data_echo)
+            )
         except Exception as e:
             print(f"Error ananlyzing echo trace {i}", e)
+        fits_echo.set_row(i, fit_res_echo)
         if fit_res_echo is not None:
-            anal_res.add_fit(fit_res_echo, f"{i} - echo", qu_id)
             T2s[i] = fit_res_echo.params_by_name["tau"]
 
         T1s_masked = np.where(T1s > 0, T1s, np.nan)
@@ -233,6 +251,8 @@ def analyze_interleaved_T1_echo(
         )
         if transition == "ge":
             anal_res.add_params({"reset_delay_length": 5.01 * T1}, qu_id)
+    anal_res.add_fit(fits_T1, "T1 fits", qu_id)
+    anal_res.add_fit(fits_echo, "echo fits", qu_id)
 
     # Plot
     T1_info = ParamInfo(f"{transition}_T1")
@@ -245,26 +265,30 @@ def analyze_interleaved_T1_echo(
         sweep_info = [ParamInfo("index")]
     sweep_scaled = sweeps[0] * sweep_info[0].scale
 
-    fig, axs = plt.subplots(2, 1, figsize=(22, 12))
-    anal_res.add_figure(fig, "fig", qu_id)
-
-    axs[0].plot(sweep_scaled, T1_scaled, ".-")
-    axs[0].axhline(y=T1 * T1_info.scale, color="tab:pink", linestyle="--")
-    axs[0].set_ylabel(T1_info.name_and_unit)
-
-    axs[1].plot(sweep_scaled, echo_scaled, ".-")
-    axs[1].axhline(y=T2 * echo_info.scale, color="tab:pink", linestyle="--")
-    axs[1].set_ylabel(echo_info.name_and_unit)
-
-    finalize_plot(
-        fig,
-        f"Interleaved T1-echo ({transition})",
-        qu_id,
-        fit_res=None,
-        qubit_params=qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+    def render():
+        sqil.set_plot_style(plt)
+        fig, axs = plt.subplots(2, 1, figsize=(22, 12))
+
+        axs[0].plot(sweep_scaled, T1_scaled, ".-")
+        axs[0].axhline(y=T1 * T1_info.scale, color="tab:pink", linestyle="--")
+        axs[0].set_ylabel(T1_info.name_and_unit)
+
+        axs[1].plot(sweep_scaled, echo_scaled, ".-")
+        axs[1].axhline(y=T2 * echo_info.scale, color="tab:pink", linestyle="--")
+        axs[1].set_ylabel(echo_info.name_and_unit)
+
+        finalize_plot(
+            fig,
+            f"Interleaved T1-echo ({transition})",
+            qu_id,
+            fit_res=None,
+            qubit_params=qubit_params,
+            updated_params=anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        return fig
+
+    anal_res.add_figure(make_figure(render, headless), "fig", qu_id)
 
     return anal_res
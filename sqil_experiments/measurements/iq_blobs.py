@@ -11,6 +11,15 @@ from laboneq_applications.experiments.options import BaseExperimentOptions
 from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_handler
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.classifier import (
+    fit_state_classifier,
+    plot_assignment_matrix,
+    plot_iq_density,
+)
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.parallel import parallel_qubits
+
 if TYPE_CHECKING:
     from collections.abc import Sequence
 
@@ -78,8 +87,10 @@ class IQBlobs(ExperimentHandler):
     exp_name = "iq_blobs"
     db_schema = {}  # Dynamic schema computed before experiment
 
-    def __init__(self, setup_path="", emulation=False, server=False, is_zi_exp=None):
-        super().__init__(setup_path, emulation, server, is_zi_exp)
+    def __init__(
+        self, setup_path="", emulation=False, server=False, is_zi_exp=None, **kwargs
+    ):
+        super().__init__(setup_path, emulation, server, is_zi_exp, **kwargs)
         self.save_zi_result = True
 
     def on_before_experiment(self, *args, **kwargs):
@@ -105,8 +116,19 @@ class IQBlobs(ExperimentHandler):
         return analyze_iq_blobs(path=path, **kwargs)
 
 
+@cached_analysis(version=2)
+@parallel_qubits
 @multi_qubit_handler
-def analyze_iq_blobs(datadict, qpu=None, qu_id="q0", relevant_params=None, **kwargs):
+def analyze_iq_blobs(
+    datadict,
+    qpu=None,
+    qu_id="q0",
+    relevant_params=None,
+    classify=True,
+    max_shots=100_000,
+    headless=False,
+    **kwargs,
+):
     # Prepare analysis result object
     anal_res = AnalysisResult()
 
@@ -120,7 +142,7 @@ def analyze_iq_blobs(datadict, qpu=None, qu_id="q0", relevant_params=None, **kwa
     db_schema_keys.remove("initial_states")
     states = db_schema_keys
 
-    fit_res, fig = None, None
+    fit_res, clf = None, None
     qubit_params = enrich_qubit_params(qpu[qu_id]) if qpu else {}
 
     if relevant_params is None:
@@ -137,35 +159,61 @@ def analyze_iq_blobs(datadict, qpu=None, qu_id="q0", relevant_params=None, **kwa
 
     has_sweeps = y_data.ndim > 1
     if not has_sweeps:
-        fig, ax = plt.subplots(1, 1, figsize=(12, 10))
-        anal_res.add_figure(fig, "fig", qu_id)
-
-        for s in states:
-            state = 1e3 * datadict.get(s, np.nan)
-            ax.scatter(
-                np.real(state),
-                np.imag(state),
-                alpha=0.1,
-                color=blob_colors[s],
-                zorder=-1,
+        shots = {s: datadict[s] for s in states}
+
+        # Classify the shots with a Gaussian mixture seeded from the prepared states
+        if classify and len(states) > 1:
+            clf = fit_state_classifier(shots, max_shots=max_shots)
+            anal_res.add_output(
+                {
+                    "assignment_fidelity": clf["fidelity"],
+                    "state_fidelities": clf["fidelities"],
+                    "thresholds": clf["thresholds"],
+                },
+                qu_id,
             )
-            plot_IQ_ellipse(state, ax, color=edge_colors[s], label=s, conf=0.99)
-
-        ax.grid(True)
-        ax.set_aspect("equal")
-        ax.set_xlabel("In-phase [mV]")
-        ax.set_ylabel("Quadrature [mV]")
-        ax.legend()
-
-    finalize_plot(
-        fig,
-        f"IQ blobs",
-        qu_id,
-        fit_res,
-        qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+            anal_res.add_extra_data(
+                clf["assignment_matrix"], "assignment_matrix", qu_id
+            )
+            anal_res.add_extra_data(clf["means"], "state_means", qu_id)
+            anal_res.add_extra_data(clf["cov"], "state_cov", qu_id)
+
+        def render():
+            fig, ax = plt.subplots(1, 1, figsize=(12, 10))
+            plot_iq_density(ax, shots, blob_colors, scale=1e3, clf=clf)
+            for s in states:
+                state = 1e3 * datadict.get(s, np.nan)
+                plot_IQ_ellipse(state, ax, color=edge_colors[s], label=s, conf=0.99)
+
+            ax.grid(True)
+            ax.set_aspect("equal")
+            ax.set_xlabel("In-phase [mV]")
+            ax.set_ylabel("Quadrature [mV]")
+            ax.legend()
+
+            finalize_plot(
+                fig,
+                f"IQ blobs",
+                qu_id,
+                fit_res,
+                qubit_params,
+                updated_params=anal_res.updated_params.get(qu_id, {}),
+                sweep_info=sweep_info,
+                relevant_params=relevant_params,
+            )
+            return fig
+
+        anal_res.add_figure(make_figure(render, headless), "fig", qu_id)
+
+    if clf is not None:
+
+        def render_assignment():
+            fig_assignment, ax = plt.subplots(1, 1)
+            plot_assignment_matrix(ax, clf)
+            return fig_assignment
+
+        anal_res.add_figure(
+            make_figure(render_assignment, headless), "assignment", qu_id
+        )
 
     return anal_res
@@ -10,7 +10,16 @@ from laboneq_applications.typing import QuantumElements, QubitSweepPoints
 from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_handler
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.figures import make_figure
 from sqil_experiments.analysis.fit import find_shared_peak
+from sqil_experiments.analysis.parallel import parallel_qubits
+from sqil_experiments.analysis.rendering import plot_mag_phase_decimated
+from sqil_experiments.measurements.helpers.adaptive_sweep import (
+    DEFAULT_ZOOM_LINEWIDTHS,
+    DEFAULT_ZOOM_POINTS,
+    coarse_to_fine,
+)
 
 
 @task_options(base_class=BaseExperimentOptions)
@@ -97,6 +106,74 @@ class QuSpec(ExperimentHandler):
         return qu_spec_analysis(path=path, **kwargs)
 
 
+def locate_peak(freq, data):
+    """Returns the (frequency, linewidth) of the peak found by find_shared_peak, or
+    None if no acceptable fit is found."""
+    fit_res = find_shared_peak(freq, np.abs(data), np.unwrap(np.angle(data)))
+    if fit_res is None:
+        return None
+    params = fit_res.params_by_name
+    for name in ["fwhm", "fwhm1", "fwhm2"]:
+        if name in params:
+            return params["x0"], abs(params[name])
+    # Gaussian FWHM
+    return params["x0"], 2 * np.sqrt(2 * np.log(2)) * abs(params["sigma"])
+
+
+class QuSpecAdaptive(QuSpec):
+    """Qubit spectroscopy on a coarse grid, followed by dense sweeps around the peaks
+    found on it. The two passes are stored as a single dataset, with an irregular
+    frequency axis, and analyzed as a normal qubit spectroscopy.
+
+    Example
+    -------
+    >>> qu_spec = QuSpecAdaptive()
+    >>> qu_spec.run(np.linspace(4e9, 6e9, 201), transition="ge", zoom_points=81)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The sequence runs the passes itself and returns the merged data
+        self.is_zi_exp = False
+
+    def sequence(
+        self,
+        coarse_frequencies,
+        transition="ge",
+        qu_ids=["q0"],
+        options: QuSpecOptions | None = None,
+        n_features: int = 1,
+        zoom_points: int = DEFAULT_ZOOM_POINTS,
+        n_linewidths: float = DEFAULT_ZOOM_LINEWIDTHS,
+        *params,
+        **kwargs,
+    ):
+        qu_ids = make_iterable(qu_ids)
+        if len(qu_ids) > 1:
+            raise ValueError("Only one qubit at the time is allowed")
+        qu_id = qu_ids[0]
+        qubits = [self.qpu[qu_id]]
+
+        def acquire(frequencies):
+            exp = create_experiment(
+                self.qpu, qubits, [frequencies], options=options, transition=transition
+            )
+            result = self.zi_session.run(self.zi_session.compile(exp))
+            return result.get_data(dsl.handles.result_handle(qu_id))
+
+        freqs, data, _ = coarse_to_fine(
+            acquire,
+            np.atleast_2d(coarse_frequencies)[0],
+            locate_peak,
+            n_features=n_features,
+            zoom_points=zoom_points,
+            n_linewidths=n_linewidths,
+        )
+        return {"data": data, "frequencies": freqs}
+
+
+@cached_analysis(version=1)
+@parallel_qubits
 @multi_qubit_handler
 def qu_spec_analysis(
     datadict,
@@ -105,6 +182,7 @@ def qu_spec_analysis(
     qpu=None,
     at_sweep_idx=None,
     relevant_params=["spectroscopy_amplitude"],
+    headless=False,
     **kwargs,
 ) -> AnalysisResult:
     # Prepare analysis result object
@@ -123,11 +201,8 @@ def qu_spec_analysis(
 
     has_sweeps = y_data.ndim > 1
     if not has_sweeps:
-        # Plot without fit
-        fig, axs = plot_mag_phase(datadict=datadict)
-        anal_res.add_figure(fig, "fig", qu_id)
-
         # Fit data to extract parameters
+        trace = None
         try:
             is_wide_range = x_data[-1] - x_data[0] > 200e6
             mag, phase = np.abs(y_data), np.unwrap(np.angle(y_data))
@@ -139,7 +214,11 @@ def qu_spec_analysis(
             anal_res.add_fit(fit_res, "Combined mag-phase fit", qu_id)
             param_id = f"resonance_frequency_{transition}"
             anal_res.add_params({param_id: fit_res.params_by_name["x0"]}, qu_id)
-            # Plot
+
+        def plot():
+            fig, axs = plot_mag_phase(datadict=datadict)
+            if fit_res is None:
+                return fig
             x_fit = np.linspace(x_data[0], x_data[-1], np.max([2000, len(x_data)]))
             if trace in ["mag", "phase"]:
                 ax_idx = 1
@@ -154,24 +233,32 @@ def qu_spec_analysis(
                 y_fit_phase = y_fit[len(x_fit) :]
                 axs[0].plot(x_fit * x_info.scale, y_fit_mag, color="tab:red")
                 axs[1].plot(x_fit * x_info.scale, y_fit_phase, color="tab:red")
+            return fig
+
     else:
         invert_sweep_axis = False
         if sweep_info[0].id == "current":
             invert_sweep_axis = True
-        fig, axs = plot_mag_phase(datadict=datadict, transpose=invert_sweep_axis)
-        anal_res.add_figure(fig, "fig", qu_id)
-        fit_res = None
-
-    finalize_plot(
-        fig,
-        f"Qubit spectroscopy ({transition})",
-        qu_id,
-        fit_res,
-        qubit_params=qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
-    fig.tight_layout()
+
+        def plot():
+            fig, _ = plot_mag_phase_decimated(datadict, transpose=invert_sweep_axis)
+            return fig
+
+    def render():
+        fig = plot()
+        finalize_plot(
+            fig,
+            f"Qubit spectroscopy ({transition})",
+            qu_id,
+            fit_res,
+            qubit_params=qubit_params,
+            updated_params=anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        fig.tight_layout()
+        return fig
+
+    anal_res.add_figure(make_figure(render, headless), "fig", qu_id)
 
     return anal_res
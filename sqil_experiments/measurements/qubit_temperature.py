@@ -12,6 +12,11 @@ from numpy.typing import ArrayLike
 from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_handler
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.bootstrap import bootstrap_mean
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.parallel import parallel_qubits
+
 
 @task_options(base_class=BaseExperimentOptions)
 class QubitTemperatureOptions:
@@ -92,6 +97,8 @@ class QubitTemperature(ExperimentHandler):
         return analyze_qubit_temperature(path=path, **kwargs)
 
 
+@cached_analysis(version=3)
+@parallel_qubits
 @multi_qubit_handler
 def analyze_qubit_temperature(
     datadict,
@@ -100,6 +107,7 @@ def analyze_qubit_temperature(
     transition="ge",
     relevant_params=None,
     qu_freq=None,
+    headless=False,
     **kwargs,
 ):
     # Prepare analysis result object
@@ -112,30 +120,37 @@ def analyze_qubit_temperature(
 
     # A_no_ge = np.mean(proj_no_pi)
 
-    fit_res, fig = None, None
+    fit_res = None
     qubit_params = enrich_qubit_params(qpu[qu_id]) if qpu else {}
 
     if relevant_params is None:
         relevant_params = [f"ef_drive_amplitude_pi"]
 
     # TODO: define datas here - maybe make a fake datadict
-    T_qu = np.nan
+    T_qu, P_e = np.nan, np.nan
     qu_freq = qpu.quantum_elements[int(qu_id[1:])].parameters.resonance_frequency_ge
 
-    # Set plot style
-    set_plot_style(plt)
-
     has_sweeps = y_data.ndim > 1
     if not has_sweeps:
+        proj_no_pi, proj_pi = None, None
         try:
             # Extract and project the data
             amplitudes = datadict["amplitude"]
             proj_no_pi = fit.transform_data(datadict["data_no_pi"])
             proj_pi = fit.transform_data(datadict["data_pi"])
 
-            # Plot
+            T_qu, P_e = compute_qubit_temp(proj_pi, proj_no_pi, qu_freq)
+
+            anal_res.add_output({"T": T_qu, "P_e": P_e}, qu_id)
+
+        except Exception as e:
+            print("Error while fitting projected data", e)
+
+        def plot():
+            if proj_pi is None:
+                fig, _ = plot_mag_phase(datadict=datadict, raw=True)
+                return fig
             fig, axs = plot_projection_IQ(datadict=datadict, proj_data=proj_no_pi)
-            anal_res.add_figure(fig, "fig", qu_id)
             # Add pi data to plot
             axs[0].plot(
                 amplitudes * x_info.scale,
@@ -150,13 +165,7 @@ def analyze_qubit_temperature(
                 color="tab:orange",
             )
             axs[0].legend([r"without $\pi$-pulse", r"with $\pi$-pulse"])
-
-            T_qu, P_e = compute_qubit_temp(proj_pi, proj_no_pi, qu_freq)
-
-            anal_res.add_output({"T": T_qu, "P_e": P_e}, qu_id)
-
-        except Exception as e:
-            print("Error while fitting projected data", e)
+            return fig
 
     elif sweep_info[0].id == "index":
         idx = sweeps[0]
@@ -174,26 +183,40 @@ def analyze_qubit_temperature(
         anal_res.add_output(
             {"T": T_qu, "T_std": T_qu_std, "P_e": P_e, "P_e_std": P_e_std}, qu_id
         )
+        # Bootstrap uncertainty of the mean temperature
+        boot = bootstrap_mean(T_qu_arr)
+        anal_res.add_output({"T_mean_std": boot["std"], "T_ci": boot["ci"]}, qu_id)
+
+        def plot():
+            fig, ax = plt.subplots(1, 1)
+            ax.plot(sweeps[0] * sweep_info[0].scale, T_qu_arr * 1e3, "o")
+            ax.set_xlabel(sweep_info[0].name_and_unit)
+            ax.set_ylabel("Temperature [mK]")
+            return fig
 
-        fig, ax = plt.subplots(1, 1)
-        anal_res.add_figure(fig, "fig", qu_id)
-        ax.plot(sweeps[0] * sweep_info[0].scale, T_qu_arr * 1e3, "o")
-        ax.set_xlabel(sweep_info[0].name_and_unit)
-        ax.set_ylabel("Temperature [mK]")
     else:
-        fig, axs = plot_mag_phase(datadict=datadict, raw=True)
-        anal_res.add_figure(fig, "fig", qu_id)
-
-    finalize_plot(
-        fig,
-        f"Qubit temperature {T_qu*1e3:.1f} mK - $P_e$ = {P_e*100:.2f} %",
-        qu_id,
-        fit_res,
-        qubit_params,
-        anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+
+        def plot():
+            fig, axs = plot_mag_phase(datadict=datadict, raw=True)
+            return fig
+
+    def render():
+        # Set plot style
+        set_plot_style(plt)
+        fig = plot()
+        finalize_plot(
+            fig,
+            f"Qubit temperature {T_qu*1e3:.1f} mK - $P_e$ = {P_e*100:.2f} %",
+            qu_id,
+            fit_res,
+            qubit_params,
+            anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        return fig
+
+    anal_res.add_figure(make_figure(render, headless), "fig", qu_id)
 
     return anal_res
 
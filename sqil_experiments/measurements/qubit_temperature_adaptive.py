@@ -4,6 +4,18 @@ from IPython.display import clear_output
 from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_handler
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.parallel import parallel_qubits
+from sqil_experiments.measurements.helpers.calibration_graph import (
+    CalibrationGraph,
+    CalibrationNode,
+    next_sweep_point,
+    sweep_consumes,
+    within,
+)
+from sqil_experiments.measurements.helpers.compile_pipeline import CompilePipeline
+from sqil_experiments.measurements.helpers.handler_pool import HandlerPool
 from sqil_experiments.measurements.qu_spec import QuSpec
 from sqil_experiments.measurements.qubit_temperature import QubitTemperature
 from sqil_experiments.measurements.time_rabi import TimeRabi
@@ -16,9 +28,28 @@ class QubitTemperatureAdaptive(ExperimentHandler):
         "qu_freq_ef": {"role": "data", "unit": "Hz", "scale": 1e-9},
         "T": {"role": "data", "unit": "K", "scale": 1e3},
         "T_std": {"role": "data", "unit": "K", "scale": 1e3},
+        "T_mean_std": {"role": "data", "unit": "K", "scale": 1e3},
     }
 
-    def sequence(self, exp_params, qu_ids=["q0"], options=None, *args, **kwargs):
+    def run(self, *args, **kwargs):
+        # Keep the child experiments connected for the whole run and compile the
+        # next one while the current one acquires, when it does not depend on it
+        with HandlerPool(self, pipeline=CompilePipeline()) as self.pool:
+            self.calibration = CalibrationGraph(self.pool)
+            res = super().run(*args, **kwargs)
+        self.compile_trace = self.pool.pipeline.trace
+        return res
+
+    def sequence(
+        self,
+        exp_params,
+        qu_ids=["q0"],
+        options=None,
+        *args,
+        calibration_ttl=0,
+        sweep_tolerance=None,
+        **kwargs,
+    ):
         (
             spec_ge_options,
             rabi_ge_options,
@@ -34,58 +65,107 @@ class QubitTemperatureAdaptive(ExperimentHandler):
             qubit_temp_params,
         ) = exp_params
 
-        # Perform ge qubit spectroscopy
-        qu_spec = QuSpec(qpu=self.qpu)
-        qu_spec_res = qu_spec.run(
-            spec_ge_params,
-            transition="ge",
-            qu_ids=["q0"],
-            options=spec_ge_options,
-            update_params=True,
-            relevant_params=["readout_amplitude", "spectroscopy_amplitude"],
+        # The ge and ef calibrations are rerun at every point. With a calibration_ttl
+        # in seconds they are reused until it expires, or until the sweep or their
+        # inputs change
+        graph = self.calibration
+        graph.add(
+            CalibrationNode(
+                "qu_spec_ge",
+                QuSpec,
+                (spec_ge_params,),
+                {
+                    "transition": "ge",
+                    "qu_ids": ["q0"],
+                    "options": spec_ge_options,
+                    "update_params": True,
+                    "relevant_params": ["readout_amplitude", "spectroscopy_amplitude"],
+                },
+                produces=["resonance_frequency_ge"],
+                consumes=sweep_consumes(kwargs.get("sweeps"), sweep_tolerance),
+                ttl=calibration_ttl,
+                check=within(np.min(spec_ge_params), np.max(spec_ge_params)),
+            )
         )
-        # If not qubit frequency is found skip
-        qu_freq = qu_spec_res.updated_params.get("q0", {}).get(
-            "resonance_frequency_ge", np.nan
+        graph.add(
+            CalibrationNode(
+                "time_rabi_ge",
+                TimeRabi,
+                (rabi_ge_params,),
+                {
+                    "transition": "ge",
+                    "qu_ids": ["q0"],
+                    "options": rabi_ge_options,
+                    "update_params": True,
+                    "relevant_params": [
+                        "ge_drive_amplitude_pi",
+                        "resonance_frequency_ge",
+                    ],
+                },
+                produces=["ge_drive_length"],
+                consumes=["resonance_frequency_ge"],
+                ttl=calibration_ttl,
+            )
         )
-        if np.isnan(qu_freq):
-            # Remove figures from memory
-            plt.close("all")
-            clear_output()
-            return {
-                "qu_freq": np.nan,
-                "qu_freq_ef": np.nan,
-                "T": np.nan,
-                "T_std": np.nan,
-            }
-
-        # Perform ge ge time rabi
-        time_rabi = TimeRabi()
-        time_rabi_res = time_rabi.run(
-            rabi_ge_params,
-            transition="ge",
-            qu_ids=["q0"],
-            options=rabi_ge_options,
-            update_params=True,
-            relevant_params=["ge_drive_amplitude_pi", "resonance_frequency_ge"],
+        graph.add(
+            CalibrationNode(
+                "qu_spec_ef",
+                QuSpec,
+                (spec_ef_params,),
+                {
+                    "transition": "ef",
+                    "qu_ids": ["q0"],
+                    "options": spec_ef_options,
+                    "update_params": True,
+                    "relevant_params": ["readout_amplitude", "spectroscopy_amplitude"],
+                },
+                produces=["resonance_frequency_ef"],
+                consumes=["resonance_frequency_ge", "ge_drive_length"],
+                ttl=calibration_ttl,
+                check=within(np.min(spec_ef_params), np.max(spec_ef_params)),
+            )
         )
-
-        # Perform ef qubit spectroscopy
-        qu_spec = QuSpec()
-        qu_spec_res = qu_spec.run(
-            spec_ef_params,
-            transition="ef",
-            qu_ids=["q0"],
-            options=spec_ef_options,
-            update_params=True,
-            relevant_params=["readout_amplitude", "spectroscopy_amplitude"],
+        graph.add(
+            CalibrationNode(
+                "time_rabi_ef",
+                TimeRabi,
+                (rabi_ef_params,),
+                {
+                    "transition": "ef",
+                    "qu_ids": ["q0"],
+                    "options": rabi_ef_options,
+                    "update_params": True,
+                    "relevant_params": [
+                        "ef_drive_amplitude_pi",
+                        "resonance_frequency_ef",
+                    ],
+                },
+                produces=["ef_drive_length"],
+                consumes=["resonance_frequency_ef"],
+                ttl=calibration_ttl,
+            )
         )
-        qu_spec_res.updated_params
-        # If not qubit frequency is found skip
-        qu_freq_ef = qu_spec_res.updated_params.get("q0", {}).get(
-            "resonance_frequency_ef", np.nan
+        graph.add(
+            CalibrationNode(
+                "qubit_temperature",
+                QubitTemperature,
+                (qubit_temp_params,),
+                {
+                    "sweeps": {"index": np.arange(10)},
+                    "qu_ids": ["q0"],
+                    "options": qubit_temp_options,
+                },
+                consumes=["ge_drive_length", "ef_drive_length"],
+                ttl=0,
+                check=None,
+            )
         )
-        if np.isnan(qu_freq_ef):
+        # While qubit_temperature acquires, compile the calibration of the next sweep point
+        next_point = next_sweep_point(kwargs.get("sweeps"), self.qpu["q0"].parameters)
+        results = graph.run("qubit_temperature", next_point=next_point)
+
+        # If not qubit frequency is found skip
+        if graph.failed in ("qu_spec_ge", "qu_spec_ef"):
             # Remove figures from memory
             plt.close("all")
             clear_output()
@@ -94,44 +174,45 @@ class QubitTemperatureAdaptive(ExperimentHandler):
                 "qu_freq_ef": np.nan,
                 "T": np.nan,
                 "T_std": np.nan,
+                "T_mean_std": np.nan,
             }
+        qu_freq = self.qpu["q0"].parameters.resonance_frequency_ge
+        qu_freq_ef = self.qpu["q0"].parameters.resonance_frequency_ef
 
-        # Perform ef ef time rabi
-        time_rabi = TimeRabi()
-        time_rabi_res = time_rabi.run(
-            rabi_ef_params,
-            transition="ef",
-            qu_ids=["q0"],
-            options=rabi_ef_options,
-            update_params=True,
-            relevant_params=["ef_drive_amplitude_pi", "resonance_frequency_ef"],
-        )
-
-        # Qubit temperature
-        qubit_temp = QubitTemperature()
-        qubit_temp_res = qubit_temp.run(
-            qubit_temp_params,
-            sweeps={"index": np.arange(10)},
-            qu_ids=["q0"],
-            options=qubit_temp_options,
-        )
-
-        T = qubit_temp_res.output.get("q0", {}).get("T", np.nan)
-        T_std = qubit_temp_res.output.get("q0", {}).get("T_std", np.nan)
+        # T_std is the spread of the repeated measurements, T_mean_std the
+        # bootstrap error of their mean
+        T, T_std, T_mean_std = np.nan, np.nan, np.nan
+        qubit_temp_res = results.get("qubit_temperature")
+        if qubit_temp_res is not None:
+            output = qubit_temp_res.output.get("q0", {})
+            T = output.get("T", np.nan)
+            T_std = output.get("T_std", np.nan)
+            T_mean_std = output.get("T_mean_std", np.nan)
 
         # Remove figures from memory
         plt.close("all")
         clear_output()
 
-        return {"qu_freq": qu_freq, "qu_freq_ef": qu_freq_ef, "T": T, "T_std": T_std}
+        return {
+            "qu_freq": qu_freq,
+            "qu_freq_ef": qu_freq_ef,
+            "T": T,
+            "T_std": T_std,
+            "T_mean_std": T_mean_std,
+        }
 
     def analyze(self, path, *args, **kwargs):
+        # Compile and acquisition times of the child experiments
+        if getattr(self, "pool", None) is not None:
+            self.pool.save_trace(path)
         return analyze_qubit_temperature_adaptive(path=path, **kwargs)
 
 
+@cached_analysis(version=1)
+@parallel_qubits
 @multi_qubit_handler
 def analyze_qubit_temperature_adaptive(
-    datadict, qpu=None, qu_id="q0", relevant_params=None, **kwargs
+    datadict, qpu=None, qu_id="q0", relevant_params=None, headless=False, **kwargs
 ):
     # Prepare analysis result object
     anal_res = AnalysisResult()
@@ -140,7 +221,6 @@ def analyze_qubit_temperature_adaptive(
     *_, sweeps = qu_data
     *_, sweep_info = qu_info
 
-    fit_res, fig = None, None
     qubit_params = enrich_qubit_params(qpu[qu_id]) if qpu else {}
 
     if relevant_params is None:
@@ -167,72 +247,80 @@ def analyze_qubit_temperature_adaptive(
     T_std_scaled = T_stds_masked * T_info.scale
 
     # T1 vs sweep
-    fig, ax = plt.subplots(1, 1)
-    anal_res.add_figure(fig, f"fig", qu_id)
-    sweep_scaled = sweeps[0] * sweep_info[0].scale
-
-    ax.errorbar(
-        sweep_scaled,
-        T_scaled,
-        yerr=T_std_scaled,
-        fmt="-o",
-        capthick=2,
-        elinewidth=2,
-        label=T_info.name,
-    )
-    ax.axhline(y=np.nanmean(T_scaled), color="tab:pink", linestyle="--", label="T avg")
-    ax.set_xlabel(sweep_info[0].name_and_unit)
-    ax.set_ylabel(T_info.name_and_unit)
-    ax.legend(loc="upper left")
-    # Qubit frequency vs sweep
-    ax_freq = ax.twinx()
-    ax_freq.plot(
-        sweep_scaled,
-        qu_freq_scaled,
-        "o-",
-        color="tab:orange",
-        alpha=0.5,
-        label=qu_freq_info.name,
-    )
-    ax_freq.set_ylabel(qu_freq_info.name_and_unit)
-    ax_freq.legend(loc="lower left")
-
-    finalize_plot(
-        fig,
-        f"Qubit temperature",
-        qu_id,
-        fit_res=None,
-        qubit_params=qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+    def plot_sweep():
+        fig, ax = plt.subplots(1, 1)
+        sweep_scaled = sweeps[0] * sweep_info[0].scale
+
+        ax.errorbar(
+            sweep_scaled,
+            T_scaled,
+            yerr=T_std_scaled,
+            fmt="-o",
+            capthick=2,
+            elinewidth=2,
+            label=T_info.name,
+        )
+        ax.axhline(
+            y=np.nanmean(T_scaled), color="tab:pink", linestyle="--", label="T avg"
+        )
+        ax.set_xlabel(sweep_info[0].name_and_unit)
+        ax.set_ylabel(T_info.name_and_unit)
+        ax.legend(loc="upper left")
+        # Qubit frequency vs sweep
+        ax_freq = ax.twinx()
+        ax_freq.plot(
+            sweep_scaled,
+            qu_freq_scaled,
+            "o-",
+            color="tab:orange",
+            alpha=0.5,
+            label=qu_freq_info.name,
+        )
+        ax_freq.set_ylabel(qu_freq_info.name_and_unit)
+        ax_freq.legend(loc="lower left")
+
+        finalize_plot(
+            fig,
+            f"Qubit temperature",
+            qu_id,
+            fit_res=None,
+            qubit_params=qubit_params,
+            updated_params=anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        return fig
+
+    anal_res.add_figure(make_figure(plot_sweep, headless), "fig", qu_id)
 
     # T vs qubit frequency
-    fig, ax = plt.subplots(1, 1)
-    anal_res.add_figure(fig, f"fig_freq", qu_id)
-    ax.errorbar(
-        qu_freq_scaled,
-        T_scaled,
-        yerr=T_std_scaled,
-        fmt="-o",
-        capthick=2,
-        elinewidth=2,
-    )
-
-    ax.axhline(y=np.nanmean(T_scaled), color="tab:pink", linestyle="--")
-    ax.set_xlabel(qu_freq_info.name_and_unit)
-    ax.set_ylabel(T_info.name_and_unit)
-
-    finalize_plot(
-        fig,
-        f"Qubit temperature",
-        qu_id,
-        fit_res=None,
-        qubit_params=qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+    def plot_freq():
+        fig, ax = plt.subplots(1, 1)
+        ax.errorbar(
+            qu_freq_scaled,
+            T_scaled,
+            yerr=T_std_scaled,
+            fmt="-o",
+            capthick=2,
+            elinewidth=2,
+        )
+
+        ax.axhline(y=np.nanmean(T_scaled), color="tab:pink", linestyle="--")
+        ax.set_xlabel(qu_freq_info.name_and_unit)
+        ax.set_ylabel(T_info.name_and_unit)
+
+        finalize_plot(
+            fig,
+            f"Qubit temperature",
+            qu_id,
+            fit_res=None,
+            qubit_params=qubit_params,
+            updated_params=anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        return fig
+
+    anal_res.add_figure(make_figure(plot_freq, headless), "fig_freq", qu_id)
 
     return anal_res
@@ -14,6 +14,13 @@ from laboneq_applications.experiments.options import TuneupExperimentOptions
 from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_handler
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.estimators import estimate_many_decaying_oscillations
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.parallel import parallel_qubits
+from sqil_experiments.analysis.rendering import plot_mag_phase_decimated
+from sqil_experiments.measurements.helpers.delay_planner import plan_ramsey_delays
+
 if TYPE_CHECKING:
     from collections.abc import Sequence
 
@@ -125,13 +132,35 @@ class Ramsey(ExperimentHandler):
         qubits = [self.qpu[qu_id] for qu_id in qu_ids]
         return create_experiment(self.qpu, qubits, time, detuning, options=options)
 
+    def plan_delays(self, detuning, qu_id="q0", transition="ge", **kwargs):
+        """Delays that minimize the expected variance of T2* given its current
+        value, or 2 * T1 if T2* is not known. See ``plan_ramsey_delays`` for the
+        options."""
+        params = self.qpu[qu_id].parameters
+        T2_star = getattr(params, f"{transition}_T2_star", None)
+        if not T2_star:
+            T2_star = 2 * (getattr(params, f"{transition}_T1", None) or 0)
+        if not T2_star or T2_star <= 0:
+            raise ValueError(
+                f"No {transition}_T2_star or {transition}_T1 estimate for {qu_id}"
+            )
+        return plan_ramsey_delays(T2_star, detuning, **kwargs)
+
     def analyze(self, path, *args, **kwargs):
         return analyze_ramsey(path=path, **kwargs)
 
 
+@cached_analysis(version=2)
+@parallel_qubits
 @multi_qubit_handler
 def analyze_ramsey(
-    datadict, qpu=None, qu_id="q0", transition="ge", relevant_params=None, **kwargs
+    datadict,
+    qpu=None,
+    qu_id="q0",
+    transition="ge",
+    relevant_params=None,
+    headless=False,
+    **kwargs,
 ):
     # Prepare analysis result object
     anal_res = AnalysisResult()
@@ -141,7 +170,7 @@ def analyze_ramsey(
     x_data, y_data, sweeps = qu_data
     x_info, y_info, sweep_info = qu_info
 
-    fit_res, fig = None, None
+    fit_res = None
     qubit_params = enrich_qubit_params(qpu[qu_id]) if qpu else {}
 
     if relevant_params is None:
@@ -152,16 +181,18 @@ def analyze_ramsey(
 
     has_sweeps = y_data.ndim > 1
     if not has_sweeps:
-        # Plot raw data and extract projection
-        fig, axs, proj, inv = plot_projection_IQ(datadict=datadict, full_output=True)
-        anal_res.add_figure(fig, "fig", qu_id)
+        # Extract projection
+        proj, inv = fit.transform_data(y_data, inv_transform=True)
 
         # Try to fit the sum of 1, 2 and 3 decaying oscillations and see which one fits best
         best_fit = None
         n_oscillation = [1, 2, 3]
         for n in n_oscillation:
             try:
-                fit_res = fit.fit_many_decaying_oscillations(x_data, proj, n)
+                guess = estimate_many_decaying_oscillations(x_data, proj, n)
+                fit_res = fit.fit_many_decaying_oscillations(
+                    x_data, proj, n, guess=guess
+                )
             except:
                 fit_res = None
             if fit_res is not None:
@@ -181,54 +212,68 @@ def analyze_ramsey(
             T2_star = np.min(taus)
             anal_res.add_params({f"{transition}_T2_star": T2_star}, qu_id)
 
-            x_fit = np.linspace(x_data[0], x_data[-1], 3 * len(x_data))
-            inverse_fit = inv(best_fit.predict(x_fit))
+        def plot():
+            # Plot raw data and the fit
+            fig, axs = plot_projection_IQ(datadict=datadict, proj_data=proj)
+            if best_fit is not None:
+                x_fit = np.linspace(x_data[0], x_data[-1], 3 * len(x_data))
+                inverse_fit = inv(best_fit.predict(x_fit))
+                axs[0].plot(
+                    x_fit * x_info.scale,
+                    best_fit.predict(x_fit) * y_info.scale,
+                    "tab:red",
+                )
+                axs[1].plot(
+                    inverse_fit.real * y_info.scale,
+                    inverse_fit.imag * y_info.scale,
+                    "tab:red",
+                )
+            return fig
 
-            # Plot the fit
-            axs[0].plot(
-                x_fit * x_info.scale, best_fit.predict(x_fit) * y_info.scale, "tab:red"
-            )
-            axs[1].plot(
-                inverse_fit.real * y_info.scale,
-                inverse_fit.imag * y_info.scale,
-                "tab:red",
+        def plot_fft():
+            x_fft, y_fft = compute_fft(x_data, proj)
+            x_peaks, y_peaks = get_peaks(x_fft, y_fft)
+            set_plot_style(plt)
+            fig2, ax2 = plt.subplots(1, 1)
+            ax2.plot(x_fft / 1e6, y_fft)
+            ax2.scatter(
+                x_peaks / 1e6,
+                y_peaks,
+                color="tab:red",
+                marker="x",
+                zorder=3,
+                s=100,
+                label="Peaks",
             )
+            ax2.set_xlabel("Frequency [MHz]")
+            ax2.set_ylabel("FFT amplitude")
+            ax2.set_title("Fourier transform")
+            ax2.legend()
+            fig2.tight_layout()
+            return fig2
+
+    else:
 
-        # Plot FFT
-        x_fft, y_fft = compute_fft(x_data, proj)
-        x_peaks, y_peaks = get_peaks(x_fft, y_fft)
-        set_plot_style(plt)
-        fig2, ax2 = plt.subplots(1, 1)
-        ax2.plot(x_fft / 1e6, y_fft)
-        ax2.scatter(
-            x_peaks / 1e6,
-            y_peaks,
-            color="tab:red",
-            marker="x",
-            zorder=3,
-            s=100,
-            label="Peaks",
+        def plot():
+            fig, _ = plot_mag_phase_decimated(datadict, raw=True)
+            return fig
+
+    def render():
+        fig = plot()
+        finalize_plot(
+            fig,
+            f"Ramsey ({transition})",
+            qu_id,
+            fit_res,
+            qubit_params,
+            updated_params=anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
         )
-        ax2.set_xlabel("Frequency [MHz]")
-        ax2.set_ylabel("FFT amplitude")
-        ax2.set_title("Fourier transform")
-        ax2.legend()
-        fig2.tight_layout()
-        anal_res.add_figure(fig2, "fft", qu_id)
+        return fig
 
-    else:
-        fig, axs = plot_mag_phase(datadict=datadict, raw=True)
-        anal_res.add_figure(fig, "fig", qu_id)
-
-    finalize_plot(
-        fig,
-        f"Ramsey ({transition})",
-        qu_id,
-        fit_res,
-        qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+    anal_res.add_figure(make_figure(render, headless), "fig", qu_id)
+    if not has_sweeps:
+        anal_res.add_figure(make_figure(plot_fft, headless), "fft", qu_id)
 
     return anal_res
@@ -13,6 +13,16 @@ from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_
 from sqil_core.fit import FitQuality
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.parallel import parallel_qubits
+from sqil_experiments.analysis.rendering import plot_mag_phase_decimated
+from sqil_experiments.measurements.helpers.adaptive_sweep import (
+    DEFAULT_ZOOM_LINEWIDTHS,
+    DEFAULT_ZOOM_POINTS,
+    coarse_to_fine,
+)
+
 
 @task_options(base_class=BaseExperimentOptions)
 class RRSpecOptions:
@@ -109,6 +119,63 @@ class RRSpec(ExperimentHandler):
         return rr_spec_analysis(path=path, **kwargs)
 
 
+def locate_resonance(freq, data, measurement):
+    """Returns the (frequency, linewidth) of the resonance estimated by quick_fit."""
+    _, _, _, Q_tot, fr, *_ = sqil.resonator.quick_fit(freq, data, measurement)
+    return fr, fr / Q_tot
+
+
+class RRSpecAdaptive(RRSpec):
+    """Resonator spectroscopy on a coarse grid, followed by dense sweeps around the
+    resonances found on it. The two passes are stored as a single dataset, with an
+    irregular frequency axis, and analyzed as a normal resonator spectroscopy.
+
+    Example
+    -------
+    >>> rr_spec = RRSpecAdaptive()
+    >>> rr_spec.run([np.linspace(7e9, 8e9, 101)], zoom_points=101)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The sequence runs the passes itself and returns the merged data
+        self.is_zi_exp = False
+
+    def sequence(
+        self,
+        coarse_frequencies: list,
+        qu_ids=["q0"],
+        options: RRSpecOptions | None = None,
+        n_features: int = 1,
+        zoom_points: int = DEFAULT_ZOOM_POINTS,
+        n_linewidths: float = DEFAULT_ZOOM_LINEWIDTHS,
+        *params,
+        **kwargs,
+    ):
+        if len(qu_ids) > 1:
+            raise ValueError("Only one qubit at the time is allowed")
+        qu_id = qu_ids[0]
+        qubit = self.qpu[qu_id]
+        measurement = qubit.parameters.readout_configuration
+
+        def acquire(frequencies):
+            exp = create_experiment(self.qpu, qubit, frequencies, options=options)
+            result = self.zi_session.run(self.zi_session.compile(exp))
+            return result.get_data(dsl.handles.result_handle(qu_id))
+
+        freqs, data, _ = coarse_to_fine(
+            acquire,
+            np.atleast_2d(coarse_frequencies)[0],
+            lambda x, y: locate_resonance(x, y, measurement),
+            n_features=n_features,
+            zoom_points=zoom_points,
+            n_linewidths=n_linewidths,
+        )
+        return {"data": data, "readout_resonator_frequency": freqs}
+
+
+@cached_analysis(version=2)
+@parallel_qubits
 @multi_qubit_handler
 def rr_spec_analysis(
     datadict,
@@ -116,6 +183,8 @@ def rr_spec_analysis(
     qpu=None,
     at_sweep_idx=None,
     relevant_params=ONE_TONE_PARAMS,
+    title="Readout resonator spectroscopy",
+    headless=False,
     **kwargs,
 ) -> AnalysisResult:
     # Prepare analysis result object
@@ -142,7 +211,6 @@ def rr_spec_analysis(
     x_data_scaled = x_data * x_info.scale
     y_data_scaled = y_data * y_info.scale
 
-    set_plot_style(plt)
     if not has_sweeps:
         y_unit = y_info.unit
 
@@ -153,72 +221,85 @@ def rr_spec_analysis(
             y_unit = "V"
         y_unit_str = f" [{y_info.rescaled_unit}]" if y_unit else ""
 
-        # Plot without fit
-        fig, axs = sqil.resonator.plot_resonator(x_data_scaled, y_data_scaled)
-        anal_res.add_figure(fig, "fig", qu_id)
-        # Fix axis names
-        axs[0].set_xlabel("In-phase" + y_unit_str)
-        axs[0].set_ylabel("Quadrature" + y_unit_str)
-        axs[1].set_ylabel("Magnitude" + y_unit_str)
-        axs[2].set_xlabel(x_info.name_and_unit)
-
         # Try complex model fit
+        plot_fit = None
         try:
-            sub_anal_res = analyze_rr_complex_data(
-                qu_data, qu_info, measurement, axs, qu_id
-            )
+            sub_anal_res = analyze_rr_complex_data(qu_data, qu_info, measurement, qu_id)
             anal_res.update(sub_anal_res)
             fit_res = sub_anal_res.get_fit("Complex fit", qu_id)
+            plot_fit = plot_rr_complex_fit
         except Exception as e:
             print(f"Error fitting the complex resonator data:", e)
             print(f"Trying to fit just the magnitude")
             # Fallback to linmag squared fit
             try:
-                sub_anal_res = analyze_rr_magnitude(qu_data, qu_info, axs, qu_id)
+                sub_anal_res = analyze_rr_magnitude(qu_data, qu_info, qu_id)
                 anal_res.update(sub_anal_res)
                 fit_res = sub_anal_res.get_fit("Magnitude squared fit", qu_id)
+                plot_fit = plot_rr_magnitude_fit
             except Exception as e2:
                 print(f"Error fitting the magnitude:", e2)
                 fit_res = None
+
+        def plot():
+            fig, axs = sqil.resonator.plot_resonator(x_data_scaled, y_data_scaled)
+            # Fix axis names
+            axs[0].set_xlabel("In-phase" + y_unit_str)
+            axs[0].set_ylabel("Quadrature" + y_unit_str)
+            axs[1].set_ylabel("Magnitude" + y_unit_str)
+            axs[2].set_xlabel(x_info.name_and_unit)
+            if plot_fit is not None:
+                plot_fit(axs, fit_res, qu_data, qu_info)
+            return fig
+
     elif has_sweeps:
         invert_sweep_axis = False
         if sweep_info[0].id == "current":
             invert_sweep_axis = True
-        fig, axs = plot_mag_phase(datadict=datadict, transpose=invert_sweep_axis)
-        anal_res.add_figure(fig, "fig", qu_id)
+        best_amp = None
 
         sweep0_info = sweep_info[0]
         if sweep0_info.id == "readout_amplitude":
-            power_offset = qubit_params["readout_range_out"].value
-            add_power_axis(axs[0], power_offset)
             # Try to extract the optimal readout amplitude
             # If the optimal amplitude is found, run rr_spec_analysis on the chosen trace
             sub_anal_res = analyze_rr_amplitude_sweep(
-                qu_data, qu_info, datadict, qpu, axs, qu_id
+                qu_data, qu_info, datadict, qpu, qu_id, headless=headless
             )
             anal_res.update(sub_anal_res)
+            best_amp = sub_anal_res.updated_params.get(qu_id, {}).get(sweep0_info.id)
             fit_res = None
 
-    finalize_plot(
-        fig,
-        "Readout resonator spectroscopy",
-        qu_id,
-        fit_res=fit_res,
-        qubit_params=qubit_params,
-        updated_params=anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+        def plot():
+            fig, axs = plot_mag_phase_decimated(datadict, transpose=invert_sweep_axis)
+            if sweep0_info.id == "readout_amplitude":
+                power_offset = qubit_params["readout_range_out"].value
+                add_power_axis(axs[0], power_offset)
+                if best_amp is not None:
+                    axs[0].axhline(best_amp, color="tab:red", linestyle="--")
+            return fig
+
+    def render():
+        set_plot_style(plt)
+        fig = plot()
+        finalize_plot(
+            fig,
+            title,
+            qu_id,
+            fit_res=fit_res,
+            qubit_params=qubit_params,
+            updated_params=anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        fig.tight_layout()
+        return fig
 
-    fig.tight_layout()
-    # plt.show()
+    anal_res.add_figure(make_figure(render, headless), "fig", qu_id)
 
     return anal_res
 
 
-def analyze_rr_complex_data(
-    qu_data, qu_info, measurement, axs, qu_id
-) -> AnalysisResult:
+def analyze_rr_complex_data(qu_data, qu_info, measurement, qu_id) -> AnalysisResult:
     """Analyze the complex data to extract the resonance frequency and kappa_tot."""
     anal_res = AnalysisResult()
 
@@ -242,7 +323,16 @@ def analyze_rr_complex_data(
         {"readout_resonator_frequency": fr, "readout_kappa_tot": kappa_tot}, qu_id
     )
     anal_res.add_fit(fit_res, "Complex fit", qu_id)
-    # Plot
+    return anal_res
+
+
+def plot_rr_complex_fit(axs, fit_res, qu_data, qu_info):
+    """Plots the complex resonator fit on the axes of plot_resonator."""
+    x_data, y_data, *_ = qu_data
+    x_info, y_info, *_ = qu_info
+
+    fr = fit_res.params_by_name["fr"]
+    is_wide_range = x_data[-1] - x_data[0] > 200e6
     x_fit = np.linspace(x_data[0], x_data[-1], np.max([2000, len(x_data)]))
     y_fit_scaled = fit_res.predict(x_fit) * y_info.scale
     # Make sure the fitted unwrapped phase is aligned with the data
@@ -262,10 +352,9 @@ def analyze_rr_complex_data(
         np.unwrap(np.angle(y_fit_scaled)) + phase_offset,
         color="tab:red",
     )
-    return anal_res
 
 
-def analyze_rr_magnitude(qu_data, qu_info, axs, qu_id) -> AnalysisResult:
+def analyze_rr_magnitude(qu_data, qu_info, qu_id) -> AnalysisResult:
     """Analyze the squared magnitude to extract the resonance frequency."""
     anal_res = AnalysisResult()
 
@@ -280,16 +369,22 @@ def analyze_rr_magnitude(qu_data, qu_info, axs, qu_id) -> AnalysisResult:
     fr = fit_res.params_by_name["x0"]
     anal_res.add_params({"readout_resonator_frequency": fr}, qu_id)
     anal_res.add_fit(fit_res, "Magnitude squared fit", qu_id)
-    # Plot
+
+    return anal_res
+
+
+def plot_rr_magnitude_fit(axs, fit_res, qu_data, qu_info):
+    """Plots the magnitude squared fit on the axes of plot_resonator."""
+    x_data, y_data, *_ = qu_data
+    x_info, y_info, *_ = qu_info
+
     x_fit = np.linspace(x_data[0], x_data[-1], np.max([2000, len(x_data)]))
     y_fit = np.sqrt(fit_res.predict(x_fit)) * np.max(np.abs(y_data))
     axs[1].plot(x_fit * x_info.scale, y_fit * y_info.scale, color="tab:red")
 
-    return anal_res
-
 
 def analyze_rr_amplitude_sweep(
-    qu_data, qu_info, datadict, qpu, axs, qu_id
+    qu_data, qu_info, datadict, qpu, qu_id, headless=False
 ) -> AnalysisResult:
     """Tries to find the optimal amplitude for readout. If the optimal amplitude is found,
     also the single trace at the chosen amplitude in analyzed recursively.
@@ -319,38 +414,41 @@ def analyze_rr_amplitude_sweep(
         )
         is_fit_okay = quality >= FitQuality.GREAT
 
-    # Plot NRMSE vs amplitude
-    fig2, ax = plt.subplots(1, 1)
-    ax.plot(sweeps[0], nrmses, ".-", ms=20, color="tab:blue", mfc="tab:blue")
-    ax.axhline(
-        sqil.fit.FIT_QUALITY_THRESHOLDS["nrmse"][0][0],
-        label=f"Great fit",
-        linestyle="--",
-        color="tab:green",
-    )
-    ax.axhline(
-        sqil.fit.FIT_QUALITY_THRESHOLDS["nrmse"][1][0],
-        label=f"Good fit",
-        linestyle="--",
-        color="tab:olive",
-    )
-    ax.set_xlabel(sweep0_info.name_and_unit)
-    ax.set_ylabel("NRMSE")
-    ax.set_title("Magnitude squared fits")
-    if is_fit_okay:
-        ax.scatter(
-            sweeps[0][best_idx],
-            nrmses[best_idx],
-            color="tab:red",
-            zorder=3,
-            s=400,
-            marker="*",
-            label=f"Selected {str(sweep0_info.name).lower()}",
+    def plot_nrmses():
+        # Plot NRMSE vs amplitude
+        set_plot_style(plt)
+        fig2, ax = plt.subplots(1, 1)
+        ax.plot(sweeps[0], nrmses, ".-", ms=20, color="tab:blue", mfc="tab:blue")
+        ax.axhline(
+            sqil.fit.FIT_QUALITY_THRESHOLDS["nrmse"][0][0],
+            label=f"Great fit",
+            linestyle="--",
+            color="tab:green",
+        )
+        ax.axhline(
+            sqil.fit.FIT_QUALITY_THRESHOLDS["nrmse"][1][0],
+            label=f"Good fit",
+            linestyle="--",
+            color="tab:olive",
         )
-        axs[0].axhline(sweeps[0][best_idx], color="tab:red", linestyle="--")
-    ax.legend()
-    fig2.tight_layout()
-    anal_res.add_figure(fig2, "fig_best_amp", qu_id)
+        ax.set_xlabel(sweep0_info.name_and_unit)
+        ax.set_ylabel("NRMSE")
+        ax.set_title("Magnitude squared fits")
+        if is_fit_okay:
+            ax.scatter(
+                sweeps[0][best_idx],
+                nrmses[best_idx],
+                color="tab:red",
+                zorder=3,
+                s=400,
+                marker="*",
+                label=f"Selected {str(sweep0_info.name).lower()}",
+            )
+        ax.legend()
+        fig2.tight_layout()
+        return fig2
+
+    anal_res.add_figure(make_figure(plot_nrmses, headless), "fig_best_amp", qu_id)
 
     # Recursive step to update readout frequency and kappa_tot
     if is_fit_okay:
@@ -358,19 +456,18 @@ def analyze_rr_amplitude_sweep(
         anal_res.add_params({sweep0_info.id: best_amp}, qu_id)
         try:
             anal_res_no_sweep = rr_spec_analysis(
-                datadict=datadict, qpu=qpu, at_sweep_idx=best_idx, qu_id=qu_id
+                datadict=datadict,
+                qpu=qpu,
+                at_sweep_idx=best_idx,
+                qu_id=qu_id,
+                title="Readout trace at chosen operating point",
+                headless=headless,
             )
             # Rename fig to fig_single
             fig_single = anal_res_no_sweep.figures.pop(f"{qu_id}_fig")
             anal_res_no_sweep.add_figure(fig_single, "fig_single", qu_id)
             # Update analysis result
             anal_res.update(anal_res_no_sweep)
-
-            fig_single.suptitle(
-                fig_single.get_suptitle().replace(
-                    "resonator spectroscopy", "trace at chosen operating point"
-                )
-            )
         except Exception as e:
             fit_res = sqil.resonator.linmag_fit(
                 x_data[best_idx, :], y_data[best_idx, :]
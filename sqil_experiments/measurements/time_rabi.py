@@ -12,6 +12,12 @@ from numpy.typing import ArrayLike
 from sqil_core.experiment import AnalysisResult, ExperimentHandler, multi_qubit_handler
 from sqil_core.utils import *
 
+from sqil_experiments.analysis.cache import cached_analysis
+from sqil_experiments.analysis.estimators import estimate_decaying_oscillations
+from sqil_experiments.analysis.figures import make_figure
+from sqil_experiments.analysis.parallel import parallel_qubits
+from sqil_experiments.analysis.rendering import plot_mag_phase_decimated
+
 
 @task_options(base_class=BaseExperimentOptions)
 class TimeRabiOptions:
@@ -98,6 +104,8 @@ class TimeRabi(ExperimentHandler):
         return analyze_time_rabi(path=path, **kwargs)
 
 
+@cached_analysis(version=4)
+@parallel_qubits
 @multi_qubit_handler
 def analyze_time_rabi(
     datadict,
@@ -105,6 +113,7 @@ def analyze_time_rabi(
     qu_id="q0",
     transition="ge",
     relevant_params=None,
+    headless=False,
     **kwargs,
 ):
     # Prepare analysis result object
@@ -115,7 +124,7 @@ def analyze_time_rabi(
     lengths, y_data, sweeps = qu_data
     x_info, y_info, sweep_info = qu_info
 
-    fit_res, fig = None, None
+    fit_res = None
     qubit_params = enrich_qubit_params(qpu[qu_id]) if qpu else {}
 
     if relevant_params is None:
@@ -126,13 +135,14 @@ def analyze_time_rabi(
 
     has_sweeps = y_data.ndim > 1
     if not has_sweeps:
+        proj = None
         try:
-            # Project the data and start plot
+            # Project the data
             proj, inv = fit.transform_data(y_data, inv_transform=True)
-            fig, axs = plot_projection_IQ(datadict=datadict, proj_data=proj)
-            anal_res.add_figure(fig, "fig", qu_id)
             # Analyze
-            fit_res_exp = fit.fit_decaying_oscillations(lengths, proj)
+            # Seeded guess, keeping the multi-start over the phase
+            guess = estimate_decaying_oscillations(lengths, proj, num_init=10)
+            fit_res_exp = fit.fit_decaying_oscillations(lengths, proj, guess=guess)
             fit_res_const = fit.fit_oscillations(lengths, proj)
             fit_res = fit.get_best_fit(fit_res_exp, fit_res_const, recipe="nrmse_aic")
 
@@ -142,35 +152,51 @@ def analyze_time_rabi(
             anal_res.add_params(
                 {f"{transition}_drive_length": fit_res.metadata["pi_time"]}, qu_id
             )
-
-            x_fit = np.linspace(lengths[0], lengths[-1], 3 * len(lengths))
-            inverse_fit = inv(fit_res.predict(x_fit))
-
-            # Plot the fit
-            axs[0].plot(
-                x_fit * x_info.scale, fit_res.predict(x_fit) * y_info.scale, "tab:red"
-            )
-            axs[1].plot(
-                inverse_fit.real * y_info.scale,
-                inverse_fit.imag * y_info.scale,
-                "tab:red",
-            )
         except Exception as e:
+            fit_res = None
             print("Error while fitting projected data", e)
 
-    elif has_sweeps:
-        fig, axs = plot_mag_phase(datadict=datadict, raw=True)
-        anal_res.add_figure(fig, "fig", qu_id)
-
-    finalize_plot(
-        fig,
-        f"Time Rabi ({transition})",
-        qu_id,
-        fit_res,
-        qubit_params,
-        anal_res.updated_params.get(qu_id, {}),
-        sweep_info=sweep_info,
-        relevant_params=relevant_params,
-    )
+        def plot():
+            if proj is None:
+                fig, _ = plot_mag_phase_decimated(datadict, raw=True)
+                return fig
+            fig, axs = plot_projection_IQ(datadict=datadict, proj_data=proj)
+            if fit_res is not None:
+                # Plot the fit
+                x_fit = np.linspace(lengths[0], lengths[-1], 3 * len(lengths))
+                inverse_fit = inv(fit_res.predict(x_fit))
+                axs[0].plot(
+                    x_fit * x_info.scale,
+                    fit_res.predict(x_fit) * y_info.scale,
+                    "tab:red",
+                )
+                axs[1].plot(
+                    inverse_fit.real * y_info.scale,
+                    inverse_fit.imag * y_info.scale,
+                    "tab:red",
+                )
+            return fig
+
+    else:
+
+        def plot():
+            fig, _ = plot_mag_phase_decimated(datadict, raw=True)
+            return fig
+
+    def render():
+        fig = plot()
+        finalize_plot(
+            fig,
+            f"Time Rabi ({transition})",
+            qu_id,
+            fit_res,
+            qubit_params,
+            anal_res.updated_params.get(qu_id, {}),
+            sweep_info=sweep_info,
+            relevant_params=relevant_params,
+        )
+        return fig
+
+    anal_res.add_figure(make_figure(render, headless), "fig", qu_id)
 
     return anal_res
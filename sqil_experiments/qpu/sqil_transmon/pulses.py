@@ -1,8 +1,11 @@
 import numpy as np
 from laboneq.dsl.experiment.pulse_library import register_pulse_functional
 
+from sqil_experiments.qpu.waveform_cache import cached_waveform
+
 
 @register_pulse_functional
+@cached_waveform
 def gaussian_square_sqil(
     x, sigma=1 / 3, padding=10e-9, zero_boundaries=False, *, length, **_
 ):
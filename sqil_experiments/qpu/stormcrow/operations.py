@@ -10,6 +10,7 @@ from laboneq.simple import SectionAlignment, dsl
 from laboneq_applications.typing import QuantumElements
 
 from sqil_experiments.qpu.stormcrow.qubit import Stormcrow
+from sqil_experiments.qpu.waveform_cache import cached_waveform
 
 if TYPE_CHECKING:
     from collections.abc import Sequence
@@ -1179,6 +1180,7 @@ class StormcrowOperations(dsl.QuantumOperations):
 
 
 @dsl.pulse_library.register_pulse_functional
+@cached_waveform
 def x180_ef_reset_pulse(
     x: np.ndarray,
     frequency: float,
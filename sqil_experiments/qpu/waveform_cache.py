@@ -0,0 +1,123 @@
+"""Bounded LRU cache for sampled waveforms.
+
+LabOne Q samples every pulse functional each time an experiment is compiled. When
+the same pulses are reused across hundreds of sweep points the synthesis is repeated
+with identical inputs, so the samples are cached, keyed by the function, its
+parameters and the sampling points.
+"""
+
+from __future__ import annotations
+
+import hashlib
+from collections import OrderedDict
+from functools import wraps
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_MAX_BYTES = 256 * 1024**2
+
+# Parameters that do not change the samples
+IGNORED_PARAMS = ["uid"]
+
+
+class WaveformCache:
+    """Least recently used cache of numpy waveforms, bounded both in number of
+    entries and in total memory."""
+
+    def __init__(
+        self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self._nbytes = 0
+
+    def get(self, key: tuple) -> np.ndarray | None:
+        wfm = self._entries.get(key)
+        if wfm is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return wfm
+
+    def put(self, key: tuple, wfm: np.ndarray):
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key).nbytes
+        wfm = np.array(wfm)
+        wfm.flags.writeable = False
+        self._entries[key] = wfm
+        self._nbytes += wfm.nbytes
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._nbytes > self.max_bytes
+        ):
+            _, old = self._entries.popitem(last=False)
+            self._nbytes -= old.nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return (
+            f"WaveformCache({len(self)} entries, {self._nbytes / 1024**2:.1f} MB, "
+            f"hits={self.hits}, misses={self.misses})"
+        )
+
+
+waveform_cache = WaveformCache()
+
+
+def waveform_key(name: str, x, params: dict) -> tuple:
+    """Key of a waveform: function name, number of samples, a digest of the sampling
+    points and the pulse parameters."""
+    params = {k: v for k, v in params.items() if k not in IGNORED_PARAMS}
+    x = np.ascontiguousarray(x)
+    x_digest = hashlib.blake2b(x.tobytes(), digest_size=16).hexdigest()
+    return (name, len(x), x_digest, repr(sorted(params.items())))
+
+
+def cached_waveform(sampler=None, *, cache: WaveformCache | None = None):
+    """Memoizes a pulse sampler ``sampler(x, **pulse_params)``.
+
+    Apply it below ``register_pulse_functional``, so that the registered name is the
+    one of the sampler. Every call returns a new array.
+
+    Example
+    -------
+    >>> @register_pulse_functional
+    ... @cached_waveform
+    ... def my_pulse(x, sigma=1 / 3, **_):
+    ...     return np.exp(-(x**2) / (2 * sigma**2))
+    """
+
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        @wraps(func)
+        def wrapper(x, **params):
+            wfm_cache = cache or waveform_cache
+            key = waveform_key(name, x, params)
+            wfm = wfm_cache.get(key)
+            if wfm is None:
+                wfm = func(x, **params)
+                wfm_cache.put(key, wfm)
+            return np.array(wfm)
+
+        return wrapper
+
+    if sampler is not None:
+        return decorator(sampler)
+    return decorator